@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for scriptharness.
+
+These aren't run as part of the test suite; run them from the top of the
+source tree, e.g.::
+
+    python -m benchmarks.bench_structures --output results.json
+    python -m benchmarks.bench_structures --compare results.json
+
+Results are saved as json, so runs from different releases can be compared
+automatically.
+
+Attributes:
+  DEFAULT_NUMBER (int): the default number of calls per timing
+  DEFAULT_REPEAT (int): the default number of timings; we keep the best
+  DEFAULT_THRESHOLD (float): the default allowed slowdown before
+    compare_results() flags a regression, e.g. .2 for 20%
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import argparse
+import json
+import platform
+import sys
+import timeit
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import scriptharness.version
+
+DEFAULT_NUMBER = 10
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = .2
+
+
+def time_call(func, number=DEFAULT_NUMBER, repeat=DEFAULT_REPEAT,
+              setup=None):
+    """Time func(), keeping the best of `repeat` runs.
+
+    Args:
+      func (function): the function to time
+      number (int, optional): the number of calls per run
+      repeat (int, optional): the number of runs
+      setup (function, optional): called before each call, untimed.  Its
+        return value is passed to func, so mutating benchmarks can get a
+        fresh object every call.
+
+    Returns:
+      seconds (float): the best time per call
+    """
+    best = None
+    for _ in range(repeat):
+        elapsed = 0
+        for _ in range(number):
+            args = []
+            if setup is not None:
+                args.append(setup())
+            start = timeit.default_timer()
+            func(*args)
+            elapsed += timeit.default_timer() - start
+        elapsed /= number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(func):
+    """Measure the peak memory allocated while running func().
+
+    Args:
+      func (function): the function to measure
+
+    Returns:
+      peak_bytes (int): the tracemalloc peak, or None if tracemalloc isn't
+        available (python < 3.4).
+    """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def get_metadata():
+    """Describe the environment the results came from.
+
+    Returns:
+      metadata (dict)
+    """
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "scriptharness": scriptharness.version.__version_string__,
+    }
+
+
+def save_results(path, results):
+    """Save results as json.
+
+    Args:
+      path (str): the path to write to
+      results (dict): name: {"seconds": float, "peak_bytes": int} results
+    """
+    with open(path, 'w') as filehandle:
+        json.dump({"metadata": get_metadata(), "results": results},
+                  filehandle, sort_keys=True, indent=4)
+
+
+def load_results(path):
+    """Load results saved by save_results().
+
+    Args:
+      path (str): the path to read
+
+    Returns:
+      results (dict)
+    """
+    with open(path) as filehandle:
+        return json.load(filehandle)["results"]
+
+
+def compare_results(old, new, threshold=DEFAULT_THRESHOLD):
+    """Find the benchmarks that got slower, or use more memory.
+
+    Args:
+      old (dict): the baseline results
+      new (dict): the results to check
+      threshold (float, optional): the allowed increase, e.g. .2 for 20%
+
+    Returns:
+      regressions (list): (name, metric, old_value, new_value) tuples
+    """
+    regressions = []
+    for name in sorted(set(old).intersection(new)):
+        for metric in ("seconds", "peak_bytes"):
+            old_value = old[name].get(metric)
+            new_value = new[name].get(metric)
+            if not old_value or new_value is None:
+                continue
+            if new_value > old_value * (1 + threshold):
+                regressions.append((name, metric, old_value, new_value))
+    return regressions
+
+
+def get_parser(description):
+    """Create the commandline parser shared by the benchmarks.
+
+    Args:
+      description (str): the benchmark description for --help
+
+    Returns:
+      ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--output", metavar="PATH", help="Save the results as json to PATH."
+    )
+    parser.add_argument(
+        "--compare", metavar="PATH",
+        help="Compare against the json results in PATH, and exit non-zero "
+             "on regressions."
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="The allowed slowdown for --compare, e.g. .2 for 20%%."
+    )
+    return parser
+
+
+def report(results, args):
+    """Print the results, then save and/or compare them per args.
+
+    Args:
+      results (dict): name: {"seconds": float, "peak_bytes": int} results
+      args (argparse Namespace): from get_parser().parse_args()
+
+    Returns:
+      status (int): 1 if there were regressions, else 0
+    """
+    for name in sorted(results):
+        peak = results[name].get("peak_bytes")
+        print("%-45s %12.6fs %s" % (
+            name, results[name]["seconds"],
+            "" if peak is None else "%12d bytes peak" % peak
+        ))
+    if args.output:
+        save_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(load_results(args.compare), results,
+                                      threshold=args.threshold)
+        for name, metric, old_value, new_value in regressions:
+            print("REGRESSION %s %s: %s -> %s" % (name, metric, old_value,
+                                                  new_value),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
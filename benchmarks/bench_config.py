@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark config file loading at script startup.
+
+Write synthetic json configs of a few sizes, and time parse_config_file()
+without a cache, and on ParseCache hits with and without hash
+verification.  Building a LoggingDict config from a parsed dict, from a
+parse straight into LoggingDicts, and by flattening a LayeredConfig, are
+timed with their peak memory.
+
+Reading a --compile-config bundle of each config, with and without
+verifying its source fingerprint, and validating each parsed config
+against a matching ConfigSchema are timed too.
+
+Also time a cold python process that imports scriptharness.config and
+parses the config, without and with a warm ParseCache, since that's what a
+script pays at startup.
+
+Attributes:
+  SIZES (dict): name: get_config() kwargs for each synthetic config
+  LEAF_SCHEMA (dict): the schema for the synthetic configs' leaf dicts
+  STARTUP_SCRIPT (str): the python -c script for the startup timings
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from benchmarks import get_parser, peak_memory, report, time_call
+from benchmarks.bench_structures import get_config
+from scriptharness.cache import ParseCache
+from scriptharness.config import parse_config_file, read_config_bundle, \
+    write_config_bundle
+from scriptharness.schema import ConfigSchema
+from scriptharness.structures import LayeredConfig, LoggingDict
+
+SIZES = {
+    "small": {"breadth": 20, "depth": 2, "list_size": 5},
+    "large": {"breadth": 40, "depth": 3, "list_size": 20},
+}
+LEAF_SCHEMA = {
+    "type": "dict",
+    "keys": {
+        "url": {"type": "str"},
+        "list": {"type": "list", "items": {"type": "int"}},
+    },
+}
+STARTUP_SCRIPT = """
+import sys
+from scriptharness.cache import ParseCache
+from scriptharness.config import parse_config_file, read_config_bundle, \
+    write_config_bundle
+kwargs = {}
+if len(sys.argv) > 2:
+    kwargs['parse_cache'] = ParseCache(sys.argv[2])
+parse_config_file(sys.argv[1], **kwargs)
+"""
+
+
+def get_schema(depth):
+    """Create a ConfigSchema matching get_config(depth=depth) configs.
+
+    Args:
+      depth (int): the number of levels of nested dicts
+
+    Returns:
+      ConfigSchema
+    """
+    schema = LEAF_SCHEMA
+    for _ in range(depth - 1):
+        schema = {"type": "dict", "values": schema}
+    return ConfigSchema({"values": schema})
+
+
+def time_startup(args, repeat=3):
+    """Time a python process running STARTUP_SCRIPT, keeping the best run.
+
+    Args:
+      args (list): the STARTUP_SCRIPT arguments
+      repeat (int, optional): the number of runs
+
+    Returns:
+      seconds (float)
+    """
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        subprocess.check_call([sys.executable, "-c", STARTUP_SCRIPT] + args)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_size(name, path, cache_dir, results):
+    """Run the benchmarks for a single config file.
+
+    Args:
+      name (str): the size name, for result names; a SIZES key
+      path (str): the json config file
+      cache_dir (str): the ParseCache directory to use
+      results (dict): the results dict to add to
+    """
+    size = os.path.getsize(path)
+
+    def add(bench, seconds, func=None):
+        """Record a timing, and func's peak memory if specified."""
+        result = {"seconds": seconds, "file_bytes": size}
+        if func is not None:
+            result["peak_bytes"] = peak_memory(func)
+        results["%s/%s" % (name, bench)] = result
+
+    def to_logging_dict(target=None):
+        """Parse, merge into a dict and build a LoggingDict, like
+        build_config() and Script.dict_to_config() do."""
+        config = {}
+        config.update(parse_config_file(path, target=target))
+        return LoggingDict(config)
+
+    parse_cache = ParseCache(cache_dir)
+    unverified_cache = ParseCache(cache_dir, verify_hash=False)
+    parse_config_file(path, parse_cache=parse_cache)
+    add("parse/json", time_call(lambda: parse_config_file(path)))
+    add("parse/ParseCache", time_call(
+        lambda: parse_config_file(path, parse_cache=parse_cache)
+    ))
+    add("parse/ParseCache_no_verify", time_call(
+        lambda: parse_config_file(path, parse_cache=unverified_cache)
+    ))
+    def to_layered_logging_dict():
+        """Parse and flatten a LayeredConfig, like Script.build_config()
+        does."""
+        return LayeredConfig([
+            ("parser defaults", {}), ("initial_config", {}),
+            (path, parse_config_file(path)), ("commandline", {}),
+        ]).flatten()
+
+    for bench, func in (
+            ("LoggingDict/from_dict", to_logging_dict),
+            ("LoggingDict/target",
+             lambda: to_logging_dict(target=LoggingDict.from_pairs)),
+            ("LoggingDict/LayeredConfig", to_layered_logging_dict),
+    ):
+        add(bench, time_call(func, number=3), func=func)
+    bundle_path = path + ".bundle"
+    write_config_bundle(bundle_path, parse_config_file(path), [path])
+    add("bundle/read", time_call(lambda: read_config_bundle(bundle_path)))
+    add("bundle/read_no_verify", time_call(
+        lambda: read_config_bundle(bundle_path, verify=False)
+    ))
+    config_schema = get_schema(SIZES[name]["depth"])
+    config = parse_config_file(path)
+    add("schema/validate", time_call(lambda: config_schema.validate(config)))
+    add("startup/json", time_startup([path]))
+    add("startup/ParseCache", time_startup([path, cache_dir]))
+
+
+def main():
+    """Run the benchmarks for each config size, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--size", action="append", choices=sorted(SIZES.keys()),
+        help="Only run these sizes.  Defaults to all of them."
+    )
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name in args.size or sorted(SIZES.keys()):
+            path = os.path.join(tempdir, "%s.json" % name)
+            with open(path, "w") as filehandle:
+                json.dump(get_config(**SIZES[name]), filehandle)
+            bench_size(name, path, os.path.join(tempdir, "cache"), results)
+    finally:
+        shutil.rmtree(tempdir)
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark scriptharness.config.download_url throughput.
+
+Serve an in-memory payload from a local http server, and time downloading
+it with a range of chunk sizes, and with download_url_parallel() at a range
+of segment counts.  Each result also records the throughput in MB/s.
+
+Locally, a single stream isn't the bottleneck; use --rate to cap each
+connection's bandwidth, like a high-latency link would, to see what
+segmenting buys.
+
+Attributes:
+  CHUNK_SIZES (tuple): the download_url() chunk_size values to time
+  SEGMENTS (tuple): the download_url_parallel() segments values to time
+  DEFAULT_SIZE (int): the default payload size, in MiB
+  BLOCK_SIZE (int): the number of bytes the server sends at a time
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+from contextlib import contextmanager
+import os
+import shutil
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import get_parser, report, time_call
+from scriptharness.config import DEFAULT_CHUNK_SIZE, SESSION_POOL, \
+    download_url, download_url_parallel
+
+CHUNK_SIZES = (1024, 16 * 1024, DEFAULT_CHUNK_SIZE, 1024 * 1024)
+SEGMENTS = (2, 4, 8)
+DEFAULT_SIZE = 64
+BLOCK_SIZE = 64 * 1024
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+    """Serve the server's payload for any GET, honoring byte ranges.
+    """
+    def send_payload(self, head=False):
+        """Send the payload headers, and the body unless head is set.
+        """
+        payload = self.server.payload
+        start, end = 0, len(payload) - 1
+        range_header = self.headers.get("Range")
+        if range_header:
+            start, end = range_header.split("=")[1].split("-")
+            start = int(start)
+            end = int(end) if end else len(payload) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                start, end, len(payload)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        if head:
+            return
+        rate = self.server.rate
+        for offset in range(start, end + 1, BLOCK_SIZE):
+            self.wfile.write(payload[offset:min(offset + BLOCK_SIZE,
+                                                end + 1)])
+            if rate:
+                time.sleep(BLOCK_SIZE / rate)
+
+    def do_GET(self):
+        """Send the payload.
+        """
+        self.send_payload()
+
+    def do_HEAD(self):
+        """Send the payload headers.
+        """
+        self.send_payload(head=True)
+
+    def log_message(self, *args):
+        """Don't log every request to stderr.
+        """
+        pass
+
+
+class PayloadServer(ThreadingMixIn, HTTPServer):
+    """Threaded http server with a payload attribute.
+    """
+    daemon_threads = True
+    payload = b''
+    rate = 0
+
+
+@contextmanager
+def serve_payload(payload, rate=0):
+    """Serve payload on a free localhost port in a background thread.
+
+    Args:
+      payload (bytes): the contents to serve
+      rate (float, optional): cap each connection at this many bytes per
+        second.  0 is unlimited.
+
+    Yields:
+      url (str)
+    """
+    server = PayloadServer(("127.0.0.1", 0), PayloadHandler)
+    server.payload = payload
+    server.rate = rate
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d/payload" % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    """Time download_url() per chunk size and download_url_parallel() per
+    segment count, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--size", type=int, default=DEFAULT_SIZE,
+        help="The payload size in MiB.  Defaults to %(default)s."
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0,
+        help="Cap each connection at RATE MiB/s.  Defaults to unlimited."
+    )
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    payload = os.urandom(size)
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, "payload")
+    results = {}
+
+    def add(name, func):
+        """Time func, and record the throughput."""
+        seconds = time_call(func, number=1)
+        results[name] = {
+            "seconds": seconds,
+            "mb_per_sec": size / 1024 / 1024 / seconds,
+        }
+
+    try:
+        with serve_payload(payload, rate=args.rate * 1024 * 1024) as url:
+            for chunk_size in CHUNK_SIZES:
+                add("download_url/chunk_size=%d" % chunk_size,
+                    lambda c=chunk_size: download_url(url, path=path,
+                                                      chunk_size=c))
+            for segments in SEGMENTS:
+                add("download_url_parallel/segments=%d" % segments,
+                    lambda s=segments: download_url_parallel(
+                        url, path=path, segments=s
+                    ))
+    finally:
+        SESSION_POOL.close()
+        shutil.rmtree(tempdir)
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
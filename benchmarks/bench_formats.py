@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark parse_config_file() per config format.
+
+Write the bench_config synthetic configs in each format we can write
+here, and time parsing them.  Formats whose modules aren't installed are
+skipped.  toml is only timed if a toml writer is installed.
+
+Attributes:
+  WRITERS (dict): format name: (extension, function returning the
+    serialized config as bytes, or None if it can't be written here)
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import json
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks import get_parser, report, time_call
+from benchmarks.bench_config import SIZES
+from benchmarks.bench_structures import get_config
+from scriptharness.config import parse_config_file
+
+
+def get_dumps(*modules):
+    """Find the dumps() of the first importable module.
+
+    Args:
+      *modules (str): the module names to try
+
+    Returns:
+      dumps (callable), or None
+    """
+    for module in modules:
+        try:
+            return __import__(module).dumps
+        except (ImportError, AttributeError):
+            continue
+    return None
+
+
+def dump_yaml(config):
+    """Serialize config as yaml, with the C dumper if we have it."""
+    import yaml
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    return yaml.dump(config, Dumper=dumper).encode('utf-8')
+
+
+def dump_msgpack(config):
+    """Serialize config as msgpack."""
+    import msgpack
+    return msgpack.packb(config, use_bin_type=True)
+
+
+def dump_toml(config):
+    """Serialize config as toml."""
+    return get_dumps("toml", "tomli_w")(config).encode('utf-8')
+
+
+WRITERS = {
+    "json": (".json", lambda config: json.dumps(config).encode('utf-8')),
+    "marshal": (".marshal", marshal.dumps),
+    "msgpack": (".msgpack", dump_msgpack),
+    "yaml": (".yaml", dump_yaml),
+    "toml": (".toml", dump_toml if get_dumps("toml", "tomli_w") else None),
+}
+
+
+def main():
+    """Time parsing each size in each format, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--size", action="append", choices=sorted(SIZES.keys()),
+        help="Only run these sizes.  Defaults to all of them."
+    )
+    parser.add_argument(
+        "--format", action="append", choices=sorted(WRITERS.keys()),
+        help="Only time these formats.  Defaults to all of them."
+    )
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name in args.size or sorted(SIZES.keys()):
+            config = get_config(**SIZES[name])
+            for fmt in args.format or sorted(WRITERS.keys()):
+                extension, dump = WRITERS[fmt]
+                if dump is None:
+                    continue
+                try:
+                    contents = dump(config)
+                except ImportError:
+                    continue
+                path = os.path.join(tempdir, name + extension)
+                with open(path, "wb") as filehandle:
+                    filehandle.write(contents)
+                results["%s/%s" % (name, fmt)] = {
+                    "seconds": time_call(lambda p=path: parse_config_file(p),
+                                         number=3),
+                    "file_bytes": len(contents),
+                }
+    finally:
+        shutil.rmtree(tempdir)
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
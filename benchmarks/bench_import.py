@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the time to import scriptharness.
+
+Run a cold python process per module and time it, keeping the best run.
+Where python supports -X importtime, the module's own cumulative import
+time is recorded too, which is steadier than the process wall time.
+
+Run with --compare against saved results to catch a new eager import of
+a heavy dependency.
+
+Attributes:
+  MODULES (tuple): the modules to time
+  BASELINE (str): the name of the bare interpreter startup result
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import subprocess
+import sys
+import timeit
+
+from benchmarks import get_parser, report
+
+MODULES = ("scriptharness", "scriptharness.config", "scriptharness.script")
+BASELINE = "startup/python"
+
+
+def time_import(module=None, repeat=5):
+    """Time a python process that imports module, keeping the best run.
+
+    Args:
+      module (str, optional): the module to import.  If None, time the bare
+        interpreter startup.
+      repeat (int, optional): the number of runs
+
+    Returns:
+      (wall_seconds, import_seconds) tuple.  import_seconds is None if
+        module is None, or -X importtime isn't supported.
+    """
+    best_wall = best_import = None
+    command = [sys.executable, "-X", "importtime", "-c",
+               "import %s" % module if module else "pass"]
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        process = subprocess.Popen(command, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        elapsed = timeit.default_timer() - start
+        if best_wall is None or elapsed < best_wall:
+            best_wall = elapsed
+        cumulative = 0
+        for line in stderr.decode('utf-8', 'replace').splitlines():
+            # import time: self [us] | cumulative | imported package
+            # Nested imports are indented; add up the top level scriptharness
+            # imports, since importing a submodule imports the package first.
+            parts = line.split("|")
+            if len(parts) != 3 or parts[2].startswith("  "):
+                continue
+            name = parts[2].strip()
+            if name == "scriptharness" or name.startswith("scriptharness."):
+                cumulative += int(parts[1]) / 1000000
+        if module and cumulative and (best_import is None or
+                                      cumulative < best_import):
+            best_import = cumulative
+    return best_wall, best_import
+
+
+def main():
+    """Time each of MODULES, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    args = parser.parse_args()
+    results = {}
+    results[BASELINE] = {"seconds": time_import()[0]}
+    for module in MODULES:
+        wall, cumulative = time_import(module)
+        results["startup/%s" % module] = {"seconds": wall}
+        if cumulative is not None:
+            results["importtime/%s" % module] = {"seconds": cumulative}
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
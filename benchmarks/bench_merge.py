@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark DeepMerge on big base configs with small overlays.
+
+DeepMerge only walks the overlay's keys, so its time should stay flat as
+the base grows.  For comparison, time the shallow dict.update() that
+build_config() does by default, and a naive deep merge that deepcopies the
+base first.
+
+Attributes:
+  SIZES (dict): name: get_config() kwargs for each synthetic base config
+  LIST_POLICIES (tuple): the DeepMerge list_policy values to time
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+from copy import deepcopy
+import sys
+
+from benchmarks import get_parser, report, time_call
+from benchmarks.bench_structures import get_config
+from scriptharness.structures import DeepMerge, LayeredConfig
+
+SIZES = {
+    "small": {"breadth": 10, "depth": 2, "list_size": 5},
+    "medium": {"breadth": 20, "depth": 3, "list_size": 10},
+    "large": {"breadth": 40, "depth": 3, "list_size": 20},
+}
+LIST_POLICIES = ("replace", "append", "merge")
+
+
+def get_overlay():
+    """Create a small overlay that changes a few nested values.
+
+    Returns:
+      overlay (dict)
+    """
+    return {
+        "key0": {"key1": {"url": "https://example.org/", "list": [99]}},
+        "key1": {"key0": {"list": [98, 97]}},
+        "new_key": {"enabled": True},
+    }
+
+
+def naive_merge(base, overlay):
+    """Deep merge by copying the whole base, then updating it in place.
+
+    Args:
+      base (dict): the base config
+      overlay (dict): the overlay config
+
+    Returns:
+      merged (dict)
+    """
+    def merge_into(target, source):
+        """Recursively update target from source."""
+        for key, value in source.items():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                merge_into(target[key], value)
+            else:
+                target[key] = value
+    merged = deepcopy(base)
+    merge_into(merged, overlay)
+    return merged
+
+
+def main():
+    """Time each merge per base size, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--size", action="append", choices=sorted(SIZES.keys()),
+        help="Only run these sizes.  Defaults to all of them."
+    )
+    args = parser.parse_args()
+    results = {}
+    overlay = get_overlay()
+    for name in args.size or sorted(SIZES.keys()):
+        base = get_config(**SIZES[name])
+
+        def shallow(base=base):
+            """dict.update(), like build_config() without merge."""
+            merged = dict(base)
+            merged.update(overlay)
+            return merged
+
+        results["%s/dict.update" % name] = {"seconds": time_call(shallow)}
+        results["%s/naive_deepcopy" % name] = {
+            "seconds": time_call(lambda b=base: naive_merge(b, overlay),
+                                 number=1)
+        }
+        for policy in LIST_POLICIES:
+            merge = DeepMerge(list_policy=policy)
+            results["%s/DeepMerge/%s" % (name, policy)] = {
+                "seconds": time_call(lambda b=base, m=merge: m(b, overlay))
+            }
+        layered = LayeredConfig([("base", base), ("overlay", overlay)],
+                                merge=DeepMerge())
+        results["%s/LayeredConfig/resolve" % name] = {
+            "seconds": time_call(lambda l=layered: dict(l.iter_resolved()))
+        }
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark scriptharness.structures.
+
+Build synthetic configs of varying breadth, depth and size, and measure
+construction, lookups, mutations by type, deepcopy, lock and json dump for
+plain dicts, LoggingDict, ReadOnlyDict and FrozenConfig.  Construction,
+deepcopy and json dump also record the tracemalloc peak.
+
+Attributes:
+  SHAPES (dict): name: get_config() kwargs for each synthetic config
+  MUTATIONS (tuple): (name, function) pairs of the mutations to time
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+from copy import deepcopy
+import json
+import sys
+
+from benchmarks import get_parser, peak_memory, report, time_call
+from scriptharness.structures import FrozenConfig, LoggingDict, \
+    ReadOnlyDict, make_immutable
+
+SHAPES = {
+    "wide": {"breadth": 1000, "depth": 1, "list_size": 2},
+    "deep": {"breadth": 2, "depth": 10, "list_size": 2},
+    "large": {"breadth": 20, "depth": 3, "list_size": 20},
+}
+MUTATIONS = (
+    ("dict_setitem", lambda obj: [
+        obj.__setitem__("new%d" % num, num) for num in range(100)
+    ]),
+    ("dict_update", lambda obj: obj.update(
+        dict(("new%d" % num, num) for num in range(100))
+    )),
+    ("dict_delitem", lambda obj: [
+        obj.__delitem__(key) for key in list(obj.keys())[:100]
+    ]),
+    ("list_append", lambda obj: [
+        obj["list"].append(num) for num in range(100)
+    ]),
+    ("list_extend", lambda obj: obj["list"].extend(list(range(100)))),
+    ("list_extend_many", lambda obj: obj["list"].extend_many(range(100))),
+    ("list_pop", lambda obj: [obj["list"].pop() for _ in range(10)]),
+    ("list_sort", lambda obj: obj["list"].sort()),
+)
+
+
+def get_config(breadth, depth, list_size):
+    """Create a synthetic config.
+
+    Args:
+      breadth (int): the number of keys per dict
+      depth (int): the number of levels of nested dicts
+      list_size (int): the number of items in each leaf's list
+
+    Returns:
+      config (dict)
+    """
+    config = {}
+    for num in range(breadth):
+        key = "key%d" % num
+        if depth > 1:
+            config[key] = get_config(breadth, depth - 1, list_size)
+        else:
+            config[key] = {
+                "url": "https://example.com/%s/%d" % (key, num),
+                "list": list(range(list_size)),
+            }
+    return config
+
+
+def get_logging_dict(config):
+    """Create a LoggingDict with a top-level list for the mutation tests.
+
+    Args:
+      config (dict): the synthetic config; this is deepcopied first.
+
+    Returns:
+      LoggingDict
+    """
+    contents = deepcopy(config)
+    contents["list"] = list(range(1000))
+    logdict = LoggingDict(contents)
+    logdict.recursively_set_parent(name="config")
+    return logdict
+
+
+def get_locked_rod(config):
+    """Create a locked ReadOnlyDict from a copy of config.
+    """
+    rod = ReadOnlyDict(deepcopy(config))
+    rod.lock()
+    return rod
+
+
+def read_all(mapping):
+    """Look up every top-level key by [] and get().
+    """
+    for key in mapping:
+        mapping[key]
+        mapping.get(key)
+
+
+def bench_shape(name, config, results):
+    """Run all of the benchmarks for a single synthetic config.
+
+    Args:
+      name (str): the shape name, for result names
+      config (dict): the synthetic config
+      results (dict): the results dict to add to
+    """
+    def add(bench, func, setup=None, number=3, memory=False):
+        """Time func, and optionally record its peak memory."""
+        result = {"seconds": time_call(func, number=number, setup=setup)}
+        if memory:
+            if setup is None:
+                result["peak_bytes"] = peak_memory(func)
+            else:
+                args = setup()
+                result["peak_bytes"] = peak_memory(lambda: func(args))
+        results["%s/%s" % (name, bench)] = result
+
+    candidates = (
+        ("dict", deepcopy(config)),
+        ("LoggingDict", get_logging_dict(config)),
+        ("ReadOnlyDict", get_locked_rod(config)),
+        ("FrozenConfig", FrozenConfig(config)),
+    )
+    # construction
+    copy_config = lambda: deepcopy(config)
+    add("construct/LoggingDict", LoggingDict, setup=copy_config, memory=True)
+    add("construct/ReadOnlyDict", lambda obj: ReadOnlyDict(obj).lock(),
+        setup=copy_config, memory=True)
+    add("construct/FrozenConfig", FrozenConfig, setup=copy_config,
+        memory=True)
+    add("construct/make_immutable", make_immutable, setup=copy_config,
+        memory=True)
+    # lookups, deepcopy, json dump
+    for variant, mapping in candidates:
+        add("lookup/%s" % variant, lambda m=mapping: read_all(m), number=100)
+        add("deepcopy/%s" % variant, lambda m=mapping: deepcopy(m),
+            memory=True)
+        add("json_dump/%s" % variant, lambda m=mapping: json.dumps(m),
+            memory=True)
+    # lock
+    add("lock/ReadOnlyDict", lambda rod: rod.lock(),
+        setup=lambda: ReadOnlyDict(deepcopy(config)))
+    # mutations
+    for mutation, func in MUTATIONS:
+        add("mutate/%s" % mutation, func,
+            setup=lambda: get_logging_dict(config), number=1)
+
+
+def main():
+    """Run the benchmarks for each shape, and report.
+    """
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--shape", action="append", choices=sorted(SHAPES.keys()),
+        help="Only run these shapes.  Defaults to all of them."
+    )
+    args = parser.parse_args()
+    results = {}
+    for name in args.shape or sorted(SHAPES.keys()):
+        bench_shape(name, get_config(**SHAPES[name]), results)
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
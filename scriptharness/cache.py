@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""On-disk caches, so unchanged resources aren't fetched again every run.
+
+Attributes:
+  LOGGER_NAME (str): logging.getLogger name
+  DEFAULT_MAX_BYTES (int): the default ArtifactCache size budget
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+from contextlib import contextmanager
+import gc
+import hashlib
+import json
+import logging
+import marshal
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from scriptharness.config import DEFAULT_CHUNK_SIZE, SESSION_POOL, \
+    remove_files, replace_file
+from scriptharness.exceptions import ScriptHarnessException
+
+LOGGER_NAME = "scriptharness.cache"
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+# Helper functions {{{1
+def get_url_key(url):
+    """Get a filesystem-safe cache key for a url.
+
+    Args:
+      url (str): the url
+
+    Returns:
+      key (str): the sha256 hex digest of the url
+    """
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def write_atomically(path, contents):
+    """Write contents to a temp file next to path, then rename it to path.
+
+    Concurrent writers each get their own temp file, so readers see either
+    the old file or a complete new one.
+
+    Args:
+      path (str): the path to write
+      contents (bytes or function): the bytes to write, or a function that
+        takes the open filehandle and writes to it
+    """
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as filehandle:
+            if callable(contents):
+                contents(filehandle)
+            else:
+                filehandle.write(contents)
+        replace_file(tmp_path, path)
+    finally:
+        # a no-op after a successful rename
+        remove_files(tmp_path)
+
+
+def get_file_sha256(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Get the sha256 hex digest of a file.
+
+    Args:
+      path (str): the file to hash
+      chunk_size (int, optional): the number of bytes to read at a time
+
+    Returns:
+      digest (str)
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as filehandle:
+        for chunk in iter(lambda: filehandle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_with_sha256(filehandle, dest, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Copy an open file to dest, hashing it on the way.
+
+    Args:
+      filehandle (file): the file to copy, opened in binary mode
+      dest (str): the path to copy to
+      chunk_size (int, optional): the number of bytes to read at a time
+
+    Returns:
+      digest (str): the sha256 hex digest of the copy
+    """
+    digest = hashlib.sha256()
+    with open(dest, 'wb') as dest_handle:
+        for chunk in iter(lambda: filehandle.read(chunk_size), b''):
+            digest.update(chunk)
+            dest_handle.write(chunk)
+    return digest.hexdigest()
+
+
+def store_read_only(src, dest):
+    """Copy src to dest atomically, and make dest read-only.
+
+    Args:
+      src (str): the existing file
+      dest (str): the path to copy to
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        replace_file(tmp_path, dest)
+    finally:
+        remove_files(tmp_path)
+
+
+def remove_read_only(path):
+    """Remove a file that store_read_only() wrote.
+
+    Windows won't remove a read-only file, so make it writable first.
+
+    Args:
+      path (str): the file to remove
+    """
+    os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+    os.remove(path)
+
+
+# HttpCache {{{1
+class HttpCache(object):
+    """On-disk cache of http GET responses, keyed by url.
+
+    Each url is stored as a body file and a json metadata file with its
+    ETag and Last-Modified headers.  fetch() sends those back as
+    If-None-Match and If-Modified-Since, so an unchanged resource costs a
+    304 rather than a full download.
+
+    Attributes:
+      path (str): the cache directory
+      max_age (float): if the cached copy was fetched or revalidated less
+        than max_age seconds ago, use it without making a request at all.
+        0 always revalidates.
+      offline_fallback (bool): if the server can't be reached, serve the
+        (possibly stale) cached copy instead of raising.
+    """
+    def __init__(self, path, max_age=0, offline_fallback=True):
+        self.path = path
+        self.max_age = max_age
+        self.offline_fallback = offline_fallback
+
+    def get_paths(self, url):
+        """Get the body and metadata paths for url.
+
+        Args:
+          url (str): the url
+
+        Returns:
+          (body_path, meta_path) tuple
+        """
+        key = get_url_key(url)
+        return (os.path.join(self.path, key + '.body'),
+                os.path.join(self.path, key + '.json'))
+
+    def get_metadata(self, url):
+        """Get the cached metadata for url, if there's a cached copy.
+
+        Args:
+          url (str): the url
+
+        Returns:
+          metadata (dict): with url, etag, last_modified and fetched keys,
+            or None if url isn't cached.
+        """
+        body_path, meta_path = self.get_paths(url)
+        if not os.path.isfile(body_path):
+            return None
+        try:
+            with open(meta_path) as filehandle:
+                metadata = json.load(filehandle)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(metadata, dict) or metadata.get('url') != url:
+            return None
+        return metadata
+
+    def write_metadata(self, url, etag=None, last_modified=None):
+        """Write the metadata for url, with the current time as fetched.
+
+        Args:
+          url (str): the url
+          etag (str, optional): the ETag response header
+          last_modified (str, optional): the Last-Modified response header
+        """
+        metadata = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': time.time(),
+        }
+        write_atomically(self.get_paths(url)[1],
+                         json.dumps(metadata).encode('utf-8'))
+
+    def fetch(self, url, timeout=None, session=None,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+        """Get the path to an up-to-date cached copy of url.
+
+        Args:
+          url (str): the url to fetch
+          timeout (float, optional): how long to wait before timing out
+          session (requests.Session, optional): the session to fetch with.
+            Defaults to the SESSION_POOL session.
+          chunk_size (int, optional): the number of bytes to read and write
+            at a time.
+
+        Returns:
+          body_path (str): the path to the cached body
+
+        Raises:
+          ScriptHarnessException: on error, unless offline_fallback applies
+        """
+        import requests
+        logger = logging.getLogger(LOGGER_NAME)
+        body_path = self.get_paths(url)[0]
+        metadata = self.get_metadata(url)
+        if metadata is not None and self.max_age and \
+                time.time() - metadata['fetched'] < self.max_age:
+            return body_path
+        headers = {}
+        if metadata is not None:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+        if timeout is None:
+            timeout = 10
+        try:
+            if session is None:
+                session = SESSION_POOL.get_session()
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            response = session.get(url, timeout=timeout, stream=True,
+                                   headers=headers)
+            if response.status_code == 304 and metadata is not None:
+                response.close()
+                self.write_metadata(url, metadata.get('etag'),
+                                    metadata.get('last_modified'))
+                return body_path
+            response.raise_for_status()
+
+            def write_body(filehandle):
+                """Stream the response body to filehandle."""
+                for chunk in response.iter_content(  # pragma: no branch
+                        chunk_size=chunk_size):
+                    filehandle.write(chunk)
+
+            write_atomically(body_path, write_body)
+            self.write_metadata(url, response.headers.get('ETag'),
+                                response.headers.get('Last-Modified'))
+            return body_path
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as exc_info:
+            if metadata is None or not self.offline_fallback:
+                raise ScriptHarnessException(
+                    "Error downloading from url %s" % url, exc_info
+                )
+            logger.warning(
+                "Can't reach %s (%s); using the cached copy from %s",
+                url, exc_info, time.ctime(metadata['fetched'])
+            )
+            return body_path
+        except requests.exceptions.RequestException as exc_info:
+            raise ScriptHarnessException(
+                "Error downloading from url %s" % url, exc_info
+            )
+        except (IOError, OSError) as exc_info:
+            raise ScriptHarnessException(
+                "Error writing to the cache %s" % self.path, exc_info
+            )
+
+
+# ArtifactCache {{{1
+class ArtifactCache(object):
+    """Content-addressed cache of downloaded files.
+
+    Files are stored once per sha256 under objects/, with a urls/ index
+    from url to sha256, so an artifact can be found by url or by its
+    expected checksum.  add() stores a read-only copy, and get() writes a
+    new copy to the destination, so the caller's files never share the
+    cache's; changes to them can't reach the cache or other scripts.  Cache
+    hits are checked against their sha256 as they're copied; a corrupt
+    object is evicted, and get() misses so it's downloaded again.
+
+    Once the objects exceed max_bytes, the least recently used ones are
+    evicted.  The cache is shared safely between concurrent scripts with an
+    exclusive flock() on a lock file; on platforms without fcntl, only
+    threads within one process are serialized.
+
+    Attributes:
+      path (str): the cache directory
+      max_bytes (int): the size budget for cached objects
+      hits (int): the number of get() calls served from the cache
+      misses (int): the number of get() calls that weren't
+      bytes_saved (int): the total size of the files served from the cache
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.thread_lock = threading.Lock()
+        for dirname in (self.objects_dir, self.urls_dir):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+    @property
+    def objects_dir(self):
+        """The directory of content-addressed files."""
+        return os.path.join(self.path, 'objects')
+
+    @property
+    def urls_dir(self):
+        """The directory of url to sha256 index files."""
+        return os.path.join(self.path, 'urls')
+
+    @contextmanager
+    def lock(self):
+        """Hold the cache lock, across threads and processes.
+        """
+        with self.thread_lock:
+            with open(os.path.join(self.path, 'lock'), 'a') as filehandle:
+                if fcntl is not None:
+                    fcntl.flock(filehandle, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(filehandle, fcntl.LOCK_UN)
+
+    def lookup(self, url=None, checksum=None):
+        """Find the cached object for checksum or url.
+
+        Call this with the lock held.
+
+        Args:
+          url (str, optional): the url the file was downloaded from
+          checksum (str, optional): the sha256 of the file.  If specified,
+            only a file with this checksum will be returned.
+
+        Returns:
+          object_path (str): or None if there's no match
+        """
+        if checksum is None and url is not None:
+            try:
+                with open(os.path.join(self.urls_dir,
+                                       get_url_key(url))) as filehandle:
+                    checksum = filehandle.read().strip()
+            except (IOError, OSError):
+                return None
+        if not checksum:
+            return None
+        object_path = os.path.join(self.objects_dir, checksum.lower())
+        if os.path.isfile(object_path):
+            return object_path
+        return None
+
+    def get(self, url, path, checksum=None):
+        """Copy the cached copy of url (or checksum) to path, if there is one.
+
+        The object is opened with the lock held, then copied and hashed
+        without it, so a big artifact doesn't block other scripts.  An open
+        file survives eviction on posix; on windows, evict() can't remove
+        it until the copy is done.
+
+        Args:
+          url (str): the url
+          path (str): the destination path
+          checksum (str, optional): the expected sha256 of the file
+
+        Returns:
+          found (bool): True on a cache hit
+        """
+        logger = logging.getLogger(LOGGER_NAME)
+        filehandle = None
+        with self.lock():
+            object_path = self.lookup(url=url, checksum=checksum)
+            if object_path is not None:
+                try:
+                    filehandle = open(object_path, 'rb')
+                    # the mtime is the LRU timestamp
+                    os.utime(object_path, None)
+                except (IOError, OSError) as exc_info:
+                    if filehandle is not None:
+                        filehandle.close()
+                        filehandle = None
+                    logger.warning("Can't use the cached copy of %s: %s",
+                                   url, exc_info)
+        if filehandle is None:
+            self.record_get(False)
+            return False
+        tmp_path = path + '.part'
+        try:
+            try:
+                with filehandle:
+                    digest = copy_with_sha256(filehandle, tmp_path)
+                if digest != os.path.basename(object_path):
+                    logger.warning("Evicting the corrupt cached copy of %s.",
+                                   url)
+                    with self.lock():
+                        if os.path.isfile(object_path):
+                            remove_read_only(object_path)
+                    self.record_get(False)
+                    return False
+                replace_file(tmp_path, path)
+            finally:
+                remove_files(tmp_path)
+        except (IOError, OSError) as exc_info:
+            logger.warning("Can't use the cached copy of %s: %s",
+                           url, exc_info)
+            self.record_get(False)
+            return False
+        self.record_get(True, os.path.getsize(path))
+        return True
+
+    def record_get(self, hit, size=0):
+        """Update the hit, miss and bytes_saved counts for a get().
+
+        Args:
+          hit (bool): whether get() was served from the cache
+          size (int, optional): the size of the file served
+        """
+        with self.thread_lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+
+    def add(self, url, path, checksum=None):
+        """Add a downloaded file to the cache, then evict if needed.
+
+        Failing to cache isn't fatal to the download, so errors are logged
+        rather than raised.
+
+        Args:
+          url (str): the url path was downloaded from
+          path (str): the downloaded file
+          checksum (str, optional): the already-verified sha256 of path.
+            Computed if not specified.
+        """
+        logger = logging.getLogger(LOGGER_NAME)
+        try:
+            if checksum is None:
+                checksum = get_file_sha256(path)
+            checksum = checksum.lower()
+            with self.lock():
+                object_path = os.path.join(self.objects_dir, checksum)
+                if not os.path.isfile(object_path):
+                    store_read_only(path, object_path)
+                write_atomically(os.path.join(self.urls_dir,
+                                              get_url_key(url)),
+                                 checksum.encode('utf-8'))
+                self.evict()
+        except (IOError, OSError) as exc_info:
+            logger.warning("Can't add %s to the artifact cache: %s",
+                           path, exc_info)
+
+    def evict(self):
+        """Remove the least recently used objects until under max_bytes.
+
+        Call this with the lock held.  Url index entries pointing at evicted
+        objects are left behind; lookup() treats them as misses.
+
+        Returns:
+          evicted (list): the removed object paths
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.objects_dir):
+            object_path = os.path.join(self.objects_dir, name)
+            file_stat = os.stat(object_path)
+            entries.append((file_stat.st_mtime, file_stat.st_size,
+                            object_path))
+            total += file_stat.st_size
+        evicted = []
+        for _, size, object_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            remove_read_only(object_path)
+            total -= size
+            evicted.append(object_path)
+        return evicted
+
+
+# ParseCache {{{1
+class ParseCache(object):
+    """Persistent cache of parsed config files.
+
+    The parsed config is stored with marshal, which loads much faster than
+    json parses, keyed by the file's absolute path and the python version
+    (marshal's format isn't stable across versions).  Each entry records
+    the file's mtime, size and sha256, so entries invalidate themselves
+    when the file changes.
+
+    Attributes:
+      path (str): the cache directory
+      verify_hash (bool): when the mtime and size match, still read and hash
+        the file before trusting the entry.  Disable this to skip reading
+        the file at all on a hit, at the risk of missing a same-size change
+        within the filesystem's mtime granularity.
+      hits (int): the number of parses served from the cache
+      misses (int): the number of parses that weren't
+    """
+    def __init__(self, path, verify_hash=True):
+        self.path = path
+        self.verify_hash = verify_hash
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def get_entry_path(self, path):
+        """Get the cache entry path for a config file path.
+
+        Args:
+          path (str): the config file path
+
+        Returns:
+          entry_path (str)
+        """
+        key = "%s:%d.%d:%d" % ((os.path.abspath(path), ) +
+                               tuple(sys.version_info[:2]) +
+                               (marshal.version, ))
+        return os.path.join(self.path, get_url_key(key) + '.marshal')
+
+    @staticmethod
+    def read_entry(entry_path):
+        """Read a cache entry.
+
+        Returns:
+          entry (dict): with mtime, size, sha256 and config keys, or None
+        """
+        try:
+            with open(entry_path, 'rb') as filehandle:
+                contents = filehandle.read()
+        except (IOError, OSError):
+            return None
+        # marshal.loads() is much faster than marshal.load() on a file.  The
+        # parsed config can't contain reference cycles, so don't let the
+        # cyclic gc repeatedly scan the objects as they're created.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            entry = marshal.loads(contents)
+        except (EOFError, ValueError, TypeError):
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if not isinstance(entry, dict) or 'config' not in entry:
+            return None
+        return entry
+
+    def parse(self, path, parse_func):
+        """Parse path with parse_func, or load the cached result.
+
+        Args:
+          path (str): the config file path
+          parse_func (function): takes the file contents as bytes, and
+            returns the parsed config.  Its exceptions aren't caught.
+
+        Returns:
+          config: the parse_func() return value, or an equal cached copy
+
+        Raises:
+          IOError or OSError: if path can't be read
+        """
+        logger = logging.getLogger(LOGGER_NAME)
+        file_stat = os.stat(path)
+        entry_path = self.get_entry_path(path)
+        entry = self.read_entry(entry_path)
+        if entry is not None and entry['size'] != file_stat.st_size:
+            entry = None
+        if entry is not None and not self.verify_hash and \
+                entry['mtime'] == file_stat.st_mtime:
+            self.hits += 1
+            return entry['config']
+        with open(path, 'rb') as filehandle:
+            contents = filehandle.read()
+        sha256 = hashlib.sha256(contents).hexdigest()
+        if entry is not None and entry['sha256'] == sha256:
+            self.hits += 1
+            return entry['config']
+        self.misses += 1
+        config = parse_func(contents)
+        entry = {
+            'mtime': file_stat.st_mtime,
+            'size': file_stat.st_size,
+            'sha256': sha256,
+            'config': config,
+        }
+        try:
+            write_atomically(entry_path, marshal.dumps(entry))
+        except (IOError, OSError, ValueError) as exc_info:
+            # ValueError: marshal can't serialize the parsed objects
+            logger.warning("Can't cache the parsed %s: %s", path, exc_info)
+        return config
@@ -4,66 +4,1015 @@
 
 Attributes:
   LOGGER_NAME (str): logging.getLogger name
+  DEFAULT_MAX_WORKERS (int): the default number of threads to fetch and
+    parse config files with
+  DEFAULT_CHUNK_SIZE (int): the number of bytes download_url() reads and
+    writes at a time
+  DEFAULT_RESUME_RETRIES (int): the default number of times download_url()
+    resumes an interrupted download
+  DEFAULT_SEGMENTS (int): the default number of concurrent byte ranges for
+    download_url_parallel()
+  DEFAULT_ENV_PREFIX (str): the usual env_prefix for build_config(), e.g.
+    SCRIPTHARNESS__platforms__linux__jobs=8
+  DEFAULT_MMAP_THRESHOLD (int): local config files at least this big are
+    memory-mapped rather than read into a bytes copy
+  SESSION_POOL (SessionPool): the shared http session pool for download_url()
+  COMPRESSIONS (dict): compression name: Compression, for
+    register_compression()
+  COMPRESSION_EXTENSIONS (dict): file extension: compression name
 """
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
-import argparse
+from collections import namedtuple
+from contextlib import contextmanager
+import codecs
+import hashlib
 import logging
 import os
-import requests
 import six
-import six.moves.urllib as urllib
 import sys
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import threading
 
 from scriptharness.exceptions import ScriptHarnessException
 from scriptharness.actions import Action
-from scriptharness.structures import iterate_pairs
+from scriptharness.structures import DeepMerge, iterate_pairs, \
+    LayeredConfig
 
 
 LOGGER_NAME = "scriptharness.config"
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_RESUME_RETRIES = 5
+DEFAULT_SEGMENTS = 4
+DEFAULT_ENV_PREFIX = "SCRIPTHARNESS"
+DEFAULT_MMAP_THRESHOLD = 1024 * 1024
+CONFIG_BUNDLE_VERSION = 2
+
+
+# Lazy imports {{{1
+# requests, multiprocessing.pool, argparse and friends are imported in the
+# functions that use them, so `import scriptharness` stays fast for scripts
+# that never touch a url.
+def get_json_module():
+    """Import json on first use, preferring simplejson if it's installed.
+
+    Returns:
+      module: simplejson or json
+    """
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+    return json
+
+
+# SessionPool {{{1
+class SessionPool(object):
+    """Share a pooled requests.Session between downloads.
+
+    Creating a new requests.Session for every download means every config
+    or artifact fetch pays for a new TCP (and TLS) connection.  A shared
+    session keeps connections alive and reuses them for the same hosts.
+
+    The session is created lazily on first use; configure() changes the
+    settings for the next session.
+
+    Attributes:
+      pool_size (int): the number of connections to keep per host, and the
+        number of hosts to keep pools for
+      retries (int): the number of times to retry failed connections
+      backoff_factor (float): sleep backoff_factor * (2 ** retry_number)
+        seconds between retries
+      keep_alive (bool): keep connections open for reuse
+      session (requests.Session): the shared session, once created
+    """
+    def __init__(self, **kwargs):
+        self.lock = threading.Lock()
+        self.session = None
+        self.pool_size = 10
+        self.retries = 5
+        self.backoff_factor = 0
+        self.keep_alive = True
+        self.configure(**kwargs)
+
+    def configure(self, pool_size=None, retries=None, backoff_factor=None,
+                  keep_alive=None):
+        """Change the session settings.
+
+        Any existing session is closed; the next get_session() will create a
+        new one with the new settings.
+
+        Args:
+          pool_size (int, optional): see the class attributes
+          retries (int, optional): see the class attributes
+          backoff_factor (float, optional): see the class attributes
+          keep_alive (bool, optional): see the class attributes
+        """
+        with self.lock:
+            for name, value in (('pool_size', pool_size),
+                                ('retries', retries),
+                                ('backoff_factor', backoff_factor),
+                                ('keep_alive', keep_alive)):
+                if value is not None:
+                    setattr(self, name, value)
+            self._close()
+
+    def get_session(self):
+        """Get the shared session, creating it if needed.
+
+        Returns:
+          requests.Session
+        """
+        import requests
+        from requests.packages.urllib3.util.retry import Retry
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=Retry(total=self.retries, read=False,
+                                      backoff_factor=self.backoff_factor),
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.session = session
+            return self.session
+
+    def _close(self):
+        """Close the session without taking the lock.
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def close(self):
+        """Close the shared session and its connections.
+        """
+        with self.lock:
+            self._close()
+
+SESSION_POOL = SessionPool()
+
+
+# ConfigInterner {{{1
+class ConfigInterner(object):
+    """Dedupe keys and immutable values across loaded configs.
+
+    Generated configs tend to repeat the same keys and long values (urls,
+    platform names) thousands of times, and every config file we load
+    creates its own copies.  Pass a ConfigInterner as the json
+    object_pairs_hook and every equal key or scalar value will be replaced
+    by a single shared instance.
+
+    Attributes:
+      table (dict): (type, value): value shared instances.  Floats are
+        keyed by float.hex(), so -0.0 and 0.0 stay distinct.
+      hits (int): the number of duplicates replaced
+      bytes_saved (int): the approximate memory saved by the replacements
+    """
+    interned_types = (six.text_type, six.binary_type, float) + \
+        six.integer_types
+
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+        self.bytes_saved = 0
+
+    def intern(self, value):
+        """Return the shared instance of value, if it's an interned type.
+
+        Args:
+          value (any): the key or value to intern
+
+        Returns:
+          the shared instance equal to value, or value
+        """
+        if isinstance(value, list):
+            value[:] = [self.intern(item) for item in value]
+            return value
+        # bools are ints; they're also singletons already.
+        if not isinstance(value, self.interned_types) or \
+                isinstance(value, bool):
+            return value
+        if isinstance(value, float):
+            # -0.0 == 0.0, but they're different values.
+            key = (float, value.hex())
+        else:
+            key = (type(value), value)
+        shared = self.table.setdefault(key, value)
+        if shared is not value:
+            self.hits += 1
+            self.bytes_saved += sys.getsizeof(value)
+        return shared
+
+    def __call__(self, pairs):
+        """json object_pairs_hook.
+
+        Args:
+          pairs (list): the (key, value) pairs of a json object
+
+        Returns:
+          dict
+        """
+        return dict(
+            (self.intern(key), self.intern(value)) for key, value in pairs
+        )
+
+
+# Config loaders {{{1
+ConfigLoader = namedtuple("ConfigLoader", ("name", "load", "sniff"))
+CONFIG_LOADERS = {}
+CONFIG_EXTENSIONS = {}
+
+
+def register_config_loader(name, load, extensions=(), sniff=None):
+    """Add a config file format, or replace one, for parse_config_file().
+
+    Args:
+      name (str): the format name, e.g. "yaml"
+      load (callable): load(contents, object_pairs_hook=None) takes the file
+        contents as bytes, and returns the config.  Big local files are
+        passed as a read-only mmap instead, which supports the buffer
+        protocol and slicing but not the bytes methods.  If the format
+        can't build objects through object_pairs_hook, use rebuild_tree().
+        It should raise ValueError if the contents can't be parsed.
+      extensions (iterable, optional): the file extensions, e.g. (".yml",
+        ".yaml"), that use this loader
+      sniff (callable, optional): sniff(contents) returns True if the
+        contents (bytes or mmap, as for load) look like this format, for
+        files with unknown extensions.
+    """
+    CONFIG_LOADERS[name] = ConfigLoader(name, load, sniff)
+    for extension in extensions:
+        CONFIG_EXTENSIONS[extension.lower()] = name
+
+
+def get_config_loader(resource, contents=None):
+    """Find the ConfigLoader for a config file.
+
+    The extension of the path (or url path) picks the loader, ignoring a
+    compression extension like .gz.  Otherwise, each loader's sniff() is
+    tried against the contents, and json is the default.
+
+    Args:
+      resource (str): the config file path or url
+      contents (bytes, optional): the file contents, for sniffing
+
+    Returns:
+      ConfigLoader
+    """
+    name = resource
+    if is_url(resource):
+        name = get_filename_from_url(resource)
+    name = strip_compression_extension(name)
+    extension = os.path.splitext(name)[1].lower()
+    if extension in CONFIG_EXTENSIONS:
+        return CONFIG_LOADERS[CONFIG_EXTENSIONS[extension]]
+    if contents is not None:
+        for loader in CONFIG_LOADERS.values():
+            if loader.sniff is not None and loader.name != "json" and \
+                    loader.sniff(contents):
+                return loader
+    return CONFIG_LOADERS["json"]
+
+
+def import_loader_module(name, *modules):
+    """Import the first importable of modules, for an optional format.
+
+    Args:
+      name (str): the format name, for the error
+      *modules (str): the module names to try, in order
+
+    Returns:
+      module
+
+    Raises:
+      ScriptHarnessException: if none of them are installed
+    """
+    import importlib
+    for module in modules:
+        try:
+            return importlib.import_module(module)
+        except ImportError:
+            continue
+    raise ScriptHarnessException(
+        "Can't load %s configs without one of these modules installed!" %
+        name, modules
+    )
+
+
+def load_json(contents, object_pairs_hook=None):
+    """Load json config contents.
+
+    codecs.decode() reads an mmap in place, without a bytes copy first.
+    """
+    json = get_json_module()
+    return json.loads(codecs.decode(contents, 'utf-8'),
+                      object_pairs_hook=object_pairs_hook)
+
+
+def load_marshal(contents, object_pairs_hook=None):
+    """Load marshal config contents.
+
+    marshal is the fastest format to load, but it's specific to the python
+    version, and loading a malicious file can crash python; only use it for
+    trusted, generated configs.
+    """
+    import marshal
+    try:
+        config = marshal.loads(contents)
+    except (EOFError, TypeError) as exc_info:
+        raise ValueError(exc_info)
+    if object_pairs_hook is not None:
+        config = rebuild_tree(config, object_pairs_hook)
+    return config
+
+
+def load_msgpack(contents, object_pairs_hook=None):
+    """Load msgpack config contents.  This needs msgpack installed.
+    """
+    msgpack = import_loader_module("msgpack", "msgpack")
+    kwargs = {"raw": False}
+    if object_pairs_hook is not None:
+        kwargs["object_pairs_hook"] = object_pairs_hook
+    try:
+        return msgpack.unpackb(contents, **kwargs)
+    except msgpack.UnpackException as exc_info:
+        raise ValueError(exc_info)
+
+
+def sniff_msgpack(contents):
+    """Does it start with a msgpack map?  json can't start with these bytes.
+    """
+    return bool(contents) and (0x80 <= six.indexbytes(contents, 0) <= 0x8f or
+                               six.indexbytes(contents, 0) in (0xde, 0xdf))
+
+
+def load_yaml(contents, object_pairs_hook=None):
+    """Load yaml config contents.  This needs PyYAML installed.
+    """
+    yaml = import_loader_module("yaml", "yaml")
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    try:
+        config = yaml.load(contents, Loader=loader)
+    except yaml.YAMLError as exc_info:
+        raise ValueError(exc_info)
+    if object_pairs_hook is not None:
+        config = rebuild_tree(config, object_pairs_hook)
+    return config
+
+
+def sniff_yaml(contents):
+    """Does it start with a yaml document marker?
+    """
+    return contents[:5].startswith((b"---", b"%YAML"))
+
+
+def load_toml(contents, object_pairs_hook=None):
+    """Load toml config contents.
+
+    This uses tomllib on python 3.11+, and otherwise needs tomli or toml
+    installed.
+    """
+    toml = import_loader_module("toml", "tomllib", "tomli", "toml")
+    config = toml.loads(codecs.decode(contents, 'utf-8'))
+    if object_pairs_hook is not None:
+        config = rebuild_tree(config, object_pairs_hook)
+    return config
+
+
+register_config_loader("json", load_json, extensions=(".json", ))
+register_config_loader("marshal", load_marshal, extensions=(".marshal", ))
+register_config_loader("msgpack", load_msgpack,
+                       extensions=(".msgpack", ".mpk"), sniff=sniff_msgpack)
+register_config_loader("yaml", load_yaml, extensions=(".yaml", ".yml"),
+                       sniff=sniff_yaml)
+register_config_loader("toml", load_toml, extensions=(".toml", ))
+
+
+# Compression {{{1
+Compression = namedtuple("Compression", ("name", "magic", "decompressor"))
+COMPRESSIONS = {}
+COMPRESSION_EXTENSIONS = {}
+
+
+def register_compression(name, decompressor, magic, extensions=()):
+    """Add a compression format, or replace one, for iter_decompressed().
+
+    Args:
+      name (str): the format name, e.g. "gzip"
+      decompressor (callable): returns a new incremental decompressor, with
+        decompress(data), unused_data and eof, like zlib.decompressobj()
+      magic (bytes): the bytes every compressed stream starts with
+      extensions (iterable, optional): the file extensions, e.g. (".gz", ),
+        that use this format
+    """
+    COMPRESSIONS[name] = Compression(name, magic, decompressor)
+    for extension in extensions:
+        COMPRESSION_EXTENSIONS[extension.lower()] = name
+
+
+def get_compression(resource=None, contents=None):
+    """Find the Compression of a resource, if it's compressed.
+
+    The magic bytes at the start of the contents win, since an http client
+    may already have undone a Content-Encoding: gzip.  The extension is
+    only used when there are no contents to check.
+
+    Args:
+      resource (str, optional): the path or url
+      contents (bytes, optional): the start of the contents
+
+    Returns:
+      Compression, or None if it isn't compressed
+    """
+    if contents is not None:
+        for compression in COMPRESSIONS.values():
+            magic = compression.magic
+            if contents[:len(magic)] == magic:
+                return compression
+        return None
+    if resource is None:
+        return None
+    name = resource
+    if is_url(resource):
+        name = get_filename_from_url(resource)
+    extension = os.path.splitext(name)[1].lower()
+    if extension in COMPRESSION_EXTENSIONS:
+        return COMPRESSIONS[COMPRESSION_EXTENSIONS[extension]]
+    return None
+
+
+def strip_compression_extension(name):
+    """Strip a compression extension from a filename.
+
+    Args:
+      name (str): the filename, e.g. config.json.gz
+
+    Returns:
+      name (str): e.g. config.json
+    """
+    root, extension = os.path.splitext(name)
+    if extension.lower() in COMPRESSION_EXTENSIONS:
+        return root
+    return name
+
+
+def iter_decompressed(chunks, resource=None):
+    """Decompress a stream of chunks, if it's compressed.
+
+    Only one chunk of compressed and decompressed data is held at a time.
+    Concatenated streams, like `cat a.gz b.gz`, are decompressed in turn.
+
+    Args:
+      chunks (iterable): the bytes chunks, e.g. response.iter_content()
+      resource (str, optional): the path or url, for get_compression()
+
+    Yields:
+      chunk (bytes): the decompressed chunks, or the original chunks if
+        they aren't compressed
+
+    Raises:
+      ValueError: if the compressed stream is corrupt or truncated
+    """
+    chunks = iter(chunks)
+    magic_size = max([len(c.magic) for c in COMPRESSIONS.values()] or [0])
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= magic_size:
+            break
+    compression = get_compression(resource, head or None)
+    if compression is None:
+        if head:
+            yield head
+        for chunk in chunks:
+            yield chunk
+        return
+    decompressor = compression.decompressor()
+
+    def all_chunks():
+        """head, then the rest of the chunks."""
+        yield head
+        for chunk in chunks:
+            yield chunk
+
+    for chunk in all_chunks():
+        while chunk:
+            if getattr(decompressor, 'eof', False):
+                # the next of concatenated streams
+                decompressor = compression.decompressor()
+            try:
+                data = decompressor.decompress(chunk)
+            except Exception as exc_info:  # pylint: disable=broad-except
+                raise ValueError("Can't decompress %s data: %s" % (
+                    compression.name, exc_info
+                ))
+            if data:
+                yield data
+            chunk = b""
+            if getattr(decompressor, 'eof', False):
+                chunk = decompressor.unused_data
+    if not getattr(decompressor, 'eof', True):
+        raise ValueError("Truncated %s data!" % compression.name)
+
+
+def decompress_contents(contents, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Decompress a whole compressed config, chunk by chunk.
+
+    Args:
+      contents (bytes or mmap): the compressed contents
+      chunk_size (int, optional): the number of bytes to decompress at a
+        time
+
+    Returns:
+      contents (bytes): decompressed
+    """
+    import io
+    output = io.BytesIO()
+    chunks = (contents[start:start + chunk_size]
+              for start in range(0, len(contents), chunk_size))
+    for chunk in iter_decompressed(chunks):
+        output.write(chunk)
+    return output.getvalue()
+
+
+def get_gzip_decompressor():
+    """Get a gzip decompressor.
+    """
+    import zlib
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def get_bz2_decompressor():
+    """Get a bz2 decompressor.
+    """
+    import bz2
+    return bz2.BZ2Decompressor()
+
+
+def get_xz_decompressor():
+    """Get an xz decompressor.  Python 2 needs backports.lzma installed.
+    """
+    lzma = import_loader_module("xz", "lzma", "backports.lzma")
+    return lzma.LZMADecompressor()
+
+
+register_compression("gzip", get_gzip_decompressor, b"\x1f\x8b",
+                     extensions=(".gz", ))
+register_compression("bz2", get_bz2_decompressor, b"BZh",
+                     extensions=(".bz2", ))
+register_compression("xz", get_xz_decompressor, b"\xfd7zXZ\x00",
+                     extensions=(".xz", ))
 
 
 # parse_config_file() {{{1
-def parse_config_file(path):
+def get_object_pairs_hook(interner=None, target=None):
+    """Build the json object_pairs_hook for parse_config_file().
+
+    Args:
+      interner (ConfigInterner, optional): dedupe keys and values through
+        this interner's table.
+      target (callable, optional): build each json object from its list of
+        (key, value) pairs, e.g. dict, ReadOnlyDict or LoggingDict.from_pairs
+
+    Returns:
+      object_pairs_hook (callable): or None for json's default dicts
+    """
+    if target is None:
+        return interner
+    if interner is None:
+        return target
+
+    def hook(pairs):
+        """Intern the pairs, then build the target."""
+        return target([(interner.intern(key), interner.intern(value))
+                       for key, value in pairs])
+    return hook
+
+
+@contextmanager
+def read_config_contents(path, mmap_threshold=DEFAULT_MMAP_THRESHOLD):
+    """Read a local config file's contents for the config loaders.
+
+    Files of at least mmap_threshold bytes are memory-mapped, so the loader
+    reads the page cache directly instead of a bytes copy of the file.
+
+    Args:
+      path (str): the local path
+      mmap_threshold (int, optional): the smallest file to mmap, or None to
+        always read the file into bytes
+
+    Yields:
+      contents (bytes or mmap): the mmap is closed on exit.
+    """
+    with open(path, 'rb') as filehandle:
+        size = os.fstat(filehandle.fileno()).st_size
+        # python 2's loaders need real strs.
+        if six.PY2 or mmap_threshold is None or size == 0 or \
+                size < mmap_threshold:
+            yield filehandle.read()
+            return
+        import mmap
+        contents = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield contents
+        finally:
+            contents.close()
+
+
+def rebuild_tree(value, object_pairs_hook):
+    """Rebuild a parsed config as if it had been parsed with a hook.
+
+    Objects are rebuilt bottom-up, the same order json calls the hook in.
+
+    Args:
+      value (any): the parsed config, or part of it.  Lists are changed in
+        place.
+      object_pairs_hook (callable): from get_object_pairs_hook()
+
+    Returns:
+      value, rebuilt
+    """
+    if isinstance(value, dict):
+        return object_pairs_hook([
+            (key, rebuild_tree(item, object_pairs_hook))
+            for key, item in value.items()
+        ])
+    if isinstance(value, list):
+        value[:] = [rebuild_tree(item, object_pairs_hook) for item in value]
+    return value
+
+
+def parse_config_file(path, interner=None, session=None, http_cache=None,
+                      parse_cache=None, target=None, resolver=None):
     """Read a config file and return a dictionary.
 
-    For now, only support json.
+    The format is picked by get_config_loader(): by extension, then by
+    sniffing the contents, defaulting to json.  json, marshal, msgpack,
+    yaml and toml are built in, and scripts can add their own formats with
+    register_config_loader().
+
+    With a target, json and msgpack objects are built directly as that type
+    while parsing, rather than parsed into dicts and copied, so a large
+    config only exists in memory once.  Other formats are rebuilt as the
+    target type after parsing.
 
     Args:
       path (str): path or url to config file.
+      interner (ConfigInterner, optional): dedupe keys and values through
+        this interner's table.
+      session (requests.Session, optional): the session to download urls
+        with.  Defaults to the SESSION_POOL session.
+      http_cache (scriptharness.cache.HttpCache, optional): fetch urls
+        through this cache with conditional GETs, and read them from the
+        cache directory rather than downloading them to the cwd.
+      parse_cache (scriptharness.cache.ParseCache, optional): skip parsing
+        files that haven't changed since they were last parsed.
+      target (callable, optional): build each json object from its list of
+        (key, value) pairs, e.g. dict (the default), ReadOnlyDict or
+        LoggingDict.from_pairs.
+      resolver (ConfigResolver, optional): resolve the config's includes
+        through this ConfigResolver.  The other kwargs are ignored; the
+        ConfigResolver has its own.
+
+    Local paths and file:// urls are read in place, and big ones are
+    memory-mapped; see read_config_contents().  gzip, bz2 and xz configs
+    are decompressed in memory, e.g. config.json.gz.
 
     Returns:
-      config (dict)
+      config (dict): or an instance of the target type
 
     Raises:
       ScriptHarnessException on error
     """
-    if is_url(path):
-        path = download_url(path)
+    if resolver is not None:
+        return resolver.resolve(path)
+    resource = path
+    object_pairs_hook = get_object_pairs_hook(interner=interner,
+                                              target=target)
+    local_path = get_local_path(path)
+    if local_path is not None:
+        path = local_path
+    else:
+        if http_cache is not None:
+            path = http_cache.fetch(path, session=session)
+        else:
+            path = download_url(path, session=session)
     # py3 may throw FileNotFoundError or IOError; both inherit OSError.
     # py2 throws IOError, which doesn't inherit OSError.
     if six.PY3:
         exception = OSError
     else:
         exception = IOError
+
+    def load(contents, object_pairs_hook=None):
+        """Decompress, then pick the loader by resource name or sniffing."""
+        if get_compression(contents=contents) is not None:
+            contents = decompress_contents(contents)
+        return get_config_loader(resource, contents).load(
+            contents, object_pairs_hook=object_pairs_hook
+        )
+
     try:
-        with open(path) as filehandle:
-            config = dict(json.load(filehandle))
+        if parse_cache is not None:
+            # marshal can only store builtin types, so the cache holds the
+            # plain parse, rebuilt through the hook afterwards.
+            config = parse_cache.parse(path, load)
+            if object_pairs_hook is not None:
+                config = rebuild_tree(config, object_pairs_hook)
+        else:
+            with read_config_contents(path) as contents:
+                config = load(contents, object_pairs_hook=object_pairs_hook)
     except exception as exc_info:
         raise ScriptHarnessException(
             "Can't open path %s!" % path, exc_info
         )
     except ValueError as exc_info:
         raise ScriptHarnessException(
-            "Can't parse json in %s!" % path, exc_info
+            "Can't parse %s!" % path, exc_info
+        )
+    if not isinstance(config, dict):
+        raise ScriptHarnessException(
+            "Can't parse %s!" % path,
+            "The top level is a %s, not an object." % type(config).__name__
         )
     return config
 
 
+def parse_config_files(resources, max_workers=DEFAULT_MAX_WORKERS,
+                       **kwargs):
+    """Fetch and parse a number of config files concurrently.
+
+    Each resource is downloaded (if it's a url) and parsed in a thread pool,
+    so the total time is closer to the slowest resource than to the sum of
+    all of them.  Urls that would download to the same filename are
+    handled serially in the same thread, so they don't clobber each other
+    (an http_cache keys its files by url, so that isn't a concern there).
+
+    Args:
+      resources (list): paths or urls to config files.
+      max_workers (int, optional): the maximum number of threads.
+      **kwargs: additional kwargs for parse_config_file()
+
+    Returns:
+      results (list): a (config, exception) tuple per resource, in the same
+        order as resources.  If the resource couldn't be read, config is
+        None and exception is the ScriptHarnessException.
+    """
+    from multiprocessing.pool import ThreadPool
+    groups = {}
+    for position, resource in enumerate(resources):
+        if get_local_path(resource) is None and \
+                kwargs.get('http_cache') is None:
+            target = get_filename_from_url(resource)
+        else:
+            target = resource
+        groups.setdefault(target, []).append((position, resource))
+
+    def parse_group(group):
+        """Parse one group of resources serially."""
+        results = []
+        for position, resource in group:
+            try:
+                results.append(
+                    (position, parse_config_file(resource, **kwargs), None)
+                )
+            except ScriptHarnessException as exc_info:
+                results.append((position, None, exc_info))
+        return results
+
+    groups = list(groups.values())
+    if max_workers > 1 and len(groups) > 1:
+        pool = ThreadPool(min(max_workers, len(groups)))
+        try:
+            group_results = pool.map(parse_group, groups)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        group_results = [parse_group(group) for group in groups]
+    results = [None] * len(resources)
+    for group_result in group_results:
+        for position, config, exc_info in group_result:
+            results[position] = (config, exc_info)
+    return results
+
+
+# ConfigResolver {{{1
+def shallow_merge(base, overlay):
+    """Merge two configs like dict.update(), without changing either.
+
+    Args:
+      base (dict): the lower precedence config
+      overlay (dict): the higher precedence config
+
+    Returns:
+      merged (dict)
+    """
+    merged = dict(base)
+    merged.update(overlay)
+    return merged
+
+
+class ConfigResolver(object):
+    """Resolve config files that include other config files.
+
+    A config file can list other config files, by path or url, under its
+    include_key.  Relative paths are relative to the including file (or
+    url).  Each included config is applied in order, and the including
+    config is applied last, so it overrides everything it includes.
+
+    The include graph is discovered level by level: every resource at one
+    level is fetched and parsed concurrently by parse_config_files() before
+    the next level's includes are known.  Each unique resource is parsed
+    once per ConfigResolver, however many configs include it, and so is
+    each resolved config.  Cycles raise a ScriptHarnessException.
+
+    Pass the ConfigResolver to parse_config_file() or build_config() as
+    resolver=...; the parse_config_file() kwargs (interner, session,
+    http_cache, parse_cache, target) go to the ConfigResolver instead.
+
+    Attributes:
+      include_key (str): the config key that lists includes
+      max_workers (int): the maximum number of threads per level
+      merge (callable): merge(base, overlay) applies each config on top of
+        the previous ones, e.g. a DeepMerge.  Defaults to shallow_merge.
+      parse_kwargs (dict): kwargs for parse_config_file()
+      parsed (dict): resource: (config, exception) parse results
+      resolved (dict): resource: resolved config.  These are shared with
+        every caller, so don't change them.
+      lock (threading.Lock): held while parsing and resolving
+    """
+    def __init__(self, include_key="include",
+                 max_workers=DEFAULT_MAX_WORKERS, merge=None, **kwargs):
+        self.include_key = include_key
+        self.max_workers = max_workers
+        self.merge = merge or shallow_merge
+        self.parse_kwargs = kwargs
+        self.parsed = {}
+        self.resolved = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(resource, parent=None):
+        """Normalize a resource, so each config file has a single key.
+
+        Args:
+          resource (str): the path or url
+          parent (str, optional): the including resource, if any; relative
+            resources are relative to it.
+
+        Returns:
+          key (str): a url or absolute path
+        """
+        import six.moves.urllib as urllib
+        if is_url(resource):
+            return resource
+        if parent is not None and is_url(parent):
+            return urllib.parse.urljoin(parent, resource)
+        if parent is not None:
+            resource = os.path.join(os.path.dirname(parent), resource)
+        return os.path.abspath(resource)
+
+    def get_includes(self, resource, config):
+        """Get the keys of the resources that config includes.
+
+        Args:
+          resource (str): the key of the including resource
+          config (dict): its parsed config
+
+        Returns:
+          includes (list): resource keys, in order
+
+        Raises:
+          ScriptHarnessException: if the include_key isn't a list of strings
+        """
+        includes = config.get(self.include_key) or []
+        if isinstance(includes, six.string_types):
+            includes = [includes]
+        if not isinstance(includes, list) or \
+                not all(isinstance(x, six.string_types) for x in includes):
+            raise ScriptHarnessException(
+                "%s in %s must be a list of paths or urls!" % (
+                    self.include_key, resource
+                ), includes
+            )
+        return [self.get_key(include, parent=resource)
+                for include in includes]
+
+    def parse_all(self, resources):
+        """Parse resources and everything they include, a level at a time.
+
+        Args:
+          resources (list): paths or urls
+        """
+        with self.lock:
+            frontier = []
+            for resource in resources:
+                key = self.get_key(resource)
+                if key not in self.parsed and key not in frontier:
+                    frontier.append(key)
+            while frontier:
+                results = parse_config_files(
+                    frontier, max_workers=self.max_workers,
+                    **self.parse_kwargs
+                )
+                next_frontier = []
+                for resource, (config, exc_info) in zip(frontier, results):
+                    includes = []
+                    if exc_info is None:
+                        try:
+                            includes = self.get_includes(resource, config)
+                        except ScriptHarnessException as exc:
+                            config, exc_info = None, exc
+                    self.parsed[resource] = (config, exc_info)
+                    for include in includes:
+                        if include not in self.parsed and \
+                                include not in frontier and \
+                                include not in next_frontier:
+                            next_frontier.append(include)
+                frontier = next_frontier
+
+    def check_cycles(self, resource, chain=None, checked=None):
+        """Raise if resource includes itself, directly or indirectly.
+
+        Args:
+          resource (str): the resource key
+          chain (list, optional): the include chain leading to resource
+          checked (set, optional): the resources already known not to lead
+            to a cycle
+
+        Raises:
+          ScriptHarnessException: on a cycle, with the include chain
+        """
+        chain = chain or []
+        checked = checked if checked is not None else set()
+        if resource in chain:
+            cycle = chain[chain.index(resource):] + [resource]
+            raise ScriptHarnessException(
+                "Config include cycle: %s" % " -> ".join(cycle)
+            )
+        if resource in checked or resource in self.resolved:
+            return
+        config, exc_info = self.parsed[resource]
+        if exc_info is None:
+            for include in self.get_includes(resource, config):
+                self.check_cycles(include, chain=chain + [resource],
+                                  checked=checked)
+        checked.add(resource)
+
+    def _resolve(self, resource):
+        """Merge resource's includes and config, depth first.
+
+        Args:
+          resource (str): the resource key; its graph is parsed and acyclic.
+
+        Returns:
+          config (dict)
+
+        Raises:
+          ScriptHarnessException: if resource or an include can't be read
+        """
+        if resource in self.resolved:
+            return self.resolved[resource]
+        config, exc_info = self.parsed[resource]
+        if exc_info is not None:
+            raise exc_info
+        if self.include_key in config:
+            merged = {}
+            for include in self.get_includes(resource, config):
+                merged = self.merge(merged, self._resolve(include))
+            config = self.merge(merged, dict(
+                (key, value) for key, value in config.items()
+                if key != self.include_key
+            ))
+        self.resolved[resource] = config
+        return config
+
+    def resolve(self, resource):
+        """Parse and resolve a config file and its includes.
+
+        Args:
+          resource (str): the path or url
+
+        Returns:
+          config (dict)
+
+        Raises:
+          ScriptHarnessException: on a cycle, or if resource or any of its
+            includes can't be read
+        """
+        self.parse_all([resource])
+        key = self.get_key(resource)
+        with self.lock:
+            self.check_cycles(key)
+            return self._resolve(key)
+
+
 def get_filename_from_url(url):
     """Determine the filename of a file from its url.
 
@@ -73,6 +1022,7 @@ def get_filename_from_url(url):
     Returns:
       name (str): the name of the file
     """
+    import six.moves.urllib as urllib
     parsed = urllib.parse.urlparse(url)
     if parsed.path != '':
         return parsed.path.rstrip('/').rsplit('/', 1)[-1]
@@ -89,47 +1039,518 @@ def is_url(resource):
     Returns:
       bool
     """
+    import six.moves.urllib as urllib
     parsed = urllib.parse.urlparse(resource)
     if parsed.scheme:
         return True
     return False
 
 
-def download_url(url, path=None, timeout=None, mode='wb'):
+def get_local_path(resource):
+    """Get the local path of a config resource, if it has one.
+
+    file:// urls are local files, so they can be read in place rather than
+    downloaded.
+
+    Args:
+      resource (str): a path or url
+
+    Returns:
+      path (str): resource itself if it isn't a url, the path of a file://
+        url, or None for any other url
+    """
+    if not is_url(resource):
+        return resource
+    import six.moves.urllib as urllib
+    parsed = urllib.parse.urlparse(resource)
+    if parsed.scheme.lower() != "file" or \
+            parsed.netloc not in ("", "localhost"):
+        return None
+    return urllib.request.url2pathname(parsed.path)
+
+
+def replace_file(src, dest):
+    """Rename src to dest, replacing dest if it exists.
+
+    os.replace() is atomic on both posix and windows, but is python 3.3+.
+    os.rename() only replaces an existing dest on posix.
+
+    Args:
+      src (str): the path to rename
+      dest (str): the path to rename to
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dest)
+    else:  # pragma: no cover
+        if os.name == 'nt' and os.path.exists(dest):
+            os.remove(dest)
+        os.rename(src, dest)
+
+
+def read_part_metadata(meta_path, url):
+    """Read the sidecar metadata of a partial download, if it matches url.
+
+    Args:
+      meta_path (str): the path to the sidecar json file
+      url (str): the url being downloaded
+
+    Returns:
+      metadata (dict): with url and validator keys, or None if there is no
+        usable metadata.
+    """
+    json = get_json_module()
+    try:
+        with open(meta_path) as filehandle:
+            metadata = json.load(filehandle)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(metadata, dict) or metadata.get('url') != url or \
+            not metadata.get('validator'):
+        return None
+    return metadata
+
+
+def write_part_metadata(meta_path, url, response):
+    """Record how to resume a partial download, if the server allows it.
+
+    The validator is the ETag, or failing that, the Last-Modified header;
+    it's sent back as If-Range so a changed file is downloaded from the
+    start rather than spliced onto stale bytes.  Encoded (e.g. gzipped)
+    responses can't be resumed by byte offset, so no metadata is written.
+
+    Args:
+      meta_path (str): the path to the sidecar json file
+      url (str): the url being downloaded
+      response (requests.Response): the response being written
+
+    Returns:
+      resumable (bool): whether metadata was written.
+    """
+    json = get_json_module()
+    headers = response.headers
+    validator = headers.get('ETag') or headers.get('Last-Modified')
+    encoding = headers.get('Content-Encoding', 'identity')
+    if not validator or encoding != 'identity':
+        remove_files(meta_path)
+        return False
+    with open(meta_path, 'w') as filehandle:
+        json.dump({'url': url, 'validator': validator}, filehandle)
+    return True
+
+
+def remove_files(*paths):
+    """Remove each path that exists.
+
+    Args:
+      *paths (str): the paths to remove
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def fetch_to_part(url, part_path, session, timeout, chunk_size,
+                  resume_retries):
+    """Download url to part_path, resuming after dropped connections.
+
+    If part_path and its sidecar metadata (part_path + '.json') are left
+    over from an earlier attempt at the same url, only the remaining bytes
+    are requested, with a Range header.  If-Range makes the server send the
+    whole file instead if it has changed since.
+
+    Args:
+      url (str): the url to download
+      part_path (str): the partial file to write to
+      session (requests.Session): the session to download with
+      timeout (float): how long to wait before timing out
+      chunk_size (int): the number of bytes to read and write at a time
+      resume_retries (int): the number of times to resume after a dropped
+        connection or short read
+
+    Raises:
+      requests.exceptions.RequestException: on download error.  part_path
+        and its metadata are left in place if the download is resumable.
+    """
+    import requests
+    meta_path = part_path + '.json'
+    attempt = 0
+    while True:
+        headers = {}
+        offset = 0
+        metadata = read_part_metadata(meta_path, url)
+        if metadata is not None and os.path.isfile(part_path):
+            offset = os.path.getsize(part_path)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = metadata['validator']
+        try:
+            response = session.get(url, timeout=timeout, stream=True,
+                                   headers=headers)
+            if offset and response.status_code == 416:
+                # The .part file is already as long as (or longer than) the
+                # remote file; start over without a Range.
+                response.close()
+                remove_files(part_path, meta_path)
+                continue
+            if offset and response.status_code == 206:
+                file_mode = 'ab'
+            else:
+                offset = 0
+                file_mode = 'wb'
+                write_part_metadata(meta_path, url, response)
+            expected = None
+            if os.path.isfile(meta_path) and \
+                    'Content-Length' in response.headers:
+                expected = offset + int(response.headers['Content-Length'])
+                # urllib3 raises on a short read, discarding the bytes it has
+                # already buffered; we'd rather keep them and check the
+                # length ourselves.
+                response.raw.enforce_content_length = False
+            with open(part_path, file_mode) as filehandle:
+                for chunk in response.iter_content(  # pragma: no branch
+                        chunk_size=chunk_size):
+                    filehandle.write(chunk)
+            if expected is not None and os.path.getsize(part_path) < expected:
+                raise requests.exceptions.ChunkedEncodingError(
+                    "Short read from %s: got %d of %d bytes" % (
+                        url, os.path.getsize(part_path), expected
+                    )
+                )
+        except (requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError):
+            if attempt >= resume_retries or not os.path.isfile(meta_path):
+                raise
+            attempt += 1
+            continue
+        remove_files(meta_path)
+        return
+
+
+def fetch_decompressed(url, part_path, session, timeout, chunk_size,
+                       checksum_type='sha256'):
+    """Download url to part_path, decompressing it on the way.
+
+    Unlike fetch_to_part(), this can't resume, since an offset into the
+    decompressed file isn't an offset into the download.
+
+    Args:
+      url (str): the url to download
+      part_path (str): the partial file to write to
+      session (requests.Session): the session to download with
+      timeout (float): how long to wait before timing out
+      chunk_size (int): the number of bytes to read at a time
+      checksum_type (str, optional): the hashlib algorithm to digest the
+        download with
+
+    Returns:
+      digest (str): the hex digest of the downloaded (compressed) contents
+
+    Raises:
+      requests.exceptions.RequestException: on download error
+      ValueError: if the compressed contents are corrupt
+    """
+    digest = hashlib.new(checksum_type)
+    response = session.get(url, timeout=timeout, stream=True)
+
+    def iter_chunks():
+        """Hash the downloaded chunks as they go by."""
+        for chunk in response.iter_content(  # pragma: no branch
+                chunk_size=chunk_size):
+            digest.update(chunk)
+            yield chunk
+
+    with open(part_path, 'wb') as filehandle:
+        for chunk in iter_decompressed(iter_chunks(), url):
+            filehandle.write(chunk)
+    return digest.hexdigest()
+
+
+def download_url(url, path=None, timeout=None, mode='wb', session=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 resume_retries=DEFAULT_RESUME_RETRIES, checksum=None,
+                 artifact_cache=None, decompress=False,
+                 checksum_type='sha256'):
     """Download a url to a path
 
+    When writing (mode 'wb'), the contents are streamed to path + '.part',
+    which is renamed to path once the download is complete.  A failed
+    download never leaves a truncated file at path.  Other modes, like
+    'ab', write to path directly.
+
+    If the server sends an ETag or Last-Modified header, a dropped
+    connection or short read is resumed with a Range request, up to
+    resume_retries times.  If the download still fails, the .part file is
+    kept, and the next download_url() of the same url to the same path
+    picks up where it left off.
+
     Args:
       url (str): the url to download
       path (str, optional): the path to write to
       timeout (float, optional): how long to wait before timing out
       mode (str, optional): the mode to open the file with
+      session (requests.Session, optional): the session to download with.
+        Defaults to the SESSION_POOL session, so connections are reused.
+      chunk_size (int, optional): the number of bytes to read and write at
+        a time.
+      resume_retries (int, optional): the number of times to resume an
+        interrupted download.
+      checksum (str, optional): the expected hex digest of the contents,
+        checked before path is replaced.  Only used in 'wb' mode.
+      artifact_cache (scriptharness.cache.ArtifactCache, optional): link
+        path from this cache if url (or checksum) is already there, and add
+        new downloads to it.  Only used in 'wb' mode.
+      decompress (bool, optional): if the download is gzip, bz2 or xz
+        compressed, write the decompressed contents to path, and drop the
+        compression extension from the default path.  Decompressed
+        downloads aren't resumable; checksum is still the digest of the
+        compressed download.  This can't be used with an artifact_cache.
+      checksum_type (str, optional): the hashlib algorithm of checksum.
+        The artifact_cache can only vouch for sha256 checksums, so other
+        checksums skip the cache lookup; the verified download is still
+        added to the cache.
 
     Raises:
       ScriptHarnessException on error
     """
+    import requests
+    if decompress and artifact_cache is not None:
+        raise ScriptHarnessException(
+            "download_url() can't decompress into an artifact_cache!", url
+        )
     if path is None:
         path = get_filename_from_url(url)
+        if decompress:
+            path = strip_compression_extension(path)
     if timeout is None:
         timeout = 10
+    part_path = path + '.part'
+    sha256 = checksum if checksum_type == 'sha256' else None
     try:
-        session = requests.Session()
-        session.mount(url, requests.adapters.HTTPAdapter(max_retries=5))
-        response = session.get(url, timeout=timeout, stream=True)
-        with open(path, mode) as filehandle:
-            for chunk in response.iter_content(  # pragma: no branch
-                    chunk_size=1024):
-                if chunk:  # pragma: no branch
+        if session is None:
+            session = SESSION_POOL.get_session()
+        if mode == 'wb':
+            if artifact_cache is not None and \
+                    (checksum is None or sha256 is not None) and \
+                    artifact_cache.get(url, path, checksum=sha256):
+                return path
+            if decompress:
+                digest = fetch_decompressed(url, part_path, session, timeout,
+                                            chunk_size,
+                                            checksum_type=checksum_type)
+                if checksum is not None and digest != checksum.lower():
+                    raise ScriptHarnessException(
+                        "%s checksum mismatch for %s" % (checksum_type, url),
+                        digest, checksum
+                    )
+            else:
+                fetch_to_part(url, part_path, session, timeout, chunk_size,
+                              resume_retries)
+                if checksum is not None:
+                    verify_checksum(part_path, checksum, checksum_type,
+                                    chunk_size=chunk_size)
+            replace_file(part_path, path)
+            if artifact_cache is not None:
+                artifact_cache.add(url, path, checksum=sha256)
+        else:
+            response = session.get(url, timeout=timeout, stream=True)
+            chunks = response.iter_content(chunk_size=chunk_size)
+            if decompress:
+                chunks = iter_decompressed(chunks, url)
+            with open(path, mode) as filehandle:
+                for chunk in chunks:  # pragma: no branch
                     filehandle.write(chunk)
-                    filehandle.flush()
         return path
     except requests.exceptions.RequestException as exc_info:
+        if not os.path.isfile(part_path + '.json'):
+            remove_files(part_path)
         raise ScriptHarnessException("Error downloading from url %s" % url,
                                      exc_info)
-    except IOError as exc_info:
+    except (IOError, OSError) as exc_info:
+        remove_files(part_path, part_path + '.json')
         raise ScriptHarnessException(
             "Error writing downloaded contents to path %s" % path,
             exc_info
         )
+    except ValueError as exc_info:
+        remove_files(part_path)
+        raise ScriptHarnessException(
+            "Can't decompress the download from url %s" % url, exc_info
+        )
+    except ScriptHarnessException:
+        remove_files(part_path, part_path + '.json')
+        raise
+
+
+def verify_checksum(path, checksum, checksum_type='sha256',
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Verify a file's checksum.
+
+    Args:
+      path (str): the file to check
+      checksum (str): the expected hex digest
+      checksum_type (str, optional): the hashlib algorithm name
+      chunk_size (int, optional): the number of bytes to read at a time
+
+    Raises:
+      ScriptHarnessException: on mismatch
+    """
+    digest = hashlib.new(checksum_type)
+    with open(path, 'rb') as filehandle:
+        for chunk in iter(lambda: filehandle.read(chunk_size), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != checksum.lower():
+        raise ScriptHarnessException(
+            "%s checksum mismatch for %s" % (checksum_type, path),
+            digest.hexdigest(), checksum
+        )
+
+
+def fetch_segment(url, part_path, start, end, validator, session, timeout,
+                  chunk_size):
+    """Fetch bytes start-end (inclusive) of url into part_path.
+
+    Each segment opens its own file descriptor, so concurrent segments
+    don't share a file position.  os.pwrite() is used where available.
+
+    Args:
+      url (str): the url to download
+      part_path (str): the preallocated file to write to
+      start (int): the first byte offset
+      end (int): the last byte offset
+      validator (str): the ETag or Last-Modified from the HEAD request,
+        sent as If-Range so a changed file can't be mixed with the old one
+      session (requests.Session): the session to download with
+      timeout (float): how long to wait before timing out
+      chunk_size (int): the number of bytes to read and write at a time
+
+    Raises:
+      requests.exceptions.RequestException: on download error, or if the
+        server doesn't return exactly the requested range.
+    """
+    import requests
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    response = session.get(url, timeout=timeout, stream=True,
+                           headers=headers)
+    if response.status_code != 206:
+        response.close()
+        raise requests.exceptions.HTTPError(
+            "Expected a 206 for bytes %d-%d of %s, got %d" % (
+                start, end, url, response.status_code
+            ), response=response
+        )
+    position = start
+    fd = os.open(part_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        for chunk in response.iter_content(  # pragma: no branch
+                chunk_size=chunk_size):
+            if hasattr(os, 'pwrite'):
+                os.pwrite(fd, chunk, position)
+            else:  # pragma: no cover
+                os.lseek(fd, position, os.SEEK_SET)
+                os.write(fd, chunk)
+            position += len(chunk)
+    finally:
+        os.close(fd)
+    if position != end + 1:
+        raise requests.exceptions.ChunkedEncodingError(
+            "Short read from %s: got %d of bytes %d-%d" % (
+                url, position - start, start, end
+            )
+        )
+
+
+def download_url_parallel(url, path=None, segments=DEFAULT_SEGMENTS,
+                          checksum=None, checksum_type='sha256',
+                          timeout=None, session=None,
+                          chunk_size=DEFAULT_CHUNK_SIZE):
+    """Download a url in concurrent byte range segments.
+
+    A single stream is often limited by latency rather than bandwidth; with
+    several ranges in flight, large artifacts download faster.  The file is
+    preallocated as path + '.part', each segment is written at its offset,
+    and the result is renamed to path once every segment (and the checksum,
+    if given) checks out.
+
+    If the server doesn't advertise byte ranges, this falls back to
+    download_url().
+
+    Args:
+      url (str): the url to download
+      path (str, optional): the path to write to
+      segments (int, optional): the number of ranges to fetch concurrently
+      checksum (str, optional): the expected hex digest of the contents
+      checksum_type (str, optional): the hashlib algorithm of checksum
+      timeout (float, optional): how long to wait before timing out
+      session (requests.Session, optional): the session to download with.
+        Defaults to the SESSION_POOL session.
+      chunk_size (int, optional): the number of bytes to read and write at
+        a time.
+
+    Returns:
+      path (str): the downloaded path
+
+    Raises:
+      ScriptHarnessException on error
+    """
+    from multiprocessing.pool import ThreadPool
+    import requests
+    if path is None:
+        path = get_filename_from_url(url)
+    if timeout is None:
+        timeout = 10
+    part_path = path + '.part'
+    try:
+        if session is None:
+            session = SESSION_POOL.get_session()
+        response = session.head(url, timeout=timeout, allow_redirects=True)
+        headers = response.headers
+        size = int(headers.get('Content-Length') or 0)
+        if response.status_code != 200 or size == 0 or \
+                headers.get('Accept-Ranges') != 'bytes' or \
+                headers.get('Content-Encoding', 'identity') != 'identity':
+            # download_url() verifies the .part file before replacing path
+            return download_url(url, path=path, timeout=timeout,
+                                session=session, chunk_size=chunk_size,
+                                checksum=checksum,
+                                checksum_type=checksum_type)
+        validator = headers.get('ETag') or headers.get('Last-Modified')
+        segments = max(1, min(segments, size))
+        segment_size = -(-size // segments)
+        ranges = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+        with open(part_path, 'wb') as filehandle:
+            filehandle.truncate(size)
+        pool = ThreadPool(len(ranges))
+        try:
+            pool.map(
+                lambda byte_range: fetch_segment(
+                    url, part_path, byte_range[0], byte_range[1], validator,
+                    session, timeout, chunk_size
+                ),
+                ranges
+            )
+        finally:
+            pool.close()
+            pool.join()
+        if checksum is not None:
+            verify_checksum(part_path, checksum, checksum_type)
+        replace_file(part_path, path)
+        return path
+    except requests.exceptions.RequestException as exc_info:
+        remove_files(part_path)
+        raise ScriptHarnessException("Error downloading from url %s" % url,
+                                     exc_info)
+    except (IOError, OSError) as exc_info:
+        remove_files(part_path)
+        raise ScriptHarnessException(
+            "Error writing downloaded contents to path %s" % path,
+            exc_info
+        )
+    except ScriptHarnessException:
+        remove_files(part_path)
+        raise
 
 
 # get_parser() {{{1
@@ -161,6 +1582,7 @@ def get_action_parser(all_actions):
     Returns:
       ArgumentParser with action options
     """
+    import argparse
     parser = argparse.ArgumentParser(add_help=False)
     message = []
     choices = []
@@ -200,6 +1622,7 @@ def get_config_parser():
     Returns:
       ArgumentParser with config options
     """
+    import argparse
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument(
         '--config-file', '--cfg', '-c', action='append', dest='config_files',
@@ -214,25 +1637,39 @@ def get_config_parser():
         '--dump-config', action='store_true',
         help="Log the built configuration and exit."
     )
+    parser.add_argument(
+        '--compile-config', metavar="OUT",
+        help="Write the merged config files to a config bundle and exit."
+    )
+    parser.add_argument(
+        '--config-bundle', metavar="IN",
+        help="Load the config from a --compile-config bundle instead of "
+             "the config files."
+    )
     return parser
 
 
-def get_parser(all_actions=None, parents=None, **kwargs):
+def get_parser(all_actions=None, parents=None, config_schema=None,
+               **kwargs):
     """Create a script option parser.
 
     Args:
       parents (list, optional): ArgumentParsers to set as parents of the parser
+      config_schema (ConfigSchema, optional): the schema build_config() will
+        validate the config against, set as parser.config_schema
       **kwargs: additional kwargs for ArgumentParser
 
     Returns:
       ArgumentParser with config options
     """
+    import argparse
     if parents is None:
         parents = []
         if all_actions:
             parents.append(get_action_parser(all_actions))
         parents.append(get_config_parser())
     parser = argparse.ArgumentParser(parents=parents, **kwargs)
+    parser.config_schema = config_schema
     return parser
 
 
@@ -256,16 +1693,341 @@ def parse_args(parser, cmdln_args=None):
     return parsed_args
 
 
+# Config bundles {{{1
+def get_url_validator(url, session=None, timeout=10):
+    """Get the ETag, or else the Last-Modified, of a url with a HEAD request.
+
+    Args:
+      url (str): the url
+      session (requests.Session, optional): the session to use.  Defaults to
+        the SESSION_POOL session.
+      timeout (float, optional): how long to wait before timing out
+
+    Returns:
+      validator (str): or None if the server sends neither header
+
+    Raises:
+      ScriptHarnessException: if the request fails
+    """
+    import requests
+    if session is None:
+        session = SESSION_POOL.get_session()
+    try:
+        response = session.head(url, timeout=timeout, allow_redirects=True)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exc_info:
+        raise ScriptHarnessException("Can't check url %s" % url, exc_info)
+    return response.headers.get('ETag') or \
+        response.headers.get('Last-Modified')
+
+
+def get_source_fingerprint(resource, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Fingerprint a config file, for config bundles.
+
+    Local files (and file:// urls) are fingerprinted by their size and
+    sha256.  Remote urls aren't downloaded again; they're fingerprinted by
+    the ETag or Last-Modified of a HEAD request, and a url whose server
+    sends neither can't be bundled.
+
+    Args:
+      resource (str): the config file path or url
+      chunk_size (int, optional): the number of bytes to hash at a time
+
+    Returns:
+      fingerprint (dict): resource, and the size and sha256 of a local file,
+        or the validator of a url
+
+    Raises:
+      ScriptHarnessException: if a url can't be checked, or has no validator
+    """
+    fingerprint = {"resource": resource, "size": None, "sha256": None,
+                   "validator": None}
+    local_path = get_local_path(resource)
+    if local_path is None:
+        fingerprint["validator"] = get_url_validator(resource)
+        if fingerprint["validator"] is None:
+            raise ScriptHarnessException(
+                "Can't bundle %s: the server sends no ETag or Last-Modified "
+                "to check it against later." % resource
+            )
+        return fingerprint
+    resource = local_path
+    fingerprint["resource"] = os.path.abspath(resource)
+    hash_obj = hashlib.sha256()
+    with open(resource, 'rb') as filehandle:
+        for chunk in iter(lambda: filehandle.read(chunk_size), b''):
+            hash_obj.update(chunk)
+    fingerprint["size"] = os.path.getsize(resource)
+    fingerprint["sha256"] = hash_obj.hexdigest()
+    return fingerprint
+
+
+def write_config_bundle(path, config, sources):
+    """Write a merged config and its sources' fingerprints to a bundle.
+
+    The bundle is a single marshal file, so loading it is one read and one
+    unmarshal.  marshal is specific to the python version, so a bundle is
+    only readable by the same python version that wrote it.  Each source is
+    fingerprinted by get_source_fingerprint(), so read_config_bundle() can
+    tell when the bundle is stale.
+
+    Args:
+      path (str): the bundle path to write
+      config (dict): the merged config.  It has to be made of builtin types.
+      sources (list): the config files and urls the config came from
+
+    Raises:
+      ScriptHarnessException: if the config can't be marshaled or written,
+        or a source can't be fingerprinted
+    """
+    import marshal
+    bundle = {
+        "version": CONFIG_BUNDLE_VERSION,
+        "python": "%d.%d" % sys.version_info[:2],
+        "sources": [get_source_fingerprint(resource) for resource in sources],
+        "config": config,
+    }
+    try:
+        contents = marshal.dumps(bundle)
+    except ValueError as exc_info:
+        raise ScriptHarnessException(
+            "Can't marshal the config for bundle %s!" % path, exc_info
+        )
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as filehandle:
+            filehandle.write(contents)
+        replace_file(tmp_path, path)
+    except (IOError, OSError) as exc_info:
+        remove_files(tmp_path)
+        raise ScriptHarnessException(
+            "Can't write config bundle %s!" % path, exc_info
+        )
+
+
+def read_config_bundle(path, verify=True):
+    """Load the config from a write_config_bundle() bundle.
+
+    Args:
+      path (str): the bundle path
+      verify (bool, optional): check that the config files the bundle was
+        built from haven't changed.  Each remote url costs a HEAD request.
+
+    Returns:
+      config (dict)
+
+    Raises:
+      ScriptHarnessException: if the bundle can't be read, was written by
+        another python version, or any of its sources changed
+    """
+    import gc
+    import marshal
+    try:
+        with open(path, 'rb') as filehandle:
+            contents = filehandle.read()
+        # The unmarshaled tree only holds new objects, so don't let the
+        # allocations trigger collections that would walk it.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            bundle = marshal.loads(contents)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    except (IOError, OSError, EOFError, ValueError, TypeError) as exc_info:
+        raise ScriptHarnessException(
+            "Can't read config bundle %s!" % path, exc_info
+        )
+    python = "%d.%d" % sys.version_info[:2]
+    if not isinstance(bundle, dict) or \
+            bundle.get("version") != CONFIG_BUNDLE_VERSION or \
+            bundle.get("python") != python:
+        raise ScriptHarnessException(
+            "Config bundle %s isn't a version %d bundle for python %s; "
+            "recompile it with --compile-config." % (
+                path, CONFIG_BUNDLE_VERSION, python
+            )
+        )
+    if verify:
+        stale = []
+        for fingerprint in bundle["sources"]:
+            resource = fingerprint["resource"]
+            try:
+                if fingerprint["validator"] is not None:
+                    if get_url_validator(resource) != \
+                            fingerprint["validator"]:
+                        stale.append(resource)
+                elif os.path.getsize(resource) != fingerprint["size"] or \
+                        get_source_fingerprint(resource)["sha256"] != \
+                        fingerprint["sha256"]:
+                    stale.append(resource)
+            except (IOError, OSError, ScriptHarnessException):
+                stale.append(resource)
+        if stale:
+            raise ScriptHarnessException(
+                "Config bundle %s is stale; recompile it with "
+                "--compile-config." % path, stale
+            )
+    return bundle["config"]
+
+
 # build_config {{{1
-def build_config(parser, parsed_args, initial_config=None):
-    """Build a configuration dict from the parser and initial config.
+def get_parser_defaults(parser):
+    """Get all of the parser defaults at once.
+
+    parser.get_default(dest) walks every parser action per call; this walks
+    them once, with the same precedence.
+
+    Args:
+      parser (ArgumentParser): the parser
+
+    Returns:
+      defaults (dict): dest: default
+    """
+    defaults = {}
+    # pylint: disable=protected-access
+    for action in parser._actions:
+        if action.default is not None:
+            defaults.setdefault(action.dest, action.default)
+    for key, value in parser._defaults.items():
+        defaults.setdefault(key, value)
+    return defaults
+
+
+def coerce_env_value(value):
+    """Parse an environment variable value as json, if it's meant as json.
+
+    Only values that parse as a json object or array, or that are exactly
+    the json of the scalar they parse to, are coerced, so 8, true, null,
+    0.5 and ["x"] are.  Strings like 1.10, 1e3, 08, 1234e56 or NaN stay
+    strings, since json would change them; a schema with coerce can type
+    them.
+
+    Args:
+      value (str): the environment variable value
 
-    The configuration is built in this order::
+    Returns:
+      value: the parsed json, or value unchanged
+    """
+    import math
+    json = get_json_module()
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return value
+    if isinstance(parsed, (dict, list)):
+        return parsed
+    if isinstance(parsed, float) and \
+            (math.isinf(parsed) or math.isnan(parsed)):
+        return value
+    if json.dumps(parsed) == value:
+        return parsed
+    return value
+
+
+def get_env_config(prefix=DEFAULT_ENV_PREFIX, separator="__",
+                   environ=None):
+    """Build a config from environment variables.
+
+    Each PREFIX__a__b__c=VALUE variable sets config["a"]["b"]["c"].  VALUE
+    is coerced by coerce_env_value(), so 8, true, null and ["x"] are
+    parsed as json; anything else, like linux or 1.10, stays a string.  The
+    environment is scanned once, and only the variables with the prefix
+    are parsed.
+
+    On Windows, environment variable names are uppercased.
+
+    Args:
+      prefix (str, optional): the variable name prefix
+      separator (str, optional): separates the prefix and each key
+      environ (dict, optional): the environment.  Defaults to os.environ.
+
+    Returns:
+      env_config (dict): the nested config from the environment
+    """
+    environ = os.environ if environ is None else environ
+    start = prefix + separator
+    index = sorted((name[len(start):], value)
+                   for name, value in environ.items()
+                   if name.startswith(start))
+    env_config = {}
+    for name, value in index:
+        keys = [key for key in name.split(separator) if key]
+        if not keys:
+            continue
+        value = coerce_env_value(value)
+        parent = env_config
+        for key in keys[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        parent[keys[-1]] = value
+    return env_config
+
+
+def add_config_file_layers(layered_config, config_files, opt_config_files,
+                           max_workers=DEFAULT_MAX_WORKERS, **kwargs):
+    """Parse the config files, and add a layer for each of them.
 
-      * parser defaults
-      * initial_config
-      * parsed_args.config_files, in order
-      * non-default parser args (cmdln_args)
+    Args:
+      layered_config (LayeredConfig): the config to add the layers to
+      config_files (list): the required config files/urls, in order
+      opt_config_files (list): the optional config files/urls, in order
+      max_workers (int, optional): the maximum number of threads to fetch
+        and parse config files with
+      **kwargs: additional kwargs for parse_config_file(), e.g. interner
+
+    Returns:
+      sources (list): the config files that were read, including any
+        includes a resolver read.
+
+    Raises:
+      ScriptHarnessException: if a required config file can't be read
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    resolver = kwargs.get('resolver')
+    if resolver is not None:
+        # Discover every file's includes together, so each level is
+        # fetched concurrently across all of the config files.
+        resolver.parse_all(config_files + opt_config_files)
+    results = parse_config_files(config_files + opt_config_files,
+                                 max_workers=max_workers, **kwargs)
+    sources = []
+    for resource, (parsed, exc_info) in zip(config_files,
+                                            results[:len(config_files)]):
+        if exc_info is not None:
+            raise exc_info
+        layered_config.add_layer(resource, parsed)
+        sources.append(resource)
+    for resource, (parsed, exc_info) in zip(opt_config_files,
+                                            results[len(config_files):]):
+        if exc_info is not None:
+            logger.info("Can't read optional config file %s; skipping.",
+                        resource)
+            continue
+        layered_config.add_layer(resource, parsed)
+        sources.append(resource)
+    if resolver is not None:
+        sources.extend(sorted(
+            resource for resource, (_, exc_info) in resolver.parsed.items()
+            if exc_info is None and resource not in sources
+        ))
+    return sources
+
+
+def build_layered_config(parser, parsed_args, initial_config=None,
+                         max_workers=DEFAULT_MAX_WORKERS, merge=None,
+                         schema=None, env_prefix=None, **kwargs):
+    """Build a LayeredConfig from the parser and initial config.
+
+    The layers, lowest precedence first, are::
+
+      * "parser defaults": the parsed args that match the parser defaults
+      * "initial_config"
+      * parsed_args.config_files, in order, named by their path or url
+      * parsed_args.opt_config_files, in order, named by their path or url
+      * "environment": with an env_prefix, see get_env_config()
+      * "commandline": non-default parser args (cmdln_args)
 
     So the commandline args can override everything else, as long as there are
     options to do so (commandline args will need to be a subset of the parser
@@ -273,37 +2035,149 @@ def build_config(parser, parsed_args, initial_config=None):
     commandline args, and its config isn't restricted as a subset of the
     parser options.
 
+    With --compile-config OUT, the layers below the environment are merged
+    and written to a config bundle (see write_config_bundle()).  With
+    --config-bundle IN, that bundle replaces the parser defaults,
+    initial_config and config file layers, so no config files or urls are
+    read; they're only checked for changes (see read_config_bundle()).
+
+    The config files are fetched and parsed concurrently (see
+    parse_config_files()), but they're still layered in this order.  None of
+    the layers are copied.  With resolver=ConfigResolver(...), each config
+    file's includes are resolved into its layer.
+
+    By default a higher layer replaces each top level key, like
+    dict.update().  Pass merge=DeepMerge() to merge nested dicts (and lists,
+    per its list_policy) instead, so an overlay config file only needs the
+    keys it changes.
+
+    Finally, the config is validated against the schema, or the
+    parser.config_schema from get_parser().  Any schema defaults and coerced
+    values are added as a "schema" layer on top.
+
     Args:
       parser (ArgumentParser): the parser used to parse_args()
       parsed_args (argparse Namespace): the results of parse_args()
       initial_config (dict, optional): initial configuration to set before
         commandline args
+      max_workers (int, optional): the maximum number of threads to fetch
+        and parse config files with
+      merge (callable, optional): the LayeredConfig merge function, e.g.
+        DeepMerge(list_policy="append")
+      schema (ConfigSchema or dict, optional): the schema to validate the
+        config against.  Defaults to parser.config_schema, if set.
+      env_prefix (str, optional): if set, add the get_env_config() variables
+        with this prefix, e.g. DEFAULT_ENV_PREFIX.  They're always deep
+        merged into the lower layers, so they can override a single nested
+        value.
+      **kwargs: additional kwargs for parse_config_file(), e.g. interner
+
+    Returns:
+      LayeredConfig
+
+    Raises:
+      ScriptHarnessException: if a config file can't be read, the config
+        doesn't match the schema, or both --compile-config and
+        --config-bundle are set
     """
-    config = {}
+    default_config = {}
     cmdln_config = {}
     resources = {}
-    initial_config = initial_config or {}
     logger = logging.getLogger(LOGGER_NAME)
+    parser_defaults = get_parser_defaults(parser)
     for key, value in parsed_args.__dict__.items():
         # There must be a better way.
-        if key in ('list_actions', 'actions', 'dump_config'):
+        if key in ('list_actions', 'actions', 'dump_config',
+                   'compile_config', 'config_bundle'):
             continue
         if key in ('config_files', 'opt_config_files'):
             resources.setdefault(key, value or [])
             continue
-        if parser.get_default(key) == value:
-            config[key] = value
+        if parser_defaults.get(key) == value:
+            default_config[key] = value
         else:
             cmdln_config[key] = value
-    config.update(initial_config)
-    for resource in resources.get('config_files', []):
-        config.update(parse_config_file(resource))
-    for resource in resources.get('opt_config_files', []):
-        try:
-            config.update(parse_config_file(resource))
-        except ScriptHarnessException:
-            logger.info("Can't read optional config file %s; skipping.",
-                        resource)
-    if cmdln_config:
-        config.update(cmdln_config)
-    return config
+    bundle_path = getattr(parsed_args, 'config_bundle', None)
+    compile_path = getattr(parsed_args, 'compile_config', None)
+    if bundle_path and compile_path:
+        raise ScriptHarnessException(
+            "--compile-config and --config-bundle can't be used together!",
+            compile_path, bundle_path
+        )
+    if bundle_path:
+        layered_config = LayeredConfig([
+            ("config bundle %s" % bundle_path, read_config_bundle(bundle_path))
+        ], merge=merge)
+    else:
+        layered_config = LayeredConfig([
+            ("parser defaults", default_config),
+            ("initial_config", initial_config or {}),
+        ], merge=merge)
+        sources = add_config_file_layers(
+            layered_config, resources.get('config_files', []),
+            resources.get('opt_config_files', []), max_workers=max_workers,
+            **kwargs
+        )
+        if compile_path:
+            write_config_bundle(compile_path,
+                                dict(layered_config.iter_resolved()),
+                                sources)
+    if env_prefix is not None:
+        env_config = get_env_config(prefix=env_prefix)
+        if env_config:
+            # Deep set the whole batch at once, per top level key, into
+            # copies of the resolved values; the lower layers don't change.
+            env_merge = merge or DeepMerge()
+            for key, value in env_config.items():
+                if key in layered_config:
+                    env_config[key] = env_merge(layered_config[key], value)
+            layered_config.add_layer("environment", env_config, replace=True)
+    interner = kwargs.get('interner')
+    if interner is not None and interner.hits:
+        logger.info("Interned %d duplicate config values, saving ~%d bytes.",
+                    interner.hits, interner.bytes_saved)
+    layered_config.add_layer("commandline", cmdln_config)
+    if schema is None:
+        schema = getattr(parser, 'config_schema', None)
+    if schema is not None:
+        if isinstance(schema, dict):
+            from scriptharness.schema import ConfigSchema
+            schema = ConfigSchema(schema)
+        changes = schema.get_changes(layered_config)
+        if changes:
+            layered_config.add_layer("schema", changes, replace=True)
+    return layered_config
+
+
+def build_config(parser, parsed_args, initial_config=None,
+                 max_workers=DEFAULT_MAX_WORKERS, merge=None, schema=None,
+                 env_prefix=None, **kwargs):
+    """Build a configuration dict from the parser and initial config.
+
+    This is build_layered_config(), flattened into a dict; see there for
+    the precedence of each layer.
+
+    Args:
+      parser (ArgumentParser): the parser used to parse_args()
+      parsed_args (argparse Namespace): the results of parse_args()
+      initial_config (dict, optional): initial configuration to set before
+        commandline args
+      max_workers (int, optional): the maximum number of threads to fetch
+        and parse config files with
+      merge (callable, optional): the LayeredConfig merge function, e.g.
+        DeepMerge(list_policy="append")
+      schema (ConfigSchema or dict, optional): the schema to validate the
+        config against.  Defaults to parser.config_schema, if set.
+      env_prefix (str, optional): the environment variable prefix, e.g.
+        DEFAULT_ENV_PREFIX.  Defaults to not reading the environment.
+      **kwargs: additional kwargs for parse_config_file(), e.g. interner
+
+    Returns:
+      config (dict)
+    """
+    layered_config = build_layered_config(
+        parser, parsed_args, initial_config=initial_config,
+        max_workers=max_workers, merge=merge, schema=schema,
+        env_prefix=env_prefix, **kwargs
+    )
+    return dict(layered_config.iter_resolved())
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Declarative config schemas, compiled into validator functions.
+
+A schema is a plain dict, so it can live in a json file next to the
+configs it describes::
+
+    {
+        "keys": {
+            "jobs": {"type": "int", "default": 1, "coerce": true},
+            "platform": {"type": "str", "choices": ["linux", "win"]},
+            "env": {"type": "dict", "values": {"type": "str"}},
+            "tools": {"type": "list", "items": {"type": "str"}}
+        },
+        "required": ["platform"]
+    }
+
+Each schema node may have::
+
+  * type: a TYPES name, or a list of them.  Defaults to "any".
+  * choices: the list of valid values
+  * coerce: if true, convert a value of the wrong type when that's
+    lossless, e.g. "4" to 4 for an int.  See COERCERS.
+  * keys, required, values, extra: for dicts.  keys maps each known key to
+    its schema, and any of them can have a default.  values is the schema
+    for any other keys; if extra is false, other keys are errors.
+  * items: for lists, the schema for every item.
+
+ConfigSchema compiles a schema once into a tree of closures, so validating
+a config doesn't re-read the schema, and collects every error in a single
+pass instead of stopping at the first one.
+
+Attributes:
+  TYPES (dict): type name: tuple of python types
+  COERCERS (dict): type name: function converting a value to that type, or
+    raising ValueError
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+from copy import deepcopy
+import six
+
+from scriptharness.exceptions import ScriptHarnessException
+from scriptharness.structures import Mapping
+
+
+# Types {{{1
+TYPES = {
+    "any": (object, ),
+    "bool": (bool, ),
+    "dict": (Mapping, ),
+    "float": (float, ) + six.integer_types,
+    "int": six.integer_types,
+    "list": (list, tuple),
+    "null": (type(None), ),
+    "str": six.string_types,
+}
+
+
+def coerce_bool(value):
+    """Convert a string or 0/1 to a bool.
+
+    Args:
+      value (any): the value to convert
+
+    Returns:
+      bool
+
+    Raises:
+      ValueError: if value isn't a recognizable bool
+    """
+    if isinstance(value, six.string_types):
+        lowered = value.strip().lower()
+        if lowered in ("true", "yes", "on", "1"):
+            return True
+        if lowered in ("false", "no", "off", "0"):
+            return False
+    elif isinstance(value, six.integer_types) and value in (0, 1):
+        return bool(value)
+    raise ValueError(value)
+
+
+def coerce_int(value):
+    """Convert a string or integral float to an int.
+
+    Args:
+      value (any): the value to convert
+
+    Returns:
+      int
+
+    Raises:
+      ValueError: if value isn't an integer
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, six.string_types):
+        return int(value.strip())
+    raise ValueError(value)
+
+
+def coerce_float(value):
+    """Convert a string to a float.
+
+    Args:
+      value (any): the value to convert
+
+    Returns:
+      float
+
+    Raises:
+      ValueError: if value isn't a number
+    """
+    if isinstance(value, six.string_types):
+        return float(value.strip())
+    raise ValueError(value)
+
+
+def coerce_str(value):
+    """Convert a number to a string.
+
+    Args:
+      value (any): the value to convert
+
+    Returns:
+      str
+
+    Raises:
+      ValueError: if value isn't a number
+    """
+    if isinstance(value, (float, ) + six.integer_types) and \
+            not isinstance(value, bool):
+        return six.text_type(value)
+    raise ValueError(value)
+
+
+COERCERS = {
+    "bool": coerce_bool,
+    "float": coerce_float,
+    "int": coerce_int,
+    "str": coerce_str,
+}
+
+
+# compile_schema() {{{1
+def format_path(path):
+    """Format a validator path for error messages.
+
+    Validators pass each child a (parent_path, key) tuple rather than a
+    formatted string, since the string is only needed on errors.
+
+    Args:
+      path (tuple or str): the path tuple, or the root name
+
+    Returns:
+      path (str), e.g. config.env.PATH or config.tools[1]
+    """
+    parts = []
+    while isinstance(path, tuple):
+        path, key = path
+        if isinstance(key, six.integer_types):
+            parts.append("[%d]" % key)
+        else:
+            parts.append(".%s" % key)
+    parts.append(path)
+    return "".join(reversed(parts))
+
+
+def get_type_names(schema, path):
+    """Get the list of type names in a schema node, checking them.
+
+    Args:
+      schema (dict): the schema node
+      path (str): the node's path, for errors
+
+    Returns:
+      type_names (list)
+
+    Raises:
+      ScriptHarnessException: on an unknown type name
+    """
+    type_names = schema.get("type", "any")
+    if isinstance(type_names, six.string_types):
+        type_names = [type_names]
+    for name in type_names:
+        if name not in TYPES:
+            raise ScriptHarnessException(
+                "Unknown schema type %s at %s!" % (name, path), sorted(TYPES)
+            )
+    return type_names
+
+
+def compile_type_check(schema, path):
+    """Compile the type, coerce and choices checks of a schema node.
+
+    Args:
+      schema (dict): the schema node
+      path (str): the node's path, for errors
+
+    Returns:
+      check (callable): check(value, path, errors) returns value, coerced
+        if need be.  Errors are appended to the errors list.  None if the
+        node doesn't check anything.
+    """
+    type_names = get_type_names(schema, path)
+    types = tuple(t for name in type_names for t in TYPES[name])
+    allow_bool = "bool" in type_names or "any" in type_names
+    coercers = []
+    if schema.get("coerce"):
+        coercers = [COERCERS[name] for name in type_names if name in COERCERS]
+    choices = schema.get("choices")
+    expected = " or ".join(type_names)
+    if "any" in type_names and choices is None:
+        return None
+
+    def check(value, path, errors):
+        """Check value's type and choices."""
+        # bools are ints, but an int schema shouldn't accept True.
+        if not isinstance(value, types) or \
+                (isinstance(value, bool) and not allow_bool):
+            for coercer in coercers:
+                try:
+                    value = coercer(value)
+                    break
+                except (TypeError, ValueError):
+                    continue
+            else:
+                errors.append("%s: expected %s, got %r" % (
+                    format_path(path), expected, value
+                ))
+                return value
+        if choices is not None and value not in choices:
+            errors.append("%s: %r is not one of %r" % (format_path(path),
+                                                        value, choices))
+        return value
+
+    if not coercers and choices is None:
+        # a pure type check; list validators can batch these.
+        check.simple_types = (types, allow_bool)
+    return check
+
+
+def all_of_types(items, types, allow_bool):
+    """Check that every item is one of types, without per-item calls.
+
+    Args:
+      items (list): the items to check
+      types (tuple): the valid types
+      allow_bool (bool): whether bools are valid, even if int is
+
+    Returns:
+      bool
+    """
+    for item in items:
+        if not isinstance(item, types) or \
+                (item.__class__ is bool and not allow_bool):
+            return False
+    return True
+
+
+def no_check(value, path, errors):  # pylint: disable=unused-argument
+    """The validator for a schema node without any checks.
+    """
+    return value
+
+
+def compile_dict_changes(schema, path):
+    """Compile the key checks of a dict schema node.
+
+    Args:
+      schema (dict): the schema node
+      path (str): the node's path, for errors
+
+    Returns:
+      get_changes (callable): get_changes(value, path, errors) returns a
+        dict of the keys whose values were defaulted or coerced.  value is
+        never changed.
+    """
+    key_validators = dict(
+        (key, compile_schema(key_schema, "%s.%s" % (path, key)))
+        for key, key_schema in schema.get("keys", {}).items()
+    )
+    for key, key_validator in key_validators.items():
+        if key_validator is None:
+            # no checks; just a known key
+            key_validators[key] = no_check
+    defaults = dict(
+        (key, key_schema["default"])
+        for key, key_schema in schema.get("keys", {}).items()
+        if "default" in key_schema
+    )
+    required = [key for key in schema.get("required", [])
+                if key not in defaults]
+    values_validator = None
+    if "values" in schema:
+        values_validator = compile_schema(schema["values"],
+                                          path + ".*") or no_check
+    extra = schema.get("extra", True)
+
+    def get_changes(value, path, errors):
+        """Check each key, and return the changed ones."""
+        changes = {}
+        for key in required:
+            if key not in value:
+                errors.append("%s: missing required key %s" % (
+                    format_path(path), key
+                ))
+        for key, default in defaults.items():
+            if key not in value:
+                changes[key] = deepcopy(default)
+        for key in value:
+            validator = key_validators.get(key, values_validator)
+            if validator is None:
+                if not extra:
+                    errors.append("%s: unexpected key %s" % (
+                        format_path(path), key
+                    ))
+                continue
+            item = value[key]
+            result = validator(item, (path, key), errors)
+            if result is not item:
+                changes[key] = result
+        return changes
+    return get_changes
+
+
+def compile_schema(schema, path="config"):
+    """Compile a schema node into a validator function.
+
+    Args:
+      schema (dict): the schema node
+      path (str, optional): the node's path, for errors
+
+    Returns:
+      validator (callable): validator(value, path, errors) returns value, or
+        a copy with defaults and coerced values.  value is never changed.
+        Errors are appended to the errors list.  None if the node doesn't
+        check anything.
+
+    Raises:
+      ScriptHarnessException: if the schema itself is invalid
+    """
+    if not isinstance(schema, dict):
+        raise ScriptHarnessException("Schema at %s isn't a dict!" % path,
+                                     schema)
+    check = compile_type_check(schema, path)
+    get_changes = None
+    if any(key in schema for key in ("keys", "values", "required")) or \
+            schema.get("extra") is False:
+        get_changes = compile_dict_changes(schema, path)
+    item_validator = None
+    if "items" in schema:
+        item_validator = compile_schema(schema["items"], path + "[]")
+        if item_validator is None:
+            item_validator = no_check
+    item_types = getattr(item_validator, 'simple_types', None)
+
+    def validator(value, path, errors):
+        """Validate value and its children."""
+        if check is not None:
+            value = check(value, path, errors)
+        if get_changes is not None and isinstance(value, Mapping):
+            changes = get_changes(value, path, errors)
+            if changes:
+                value = dict(value)
+                value.update(changes)
+        elif item_validator is not None and isinstance(value, (list, tuple)):
+            if item_types is not None and all_of_types(value, *item_types):
+                return value
+            items = None
+            for num, item in enumerate(value):
+                result = item_validator(item, (path, num), errors)
+                if result is not item and items is None:
+                    items = list(value)
+                if items is not None:
+                    items[num] = result
+            if items is not None:
+                value = type(value)(items)
+        return value
+
+    if get_changes is None and item_validator is None:
+        # leaf nodes: skip the wrapper
+        return check
+    return validator
+
+
+# ConfigSchema {{{1
+class ConfigSchema(object):
+    """A compiled config schema.
+
+    The top level schema node describes the config dict itself.
+
+    Attributes:
+      schema (dict): the schema
+      name (str): the config's name in error messages
+    """
+    def __init__(self, schema, name="config"):
+        self.schema = schema
+        self.name = name
+        self._check = compile_type_check(schema, name) or no_check
+        self._get_changes = compile_dict_changes(schema, name)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Load a json schema through parse_config_file().
+
+        Pass parse_cache=ParseCache(...) to skip reparsing an unchanged
+        schema file on the next run.
+
+        Args:
+          path (str): the path or url of the schema
+          **kwargs: kwargs for parse_config_file()
+
+        Returns:
+          ConfigSchema
+        """
+        from scriptharness.config import parse_config_file
+        return cls(parse_config_file(path, **kwargs))
+
+    def get_changes(self, config):
+        """Validate config, and get the top level keys to change.
+
+        Args:
+          config (dict): the config, or a LayeredConfig.  It isn't changed.
+
+        Returns:
+          changes (dict): the top level keys whose values need defaults or
+            coercion, and their new values
+
+        Raises:
+          ScriptHarnessException: with every error, if the config is invalid
+        """
+        errors = []
+        config = self._check(config, self.name, errors)
+        changes = {}
+        if not errors:
+            changes = self._get_changes(config, self.name, errors)
+        if errors:
+            raise ScriptHarnessException(
+                "Invalid config:\n  %s" % "\n  ".join(errors), errors
+            )
+        return changes
+
+    def validate(self, config):
+        """Validate config, and apply defaults and coercion.
+
+        Args:
+          config (dict): the config.  It isn't changed.
+
+        Returns:
+          config (dict): config, or a copy with the changes
+
+        Raises:
+          ScriptHarnessException: with every error, if the config is invalid
+        """
+        changes = self.get_changes(config)
+        if changes:
+            config = dict(config)
+            config.update(changes)
+        return config
@@ -9,18 +9,15 @@ Attributes:
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import codecs
+import io
 import logging
-import pprint
-from scriptharness.actions import Action, STRINGS
+from scriptharness.actions import Action, ERROR, STRINGS
 import scriptharness.config as shconfig
 from scriptharness.exceptions import ScriptHarnessException, ScriptHarnessFatal
 from scriptharness.structures import iterate_pairs, LoggingDict
+import six
 import sys
 import time
-try:
-    import simplejson as json
-except ImportError:
-    import json
 
 
 LOGGER_NAME = "scriptharness.script"
@@ -33,15 +30,34 @@ VALID_LISTENER_TIMING = (
 )
 
 
+def open_config_file(path):
+    """Open path to write a utf-8 json config to.
+
+    Args:
+      path (str): The path to write the config to
+
+    Returns:
+      filehandle: buffered, and accepting text
+    """
+    if six.PY2:
+        # python 2 json writes a mix of str and unicode chunks.
+        return codecs.open(path, 'w', encoding='utf-8')
+    return io.open(path, 'w', encoding='utf-8')
+
+
 def save_config(config, path):
     """Save the configuration file to path as json.
 
+    The json is streamed to a buffered filehandle, rather than built as one
+    big string first.
+
     Args:
       config (dict): The config to save
       path (str): The path to write the config to
     """
-    with codecs.open(path, 'w', encoding='utf-8') as filehandle:
-        filehandle.write(json.dumps(config, sort_keys=True, indent=4))
+    json = shconfig.get_json_module()
+    with open_config_file(path) as filehandle:
+        json.dump(config, filehandle, sort_keys=True, indent=4)
 
 # Script {{{1
 class Script(object):
@@ -53,12 +69,23 @@ class Script(object):
 
     Attributes:
       config (LoggingDict): the config for the script
+      layered_config (LayeredConfig): the layers config was resolved from
       strict (bool): In strict mode, warnings are fatal; config is read-only.
       actions (tuple): Action objects to run.
       listeners (dict): callbacks for run()
       logger (logging.Logger): the logger for the script
+      rollback_on_error (bool): if True, undo an action's config changes
+        when it hits a ScriptHarnessError.  This requires a config with
+        snapshot() support, like LoggingDict.
+      save_config_in_background (bool): if True, __init__ snapshots the
+        config, then writes localconfig.json on a background thread, and
+        run() waits for it at the end.
     """
     config = None
+    layered_config = None
+    rollback_on_error = False
+    save_config_in_background = False
+    _save_thread = None
 
     def __init__(self, actions, parser, **kwargs):
         """Script.__init__
@@ -79,7 +106,7 @@ class Script(object):
         self.build_config(parser, **kwargs)
         self.logger = self.get_logger()
         self.start_message()
-        self.save_config()
+        self.save_config(background=self.save_config_in_background)
 
     def __setattr__(self, name, *args):
         if name == 'config' and self.config:
@@ -88,36 +115,122 @@ class Script(object):
             )
         return super(Script, self).__setattr__(name, *args)
 
-    def build_config(self, parser, cmdln_args=None, initial_config=None):
+    def build_config(self, parser, cmdln_args=None, initial_config=None,
+                     **kwargs):
         """Create self.config from the parsed args.
 
         Args:
           parser (ArgumentParser): parser to use
           cmdln_args (tuple, optional): override the commandline args
           initial_config (dict, optional): initial config dict to apply
+          **kwargs: additional kwargs for scriptharness.config.build_config()
 
         Returns:
           parsed_args from parse_args()
         """
         parsed_args = shconfig.parse_args(parser, cmdln_args)
-        config = shconfig.build_config(parser, parsed_args, initial_config)
-        self.dict_to_config(config)
+        layered_config = shconfig.build_layered_config(
+            parser, parsed_args, initial_config, **kwargs
+        )
+        self.layered_config = layered_config
+        self.dict_to_config(dict(layered_config.iter_resolved()))
         self.enable_actions(parsed_args)
         if parsed_args.__dict__.get("dump_config"):
             logger = self.get_logger()
             logger.info("Dumping config:")
             self.save_config()
+            self.log_provenance(layered_config)
             sys.exit(0)
+        if parsed_args.__dict__.get("compile_config"):
+            logger = self.get_logger()
+            logger.info("Wrote config bundle %s.",
+                        parsed_args.compile_config)
+            sys.exit(0)
+
+    def log_provenance(self, layered_config):
+        """Log which layers each config value came from.
 
-    def save_config(self):
+        A value merged from several layers lists each of them, lowest first.
+
+        Args:
+          layered_config (LayeredConfig): from build_layered_config()
+        """
+        logger = self.get_logger()
+        logger.info("Config sources:")
+        provenance = layered_config.get_provenance(all_sources=True)
+        for key in sorted(provenance):
+            logger.info("    %s: %s", key, " + ".join(provenance[key]))
+
+    def save_config(self, background=False):
         """Save config to disk.
+
+        The config is only pretty-printed into the log if INFO is enabled.
+
+        Args:
+          background (bool, optional): if True, snapshot the config into
+            plain containers now, so later changes don't reach the file,
+            and stream it to disk on a background thread;
+            wait_for_save_config() joins it.
         """
         logger = self.get_logger()
-        logger.info(pprint.pformat(self.config, indent=4))
-        save_config(self.config, "localconfig.json")
+        if logger.isEnabledFor(logging.INFO):
+            import pprint
+            logger.info(pprint.pformat(self.config, indent=4))
+        self.wait_for_save_config()
+        if not background:
+            save_config(self.config, "localconfig.json")
+            return
+        from copy import deepcopy
+        import threading
+        # LoggingDict deepcopies into plain dicts and lists.  That's
+        # cheaper than json.dumps(), and doesn't hold the whole json
+        # string in memory.
+        config = deepcopy(self.config)
+        errors = []
+
+        def target():
+            """Save the config, keeping any exception for the join."""
+            try:
+                save_config(config, "localconfig.json")
+            except Exception as exc_info:  # pylint: disable=broad-except
+                errors.append(exc_info)
+
+        thread = threading.Thread(target=target, name="save_config")
+        thread.errors = errors
+        self._save_thread = thread
+        thread.start()
+
+    def wait_for_save_config(self, raise_errors=True):
+        """Join the background save_config() thread, if there is one.
+
+        Args:
+          raise_errors (bool, optional): if False, log a failed save rather
+            than raising, e.g. when another exception is on its way up.
+
+        Raises:
+          ScriptHarnessException: if the background save failed.
+        """
+        thread = self._save_thread
+        if thread is None:
+            return
+        thread.join()
+        self._save_thread = None
+        if thread.errors:
+            if not raise_errors:
+                logger = self.get_logger()
+                logger.error("Can't save config to localconfig.json: %s",
+                             thread.errors[0])
+                return
+            raise ScriptHarnessException(
+                "Can't save config to localconfig.json!", thread.errors[0]
+            )
 
     def dict_to_config(self, config):
         """Here for subclassing.
+
+        Args:
+          config (dict): the resolved config.  Its layers are in
+            self.layered_config.
         """
         self.config = LoggingDict(
             config, logger_name=config.get('logger_name', LOGGER_NAME)
@@ -194,8 +307,12 @@ class Script(object):
                 continue
             listener()
         logger.info(STRINGS['action']['run_message'], repl_dict)
+        snapshot = None
+        status = None
+        if self.rollback_on_error:
+            snapshot = self.config.snapshot()
         try:
-            action.run(self.config)
+            status = action.run(self.config)
         except ScriptHarnessFatal:
             for listener, actions in \
                     iterate_pairs(self.listeners['post_fatal']):
@@ -203,6 +320,11 @@ class Script(object):
                     continue
                 listener()
             raise
+        finally:
+            if snapshot is not None:
+                if status == ERROR:
+                    self.config.rollback(snapshot)
+                self.config.release(snapshot)
         for listener, actions in iterate_pairs(self.listeners['post_action']):
             if actions and action.name not in actions:
                 continue
@@ -250,10 +372,16 @@ class Script(object):
     def run(self):
         """Run all enabled actions.
         """
-        for listener, _ in iterate_pairs(self.listeners['pre_run']):
-            listener()
-        for action in self.actions:
-            self.run_action(action)
-        for listener, _ in iterate_pairs(self.listeners['post_run']):
-            listener()
+        finished = False
+        try:
+            for listener, _ in iterate_pairs(self.listeners['pre_run']):
+                listener()
+            for action in self.actions:
+                self.run_action(action)
+            for listener, _ in iterate_pairs(self.listeners['post_run']):
+                listener()
+            finished = True
+        finally:
+            # don't let a failed save mask the exception from an action
+            self.wait_for_save_config(raise_errors=finished)
         self.end_message()
@@ -5,6 +5,8 @@
 There are two config dict models here:: one is to recursively lock the
 dictionary.  This is to aid in debugging; one can assume the config hasn't
 changed from the moment of locking.  This is the original mozharness model.
+FrozenConfig is a smaller, hashable alternative to a locked ReadOnlyDict.
+LayeredConfig resolves a config from several layers without merging them.
 
 The second model is to log any changes to the dict or its children.  When
 debugging, config changes will be marked in the log.
@@ -19,29 +21,36 @@ Attributes:
     the values in the list/dict shouldn't be logged
   SUPPORTED_LOGGING_TYPES (dict): a non-logging to logging class map, e.g.
     dict: LoggingDict.  Not currently supporting sets or collections.
+  LIST_POLICIES (tuple): the valid DeepMerge list_policy values
 """
 
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
+from collections import deque
 from copy import deepcopy
 from scriptharness.exceptions import ScriptHarnessException
 import six
 import logging
-import pprint
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
 
 
 # Constants {{{1
 DEFAULT_LEVEL = logging.INFO
 DEFAULT_LOGGER_NAME = 'scriptharness.data_structures'
 QUOTES = ("'", '"', "'''", '"""')
+LIST_POLICIES = ("replace", "append", "merge")
 LOGGING_STRINGS = {
-    # position, self, item
+    # position, self, item, count
     "list": {
         "delitem": "__delitem__ %(item)s",
         "log_self": "now looks like %(self)s",
         "setitem": "__setitem__ %(position)d to %(item)s",
         "append": "appending %(item)s",
         "extend": "extending with %(item)s",
+        "extend_many": "extending with %(count)d items",
         "insert": "inserting %(item)s at position %(position)s",
         "remove": "removing %(item)s",
         "pop_no_args": "popping",
@@ -49,11 +58,12 @@ LOGGING_STRINGS = {
         "sort": "sorting",
         "reverse": "reversing",
     },
-    # key, value, default
+    # key, value, default, count
     "dict": {
         "delitem": "__delitem__ %(key)s",
         "setitem": "__setitem__ %(key)s to %(value)s",
         "clear": "clearing dict",
+        "rollback": "rolling back %(count)d change(s)",
         "pop": {
             "message_no_default": "popping dict key %(key)s",
             "message_default": "popping dict key %(key)s (default %(default)s)",
@@ -75,12 +85,13 @@ LOGGING_STRINGS = {
     },
 }
 MUTED_LOGGING_STRINGS = {
-    # position, self, item
+    # position, self, item, count
     "list": {
         "delitem": "__delitem__ %(item)s",
         "setitem": "__setitem__ %(position)d ...",
         "append": "appending ...",
         "extend": "extending ...",
+        "extend_many": "extending with %(count)d items",
         "insert": "inserting at position %(position)s",
         "remove": "removing ...",
         "pop_no_args": "popping",
@@ -88,11 +99,12 @@ MUTED_LOGGING_STRINGS = {
         "sort": "sorting",
         "reverse": "reversing",
     },
-    # key, value, default
+    # key, value, default, count
     "dict": {
         "delitem": "__delitem__ %(key)s",
         "setitem": "__setitem__ %(key)s ...",
         "clear": "clearing dict",
+        "rollback": "rolling back %(count)d change(s)",
         "pop": {
             "message_no_default": "popping dict key %(key)s",
             "message_default": "popping dict key %(key)s with default ...",
@@ -151,6 +163,14 @@ class LoggingClass(object):
     level = None
     logger_name = None
     logger_name = None
+    _journal = None
+    _snapshots = None
+    _version = 0
+    # True for from_pairs() results until a parent adopts them; see
+    # add_logging_to_obj().
+    _fresh = False
+    # True once recursively_set_parent() has run; see snapshot().
+    _parented = False
 
     def items(self):
         """Return dict.items() for dicts, and enumerate(self) for lists+tuples.
@@ -190,6 +210,7 @@ class LoggingClass(object):
                 child.recursively_set_parent(
                     child_name, self
                 )
+        self._parented = True
 
     def _child_set_parent(self, child, child_name):
         """If child is a Logging* instance, set its parent and name.
@@ -266,6 +287,47 @@ class LoggingClass(object):
             args.append(repl_dict)
         return logger.log(*args)
 
+    def journal_root(self):
+        """Get the top-level Logging* ancestor, which holds the undo journal.
+
+        Unlike ancestor_child_list(), this doesn't build the list of names,
+        so it's cheap enough to call on every change.
+
+        Returns:
+          ancestor (LoggingClass)
+        """
+        ancestor = self
+        while ancestor.parent is not None:
+            ancestor = ancestor.parent
+        return ancestor
+
+    def journaling(self):
+        """Is there an outstanding snapshot() on our ancestor?
+
+        Mutators that need to copy self to be able to undo a change check this
+        first, so we don't pay for the copy when nobody can roll back.
+
+        Returns:
+          bool
+        """
+        return bool(self.journal_root()._snapshots)  # pylint: disable=protected-access
+
+    def record_undo(self, undo, *args):
+        """Record how to undo a change that just happened to self.
+
+        This is a noop unless the ancestor has an outstanding snapshot(), so
+        the journal only costs anything while someone may roll back.
+
+        Args:
+          undo (function): called as undo(*args) by rollback().
+          *args: the args to send to undo.
+        """
+        root = self.journal_root()
+        # pylint: disable=protected-access
+        if root._snapshots:
+            root._version += 1
+            root._journal.append((root._version, undo, args))
+
 
 # LoggingList {{{2
 class LoggingList(LoggingClass, list):
@@ -287,6 +349,31 @@ class LoggingList(LoggingClass, list):
                                 level=level, muted=self.muted) for x in items]
         )
 
+    @classmethod
+    def from_iter(cls, iterable, level=DEFAULT_LEVEL, muted=False,
+                  logger_name=DEFAULT_LOGGER_NAME):
+        """Create a LoggingList from any iterable, in a single pass.
+
+        Unlike LoggingList(items), this doesn't need the items in a list
+        first, so generators of discovered files or test names don't need
+        to be materialized twice.
+
+        Args:
+          iterable (iterable): the items to add
+          level (int, optional): the logging level for changes
+          muted (bool, optional): whether our logging messages are muted
+          logger_name (str, optional): the logger name to use
+
+        Returns:
+          LoggingList
+        """
+        loglist = cls([], level=level, muted=muted, logger_name=logger_name)
+        list.extend(loglist, (
+            add_logging_to_obj(x, logger_name=logger_name, level=level,
+                               muted=muted) for x in iterable
+        ))
+        return loglist
+
     def __deepcopy__(self, memo):
         """Return a list on deepcopy.
         """
@@ -295,10 +382,14 @@ class LoggingList(LoggingClass, list):
     def __delitem__(self, item):
         self.log_change(self.strings['delitem'],
                         repl_dict={'item': item})
-        position = item
         if isinstance(item, slice):
             position = item.start
+            undo_args = self.get_undo_args()
+        else:
+            position = self.get_index(item)
+            undo_args = (position, position, [self[position]])
         super(LoggingList, self).__delitem__(item)
+        self.record_undo(self._undo_splice, *undo_args)
         self.log_self()
         if position < len(self):
             self.child_set_parent(position)
@@ -308,12 +399,33 @@ class LoggingList(LoggingClass, list):
             self.strings['setitem'],
             repl_dict={'position': position, 'item': item}
         )
+        if isinstance(position, slice):
+            undo_args = self.get_undo_args()
+        else:
+            index = self.get_index(position)
+            undo_args = (index, index + 1, [self[index]])
         item = add_logging_to_obj(item, logger_name=self.logger_name,
                                   level=self.level, muted=self.muted)
         super(LoggingList, self).__setitem__(position, item)
+        self.record_undo(self._undo_splice, *undo_args)
         self.log_self()
         self.child_set_parent(position)
 
+    def __iadd__(self, other):
+        """Journal list += other like extend().
+        """
+        self.extend(other)
+        return self
+
+    def __imul__(self, count):
+        """Journal list *= count as an extend() or a delete.
+        """
+        if count < 1:
+            del self[0:len(self)]
+        else:
+            self.extend(list(self) * (count - 1))
+        return self
+
     def child_set_parent(self, position=0):
         """When the list changes, we either want to change all of the
         children's names (which correspond to indeces) or a subset of
@@ -322,6 +434,46 @@ class LoggingList(LoggingClass, list):
         for count, elem in enumerate(self, start=position):
             self._child_set_parent(elem, int(count))
 
+    def get_index(self, position):
+        """Get the non-negative index for an int position in self.
+
+        Args:
+          position (int): the position, which may be negative.
+
+        Returns:
+          index (int)
+        """
+        if position < 0:
+            position += len(self)
+        return position
+
+    def get_undo_args(self):
+        """Get the undo_splice() args to restore all of self.
+
+        This is for the changes that can move any or all of the items, e.g.
+        sort().  It copies self, so only do it when we're journaling.
+
+        Returns:
+          undo_args (tuple): (start, stop, items) for _undo_splice()
+        """
+        if self.journaling():
+            return (0, len(self), list(self))
+        return (0, 0, [])
+
+    def _undo_splice(self, start, stop, items):
+        """Undo a change by replacing self[start:stop] with items.
+
+        This doesn't log; rollback() logs a single message instead.
+
+        Args:
+          start (int): the start of the slice to replace
+          stop (int): the end of the slice to replace
+          items (list): the items that were there before the change
+        """
+        list.__setitem__(self, slice(start, stop), items)
+        for index in range(start, len(self)):
+            self._child_set_parent(self[index], index)
+
     def log_self(self):
         """Log the current list.
 
@@ -329,6 +481,7 @@ class LoggingList(LoggingClass, list):
         debug things if we log the list after those operations.
         """
         if self.strings.get('log_self'):
+            import pprint
             self.log_change(self.strings['log_self'],
                             repl_dict={'self': pprint.pformat(self)})
 
@@ -339,10 +492,12 @@ class LoggingList(LoggingClass, list):
             add_logging_to_obj(item, logger_name=self.logger_name,
                                level=self.level, muted=self.muted)
         )
+        self.record_undo(self._undo_splice, len(self) - 1, len(self), [])
         self.log_self()
         self.child_set_parent(len(self) - 1)
 
     def extend(self, item):
+        import pprint
         position = len(self)
         self.log_change(self.strings['extend'],
                         repl_dict={'item': pprint.pformat(item)})
@@ -350,9 +505,38 @@ class LoggingList(LoggingClass, list):
             add_logging_to_obj(item, logger_name=self.logger_name,
                                level=self.level, muted=self.muted)
         )
+        self.record_undo(self._undo_splice, position, len(self), [])
         self.log_self()
         self.child_set_parent(position)
 
+    def extend_many(self, iterable):
+        """Extend with a large number of items.
+
+        extend() wraps the whole argument in a temporary LoggingList and logs
+        all of it, then re-parents the list.  extend_many() consumes the
+        iterable in a single pass, wraps each child once, only re-parents
+        the new children, and logs a single summary message.
+
+        Args:
+          iterable (iterable): the items to add
+
+        Returns:
+          count (int): the number of items added
+        """
+        position = len(self)
+        super(LoggingList, self).extend(
+            add_logging_to_obj(x, logger_name=self.logger_name,
+                               level=self.level, muted=self.muted)
+            for x in iterable
+        )
+        count = len(self) - position
+        self.record_undo(self._undo_splice, position, len(self), [])
+        self.log_change(self.strings['extend_many'],
+                        repl_dict={'count': count})
+        for index in range(position, len(self)):
+            self._child_set_parent(self[index], index)
+        return count
+
     def insert(self, position, item):
         self.log_change(
             self.strings['insert'],
@@ -361,10 +545,12 @@ class LoggingList(LoggingClass, list):
                 'position': position
             }
         )
+        index = min(max(self.get_index(position), 0), len(self))
         super(LoggingList, self).insert(
             position, add_logging_to_obj(item, logger_name=self.logger_name,
                                          level=self.level, muted=self.muted)
         )
+        self.record_undo(self._undo_splice, index, index + 1, [])
         self.log_self()
         self.child_set_parent(position)
 
@@ -372,7 +558,9 @@ class LoggingList(LoggingClass, list):
         self.log_change(self.strings['remove'],
                         repl_dict={'item': item})
         position = self.index(item)
+        value = self[position]
         super(LoggingList, self).remove(item)
+        self.record_undo(self._undo_splice, position, position, [value])
         self.log_self()
         if position < len(self):
             self.child_set_parent(position)
@@ -381,12 +569,15 @@ class LoggingList(LoggingClass, list):
         if position is None:
             self.log_change(self.strings['pop_no_args'])
             value = super(LoggingList, self).pop()
+            index = len(self)
         else:
             self.log_change(
                 self.strings['pop_args'],
                 repl_dict={'position': position}
             )
+            index = self.get_index(position)
             value = super(LoggingList, self).pop(position)
+        self.record_undo(self._undo_splice, index, index, [value])
         self.log_self()
         if position is not None:
             self.child_set_parent(position)
@@ -394,13 +585,17 @@ class LoggingList(LoggingClass, list):
 
     def sort(self, *args, **kwargs):
         self.log_change(self.strings['sort'])
+        undo_args = self.get_undo_args()
         super(LoggingList, self).sort(*args, **kwargs)
+        self.record_undo(self._undo_splice, *undo_args)
         self.log_self()
         self.child_set_parent()
 
     def reverse(self):
         self.log_change(self.strings['reverse'])
+        undo_args = self.get_undo_args()
         super(LoggingList, self).reverse()
+        self.record_undo(self._undo_splice, *undo_args)
         self.log_self()
         self.child_set_parent()
 
@@ -444,6 +639,36 @@ class LoggingDict(LoggingClass, dict):
             )
         super(LoggingDict, self).__init__(items)
 
+    @classmethod
+    def from_pairs(cls, pairs, level=DEFAULT_LEVEL, muted=False,
+                   logger_name=DEFAULT_LOGGER_NAME):
+        """Create a LoggingDict from key/value pairs, in a single pass.
+
+        LoggingDict(items) needs a dict, and rewrites each of its values in
+        place before copying it.  This consumes any iterable of pairs (or
+        data structure accepted by iterate_pairs()) directly, without the
+        intermediate dict.
+
+        Args:
+          pairs (iterable): key/value pairs
+          level (int, optional): the logging level for changes
+          muted (bool, optional): whether our logging messages are muted
+          logger_name (str, optional): the logger name to use
+
+        Returns:
+          LoggingDict
+        """
+        if isinstance(pairs, (dict, list, tuple)):
+            pairs = iterate_pairs(pairs)
+        logdict = cls({}, level=level, muted=muted, logger_name=logger_name)
+        dict.update(logdict, (
+            (key, add_logging_to_obj(value, logger_name=logger_name,
+                                     level=level, muted=muted))
+            for key, value in pairs
+        ))
+        logdict._fresh = True  # pylint: disable=protected-access
+        return logdict
+
     def __setitem__(self, key, value):
         repl_dict = {'key': key, 'value': value}
         self.log_change(
@@ -452,13 +677,22 @@ class LoggingDict(LoggingClass, dict):
         )
         value = add_logging_to_obj(value, logger_name=self.logger_name,
                                    level=self.level, muted=self.muted)
+        self.record_key_undo(key)
         super(LoggingDict, self).__setitem__(key, value)
         self.child_set_parent(key)
 
     def __delitem__(self, key):
         self.log_change(self.strings['delitem'],
                         repl_dict={'key': key})
+        value = self[key]
         super(LoggingDict, self).__delitem__(key)
+        self.record_undo(self._undo_setitem, key, value)
+
+    def __ior__(self, other):
+        """Journal dict |= other like update().
+        """
+        self.update(other)
+        return self
 
     def child_set_parent(self, key):
         """When the dict changes, we can just target the specific changed
@@ -469,8 +703,37 @@ class LoggingDict(LoggingClass, dict):
         """
         self._child_set_parent(self[key], key)
 
+    def record_key_undo(self, key):
+        """Record how to restore self[key] before it changes.
+
+        Args:
+            key (str): the dict key that is about to change.
+        """
+        if key in self:
+            self.record_undo(self._undo_setitem, key, self[key])
+        else:
+            self.record_undo(self._undo_delitem, key)
+
+    def _undo_setitem(self, key, value):
+        """Undo a change by restoring self[key] to value, without logging.
+        """
+        dict.__setitem__(self, key, value)
+        self._child_set_parent(value, key)
+
+    def _undo_delitem(self, key):
+        """Undo a change by removing a key that didn't exist, without logging.
+        """
+        dict.__delitem__(self, key)
+
+    def _undo_clear(self, contents):
+        """Undo a clear() by restoring the contents, without logging.
+        """
+        dict.update(self, contents)
+
     def clear(self):
         self.log_change(self.strings['clear'])
+        if self.journaling():
+            self.record_undo(self._undo_clear, dict(self))
         super(LoggingDict, self).clear()
 
     def pop(self, key, default=None):
@@ -483,6 +746,8 @@ class LoggingDict(LoggingClass, dict):
         else:
             message = self.strings['pop']['message_no_default']
         self.log_change(message, repl_dict=repl_dict)
+        if key in self:
+            self.record_undo(self._undo_setitem, key, self[key])
         return super(LoggingDict, self).pop(key, *args)
 
     def popitem(self):
@@ -491,6 +756,7 @@ class LoggingDict(LoggingClass, dict):
         status = super(LoggingDict, self).popitem()
         post_keys = set(self.keys())
         key = list(pre_keys.difference(post_keys))
+        self.record_undo(self._undo_setitem, *status)
         self.log_change(
             self.strings['popitem']['changed'],
             repl_dict={'key': key[0]},
@@ -515,6 +781,7 @@ class LoggingDict(LoggingClass, dict):
         if not changed:
             message = self.strings['setdefault']['unchanged']
         else:
+            self.record_undo(self._undo_delitem, key)
             repl_dict['value'] = status
             message = self.strings['setdefault']['changed']
         self.log_change(message, repl_dict=repl_dict)
@@ -548,6 +815,7 @@ class LoggingDict(LoggingClass, dict):
         new_args = {}
         for key, value in iterate_pairs(args):
             changed_keys.append(self.log_update(key, value))
+            self.record_key_undo(key)
             new_args[key] = add_logging_to_obj(
                 value, logger_name=self.logger_name, level=self.level,
                 muted=self.muted
@@ -565,6 +833,84 @@ class LoggingDict(LoggingClass, dict):
             )
             self.child_set_parent(key)
 
+    def snapshot(self):
+        """Mark the current state of the config, to be able to rollback().
+
+        This doesn't copy anything: it starts (or continues) an undo journal
+        on our ancestor, and every change to the ancestor or its children
+        records how to undo itself until the snapshot is release()d.  The
+        snapshot covers the whole ancestor, not just self.
+
+        Children find the journal through their parents, so if
+        recursively_set_parent() hasn't been called on the ancestor yet,
+        it's called here, once.
+
+        Returns:
+          snapshot (int): the journal version to pass to rollback() and
+            release().
+        """
+        root = self.journal_root()
+        # pylint: disable=protected-access
+        if not root._parented:
+            root.recursively_set_parent()
+        if not root._snapshots:
+            root._snapshots = []
+            root._journal = deque()
+        root._snapshots.append(root._version)
+        return root._version
+
+    def rollback(self, snapshot):
+        """Undo all changes since snapshot(), newest first.
+
+        This only walks the changes made since the snapshot, so the cost
+        doesn't depend on the size of the config.  The snapshot stays valid
+        until it's release()d; any snapshots taken after it are dropped.
+
+        Args:
+          snapshot (int): the return value of snapshot().
+
+        Returns:
+          count (int): the number of changes undone.
+
+        Raises:
+          ScriptHarnessException: if snapshot isn't outstanding.
+        """
+        root = self.journal_root()
+        # pylint: disable=protected-access
+        if not root._snapshots or snapshot not in root._snapshots:
+            raise ScriptHarnessException(
+                "Can't rollback to an unknown or released snapshot!", snapshot
+            )
+        count = 0
+        while root._journal and root._journal[-1][0] > snapshot:
+            _, undo, args = root._journal.pop()
+            undo(*args)
+            count += 1
+        root._snapshots = [x for x in root._snapshots if x <= snapshot]
+        self.log_change(self.strings['rollback'], repl_dict={'count': count})
+        return count
+
+    def release(self, snapshot):
+        """Release a snapshot that we no longer need to rollback() to.
+
+        Once there are no outstanding snapshots, the journal is discarded
+        and changes stop being recorded.
+
+        Args:
+          snapshot (int): the return value of snapshot().
+        """
+        root = self.journal_root()
+        # pylint: disable=protected-access
+        if root._snapshots and snapshot in root._snapshots:
+            root._snapshots.remove(snapshot)
+        if not root._snapshots:
+            root._snapshots = None
+            root._journal = None
+            return
+        oldest = min(root._snapshots)
+        while root._journal and root._journal[0][0] <= oldest:
+            root._journal.popleft()
+
     def __deepcopy__(self, memo):
         """Return a dict on deepcopy()
         """
@@ -593,12 +939,31 @@ def add_logging_to_obj(item, **kwargs):
     Any children of supported types will also have logging enabled.
     Currently supported:: list, tuple, dict.
 
+    A LoggingDict fresh from LoggingDict.from_pairs(), e.g. one that
+    parse_config_file() built with target=LoggingDict.from_pairs, is
+    adopted as-is rather than copied, if it has the same level, muted and
+    logger_name settings.  Only the first adoption skips the copy; any
+    other LoggingDict or LoggingList may still belong to the caller, so it
+    is copied.
+
     Args:
       item (object): a child of a LoggingDict.
 
     Returns:
       A logging version of item, when applicable, or item.
     """
+    if not isinstance(item, (dict, list, tuple)):
+        # the common case: scalars
+        return item
+    # pylint: disable=protected-access
+    if isinstance(item, LoggingDict) and item._fresh and \
+            item.parent is None and item.name is None and \
+            item.logger_name == kwargs.get('logger_name',
+                                           DEFAULT_LOGGER_NAME) and \
+            item.level == kwargs.get('level', DEFAULT_LEVEL) and \
+            item.muted == kwargs.get('muted', False):
+        item._fresh = False
+        return item
     result = item
     for key, value in SUPPORTED_LOGGING_TYPES.items():
         if isinstance(item, key):
@@ -623,7 +988,7 @@ def get_strings(instance_type, muted=False):
 
 
 # ReadOnlyDict {{{1
-def make_immutable(item):
+def make_immutable(item, frozen=False):
     """Recursively lock all contents of a ReadOnlyDict.
 
     Any children of supported types will also be locked.
@@ -635,15 +1000,22 @@ def make_immutable(item):
 
     Args:
       item (object): a child of a ReadOnlyDict.
+      frozen (bool, optional): create FrozenConfigs rather than locked
+        ReadOnlyDicts for dicts.
 
     Returns:
       A locked version of item, when applicable, or item.
     """
     if isinstance(item, list) or isinstance(item, tuple):
-        result = LockedTuple(item)
+        result = LockedTuple(item, frozen=frozen)
+    elif isinstance(item, FrozenConfig):
+        result = item
     elif isinstance(item, dict):
-        result = ReadOnlyDict(item)
-        result.lock()
+        if frozen:
+            result = FrozenConfig(item)
+        else:
+            result = ReadOnlyDict(item)
+            result.lock()
     else:
         result = item
     return result
@@ -657,8 +1029,10 @@ class LockedTuple(tuple):
 
     Taken straight from mozharness.
     """
-    def __new__(cls, items):
-        return tuple.__new__(cls, (make_immutable(x) for x in items))
+    def __new__(cls, items, frozen=False):
+        return tuple.__new__(
+            cls, (make_immutable(x, frozen=frozen) for x in items)
+        )
     def __deepcopy__(self, memo):
         """Return a list on deepcopy.
         """
@@ -699,6 +1073,14 @@ class ReadOnlyDict(dict):
             self[key] = make_immutable(value)
         self._lock = True
 
+    def freeze(self):
+        """Create a FrozenConfig with the same contents.
+
+        Returns:
+          FrozenConfig
+        """
+        return FrozenConfig(self)
+
     def __setitem__(self, *args):
         self._check_lock()
         return super(ReadOnlyDict, self).__setitem__(*args)
@@ -735,3 +1117,380 @@ class ReadOnlyDict(dict):
         for key, value in self.items():
             result[key] = deepcopy(value, memo)
         return result
+
+
+# FrozenConfig {{{1
+class FrozenConfig(dict):
+    """A read-only, hashable config dict.
+
+    A locked ReadOnlyDict still pays for its lock: __setattr__ is overridden,
+    every mutator checks _lock, and each instance has a __dict__.
+    FrozenConfig's mutators always raise without checking a lock, it has no
+    instance __dict__, so each nested dict is smaller, and its children are
+    recursively frozen, so it's hashable.  Lookups cost about the same as
+    ReadOnlyDict's; both are slower than a plain dict's.
+
+    types.MappingProxyType would also be read-only, but it isn't available
+    in python 2.7, and it isn't json serializable, which save_config()
+    needs.
+
+    Attributes:
+      _hash (int): the cached hash
+    """
+    __slots__ = ('_hash',)
+
+    def __new__(cls, *args, **kwargs):
+        self = super(FrozenConfig, cls).__new__(cls)
+        # Updating from a plain dict, rather than a generator, gives us a
+        # compact table, which is measurably faster to read.
+        dict.update(self, dict(
+            (key, make_immutable(value, frozen=True))
+            for key, value in dict(*args, **kwargs).items()
+        ))
+        self._hash = None
+        return self
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """__new__ has already populated the dict; dict.__init__ would
+        update() it again.
+        """
+        super(FrozenConfig, self).__init__()
+
+    def _read_only(self, *args, **kwargs):
+        """Raise on any attempt to change the FrozenConfig.
+        """
+        raise ScriptHarnessException("FrozenConfig is read-only!", args,
+                                     kwargs)
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    __ior__ = _read_only
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        """Return an unfrozen dict on deepcopy()
+        """
+        result = {}
+        memo[id(self)] = result
+        for key, value in self.items():
+            result[key] = deepcopy(value, memo)
+        return result
+
+
+# DeepMerge {{{1
+class DeepMerge(object):
+    """Recursively merge an overlay config into a base config.
+
+    Only the keys in the overlay are walked, and the base is never changed:
+    each dict along the path to an overlay key is shallow copied, and every
+    other subtree is shared with the base.  So the cost depends on the size
+    of the overlay, and the width of the dicts it touches, rather than the
+    size of the base.
+
+    Dicts are merged key by key.  Lists are merged per list_policy::
+
+      * "replace": the overlay list replaces the base list, like
+        dict.update()
+      * "append": the overlay items are appended to the base items
+      * "merge": dict items with the same merge_key value are merged;
+        any other overlay items are appended
+
+    Any other overlay value replaces the base value.
+
+    Attributes:
+      list_policy (str): one of LIST_POLICIES
+      merge_key (str): the key that identifies dict items in a list, for
+        the "merge" list_policy
+    """
+    def __init__(self, list_policy="replace", merge_key="name"):
+        if list_policy not in LIST_POLICIES:
+            raise ScriptHarnessException(
+                "Unknown list_policy!", list_policy, LIST_POLICIES
+            )
+        self.list_policy = list_policy
+        self.merge_key = merge_key
+
+    def __call__(self, base, overlay):
+        """Merge overlay into base.
+
+        Args:
+          base (object): the lower precedence value
+          overlay (object): the higher precedence value
+
+        Returns:
+          the merged value.  Unchanged subtrees of base and overlay are
+            shared, not copied.
+        """
+        if isinstance(overlay, dict) and isinstance(base, dict):
+            return self.merge_dicts(base, overlay)
+        if isinstance(overlay, list) and isinstance(base, list):
+            return self.merge_lists(base, overlay)
+        return overlay
+
+    def merge_dicts(self, base, overlay):
+        """Merge two dicts, copying base only at this level.
+
+        Args:
+          base (dict): the lower precedence dict
+          overlay (dict): the higher precedence dict
+
+        Returns:
+          merged (dict)
+        """
+        if not overlay:
+            return base
+        merged = dict(base)
+        for key, value in overlay.items():
+            if key in merged:
+                value = self(merged[key], value)
+            merged[key] = value
+        return merged
+
+    def merge_lists(self, base, overlay):
+        """Merge two lists per list_policy.
+
+        Args:
+          base (list): the lower precedence list
+          overlay (list): the higher precedence list
+
+        Returns:
+          merged (list)
+        """
+        if self.list_policy == "replace":
+            return overlay
+        if self.list_policy == "append":
+            return base + overlay
+        merged = list(base)
+        positions = {}
+        for position, item in enumerate(base):
+            if isinstance(item, dict) and self.merge_key in item:
+                positions.setdefault(item[self.merge_key], position)
+        for item in overlay:
+            position = None
+            if isinstance(item, dict) and self.merge_key in item:
+                position = positions.get(item[self.merge_key])
+            if position is None:
+                merged.append(item)
+            else:
+                merged[position] = self.merge_dicts(merged[position], item)
+        return merged
+
+
+# LayeredConfig {{{1
+class LayeredConfig(Mapping):
+    """A read-only view of a stack of config layers.
+
+    build_config() used to merge the parser defaults, initial config, config
+    files and commandline args with successive dict.update() calls, copying
+    every key once per layer.  LayeredConfig keeps each layer as-is, and
+    resolves a key by looking it up in each layer from the top (the highest
+    precedence) down.  Like dict.update(), only the top level keys are
+    layered; a dict in a higher layer replaces, rather than merges with, the
+    same key in a lower layer.
+
+    It knows which layer supplied each value, and flatten() builds the final
+    LoggingDict in a single pass.
+
+    With a merge function, e.g. a DeepMerge, the dicts and lists in each
+    layer are merged with the same key in the layers below it instead.
+
+    Attributes:
+      layers (list): (name, mapping) tuples, lowest precedence first
+      merge (callable): if set, merge(lower_value, higher_value) resolves
+        keys with container values in more than one layer
+      replacing_layers (set): the names of the layers whose values replace
+        the values below them, even with a merge function
+    """
+    def __init__(self, layers=None, merge=None):
+        self.layers = []
+        self.merge = merge
+        self.replacing_layers = set()
+        self._keys = None
+        for name, mapping in layers or []:
+            self.add_layer(name, mapping)
+
+    def add_layer(self, name, mapping, replace=False):
+        """Add a layer on top of the existing layers.
+
+        The mapping isn't copied, so changing it later changes the
+        LayeredConfig.
+
+        Args:
+          name (str): the layer name, e.g. a config file path
+          mapping (dict): the layer's config
+          replace (bool, optional): if True, the layer's values replace the
+            values below them rather than being merged with them, e.g.
+            because they're already resolved values.
+        """
+        self.layers.append((name, mapping))
+        if replace:
+            self.replacing_layers.add(name)
+        self._keys = None
+
+    def get_layer(self, key):
+        """Find the layer that supplies key.
+
+        Args:
+          key (str): the config key
+
+        Returns:
+          (name, mapping) tuple of the highest precedence layer with key
+
+        Raises:
+          KeyError: if no layer has key
+        """
+        for layer in reversed(self.layers):
+            if key in layer[1]:
+                return layer
+        raise KeyError(key)
+
+    def get_source(self, key):
+        """Find the name of the layer that supplies key.
+
+        Args:
+          key (str): the config key
+
+        Returns:
+          name (str)
+
+        Raises:
+          KeyError: if no layer has key
+        """
+        return self.get_layer(key)[0]
+
+    def get_sources(self, key):
+        """Find the names of every layer that contributes to key's value.
+
+        Without merge, that's just get_source().  With merge, it's each
+        layer whose value is merged, down to the first scalar or replacing
+        layer.
+
+        Args:
+          key (str): the config key
+
+        Returns:
+          names (list): lowest layer first
+
+        Raises:
+          KeyError: if no layer has key
+        """
+        if self.merge is None:
+            return [self.get_source(key)]
+        return [name for name, _ in reversed(self._get_merged_layers(key))]
+
+    def get_provenance(self, all_sources=False):
+        """Map each key to the name of the layer that supplies its value.
+
+        With merge, a key whose value is merged from several layers maps to
+        the top one, unless all_sources is True.
+
+        Args:
+          all_sources (bool, optional): map each key to get_sources(key)
+            instead.
+
+        Returns:
+          provenance (dict): key: layer name, or key: list of layer names
+        """
+        if all_sources:
+            return dict((key, self.get_sources(key)) for key in self)
+        provenance = {}
+        for name, mapping in self.layers:
+            for key in mapping:
+                provenance[key] = name
+        return provenance
+
+    def _get_merged_layers(self, key):
+        """Get the (name, value) of each layer merged into key's value.
+
+        Returns:
+          layers (list): top layer first, down to the first scalar or
+            replacing layer
+
+        Raises:
+          KeyError: if no layer has key
+        """
+        layers = []
+        for name, mapping in reversed(self.layers):
+            if key in mapping:
+                layers.append((name, mapping[key]))
+                if name in self.replacing_layers or \
+                        not isinstance(layers[-1][1], (dict, list)):
+                    # a scalar replaces everything below it
+                    break
+        if not layers:
+            raise KeyError(key)
+        return layers
+
+    def __getitem__(self, key):
+        if self.merge is None:
+            return self.get_layer(key)[1][key]
+        values = [value for _, value in self._get_merged_layers(key)]
+        value = values.pop()
+        while values:
+            value = self.merge(value, values.pop())
+        return value
+
+    def __contains__(self, key):
+        for _, mapping in self.layers:
+            if key in mapping:
+                return True
+        return False
+
+    def _get_keys(self):
+        """Get the set of keys across all layers, cached until add_layer().
+        """
+        if self._keys is None:
+            self._keys = set()
+            for _, mapping in self.layers:
+                self._keys.update(mapping)
+        return self._keys
+
+    def __iter__(self):
+        return iter(self._get_keys())
+
+    def __len__(self):
+        return len(self._get_keys())
+
+    def iter_resolved(self):
+        """Iterate over the resolved (key, value) pairs.
+
+        Each key is resolved once, walking the layers from the top, so
+        values hidden by a higher layer are never touched.
+
+        Yields:
+          (key, value) tuples
+        """
+        if self.merge is not None:
+            for key in self._get_keys():
+                yield key, self[key]
+            return
+        seen = set()
+        for _, mapping in reversed(self.layers):
+            for key, value in mapping.items():
+                if key not in seen:
+                    seen.add(key)
+                    yield key, value
+
+    def flatten(self, **kwargs):
+        """Build a LoggingDict of the resolved config, in a single pass.
+
+        Args:
+          **kwargs: kwargs for LoggingDict.from_pairs(), e.g. logger_name
+
+        Returns:
+          LoggingDict
+        """
+        return LoggingDict.from_pairs(self.iter_resolved(), **kwargs)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.layers)
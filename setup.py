@@ -26,10 +26,16 @@ setup(
     author_email='aki@escapewindow.com',
     url='https://github.com/escapewindow/scriptharness',
     license='MPL2',
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'ez_setup', 'examples',
+                                    'tests']),
     include_package_data=True,
     zip_safe=False,
     install_requires=dependencies,
+    extras_require={
+        'msgpack': ['msgpack'],
+        'toml': ['toml'],
+        'yaml': ['PyYAML'],
+    },
     entry_points="""
 # -*- Entry points: -*-
 """,
@@ -11,7 +11,10 @@ from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 from contextlib import contextmanager
 import os
+import requests
+import subprocess
 import sys
+import time
 
 
 UNICODE_STRINGS = [
@@ -95,3 +98,37 @@ def stdstar_redirected(path):
             stderr.flush()
             os.dup2(copied_out.fileno(), 1)  # $ exec >&copied
             os.dup2(copied_err.fileno(), 2)  # $ exec >&copied
+
+
+@contextmanager
+def start_webserver():
+    """Start a webserver for local requests testing
+    """
+    port = 8001
+    max_wait = 5
+    wait = 0
+    interval = .02
+    host = "http://localhost:%s" % str(port)
+    dir_path = os.path.join(os.path.dirname(__file__), 'http')
+    file_path = os.path.join(dir_path, 'cgi_server.py')
+    proc = subprocess.Popen([sys.executable, file_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    while wait < max_wait:
+        try:
+            response = requests.get(host)
+            if response.status_code == 200:
+                break
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(interval)
+        wait += interval
+    try:
+        yield (dir_path, host)
+    finally:
+        proc.terminate()
+        # make sure it goes away
+        try:
+            while True:
+                response = requests.get(host)
+        except requests.exceptions.ConnectionError:
+            pass
@@ -1,10 +1,97 @@
 #!/usr/bin/env python
 """Serve the test files for requests testing
+
+Requests are handled in threads, so concurrent downloads can be tested.
+Add ?delay=SECONDS to any url to sleep that long before responding.
+
+Static files are served with an ETag and Accept-Ranges, and honor
+If-None-Match, Range (bytes=START- or bytes=START-END) and If-Range
+requests.  Add ?drop=BYTES to a static file url to close the connection
+after sending that many bytes of the body, to test resuming.
 """
 
+import hashlib
 import os
 from six.moves.CGIHTTPServer import CGIHTTPRequestHandler
 from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+import six.moves.urllib as urllib
+import time
+
+
+class TestRequestHandler(CGIHTTPRequestHandler):
+    """CGIHTTPRequestHandler with test hooks.
+    """
+    def do_GET(self):
+        """Sleep for ?delay=SECONDS, if specified, then serve the request.
+        """
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        if 'delay' in query:
+            time.sleep(float(query['delay'][0]))
+        path = self.translate_path(parsed.path)
+        if self.is_cgi() or not os.path.isfile(path):
+            return CGIHTTPRequestHandler.do_GET(self)
+        return self.send_static_file(path, query)
+
+    def do_HEAD(self):
+        """Send the static file headers, without the body.
+        """
+        parsed = urllib.parse.urlparse(self.path)
+        path = self.translate_path(parsed.path)
+        if self.is_cgi() or not os.path.isfile(path):
+            return CGIHTTPRequestHandler.do_HEAD(self)
+        return self.send_static_file(path, {}, head=True)
+
+    def send_static_file(self, path, query, head=False):
+        """Serve a static file with ETag, Range and ?drop= support.
+        """
+        with open(path, 'rb') as filehandle:
+            contents = filehandle.read()
+        etag = '"%s"' % hashlib.md5(contents).hexdigest()
+        total = len(contents)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and if_range in (None, etag):
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            if end:
+                contents = contents[:int(end) + 1]
+            if start >= len(contents):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % total)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(contents) - 1, total))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(contents) - start))
+        self.end_headers()
+        if head:
+            return
+        body = contents[start:]
+        if 'drop' in query:
+            body = body[:int(query['drop'][0])]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle each request in a new thread.
+    """
+    daemon_threads = True
+
 
 def start_webserver(port=8001):
     """Start the webserver.
@@ -15,7 +102,7 @@ def start_webserver(port=8001):
     path = os.path.dirname(__file__)
     os.chdir(path)
     server_address = ("127.0.0.1", port)
-    httpd = HTTPServer(server_address, CGIHTTPRequestHandler)
+    httpd = ThreadedHTTPServer(server_address, TestRequestHandler)
     httpd.serve_forever()
 
 start_webserver()
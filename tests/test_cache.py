@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test scriptharness/cache.py
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import hashlib
+import json
+import mock
+import os
+import requests
+import scriptharness.cache as cache
+import scriptharness.config as shconfig
+from scriptharness.exceptions import ScriptHarnessException
+import shutil
+import stat
+import tempfile
+import unittest
+
+from . import start_webserver
+
+
+# TestHttpCache {{{1
+class TestHttpCache(unittest.TestCase):
+    """Test HttpCache
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, http_cache, url):
+        """Fetch url through http_cache, counting the requests.
+
+        Returns:
+          (body_path, mock of session.get) tuple
+        """
+        with mock.patch.object(self.session, 'get',
+                               wraps=self.session.get) as get:
+            path = http_cache.fetch(url, session=self.session)
+        return path, get
+
+    @staticmethod
+    def read(path):
+        """Read a file's contents"""
+        with open(path, 'rb') as filehandle:
+            return filehandle.read()
+
+    def test_conditional_get(self):
+        """The second fetch revalidates with If-None-Match
+        """
+        http_cache = cache.HttpCache(self.cache_dir)
+        with start_webserver() as (path, host):
+            url = "%s/test_config.json" % host
+            body_path, get = self.fetch(http_cache, url)
+            self.assertFalse('If-None-Match' in get.call_args[1]['headers'])
+            metadata = http_cache.get_metadata(url)
+            body_path2, get = self.fetch(http_cache, url)
+            self.assertTrue('If-None-Match' in get.call_args[1]['headers'])
+        self.assertEqual(body_path, body_path2)
+        self.assertEqual(self.read(body_path),
+                         self.read(os.path.join(path, "test_config.json")))
+        self.assertTrue(http_cache.get_metadata(url)['fetched'] >=
+                        metadata['fetched'])
+
+    def test_max_age(self):
+        """Within max_age, fetch() doesn't make a request
+        """
+        http_cache = cache.HttpCache(self.cache_dir, max_age=60)
+        with start_webserver() as (_, host):
+            url = "%s/test_config.json" % host
+            self.fetch(http_cache, url)
+            _, get = self.fetch(http_cache, url)
+        self.assertFalse(get.called)
+
+    def test_offline_fallback(self):
+        """Serve the stale copy when the server is unreachable
+        """
+        http_cache = cache.HttpCache(self.cache_dir)
+        with start_webserver() as (_, host):
+            url = "%s/test_config.json" % host
+            body_path, _ = self.fetch(http_cache, url)
+        self.assertEqual(self.fetch(http_cache, url)[0], body_path)
+        http_cache.offline_fallback = False
+        self.assertRaises(ScriptHarnessException, self.fetch, http_cache, url)
+
+    def test_uncached_error(self):
+        """Errors without a cached copy raise
+        """
+        http_cache = cache.HttpCache(self.cache_dir)
+        with start_webserver() as (_, host):
+            self.assertRaises(ScriptHarnessException, self.fetch, http_cache,
+                              "%s/nonexistent" % host)
+        self.assertRaises(ScriptHarnessException, self.fetch, http_cache,
+                          "%s/test_config.json" % host)
+
+    def test_parse_config_file(self):
+        """parse_config_file(http_cache=...) doesn't write to the cwd
+        """
+        http_cache = cache.HttpCache(self.cache_dir)
+        with start_webserver() as (path, host):
+            config = shconfig.parse_config_file(
+                "%s/test_config.json" % host, http_cache=http_cache
+            )
+        self.assertEqual(config, shconfig.parse_config_file(
+            os.path.join(path, "test_config.json")
+        ))
+        self.assertFalse(os.path.exists("test_config.json"))
+
+
+# TestArtifactCache {{{1
+class TestArtifactCache(unittest.TestCase):
+    """Test ArtifactCache
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.artifact_cache = cache.ArtifactCache(
+            os.path.join(self.tmpdir, 'cache')
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, contents):
+        """Write a file in tmpdir"""
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as filehandle:
+            filehandle.write(contents)
+        return path
+
+    def test_get_by_url(self):
+        """add() then get() by url links the cached copy
+        """
+        src = self.write_file('src', b'artifact')
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertFalse(self.artifact_cache.get("http://x/a", dest))
+        self.artifact_cache.add("http://x/a", src)
+        self.assertTrue(self.artifact_cache.get("http://x/a", dest))
+        with open(dest, 'rb') as filehandle:
+            self.assertEqual(filehandle.read(), b'artifact')
+        # add() and get() copy, so the caller's files aren't shared with
+        # the cache
+        object_path = self.artifact_cache.lookup(url="http://x/a")
+        self.assertFalse(os.path.samefile(src, object_path))
+        self.assertFalse(os.path.samefile(dest, object_path))
+        self.assertFalse(os.stat(object_path).st_mode & stat.S_IWUSR)
+        self.assertTrue(os.stat(dest).st_mode & stat.S_IWUSR)
+        self.assertEqual(self.artifact_cache.hits, 1)
+        self.assertEqual(self.artifact_cache.misses, 1)
+        self.assertEqual(self.artifact_cache.bytes_saved, len(b'artifact'))
+
+    def test_change_hit(self):
+        """Changing a file get() copied doesn't change the cache
+        """
+        src = self.write_file('src', b'artifact')
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.artifact_cache.add("http://x/a", src)
+        self.assertTrue(self.artifact_cache.get("http://x/a", dest))
+        with open(dest, 'ab') as filehandle:
+            filehandle.write(b'changed after get')
+        other = os.path.join(self.tmpdir, 'other')
+        self.assertTrue(self.artifact_cache.get("http://x/a", other))
+        with open(other, 'rb') as filehandle:
+            self.assertEqual(filehandle.read(), b'artifact')
+        self.assertEqual(self.artifact_cache.hits, 2)
+
+    def test_hash_without_lock(self):
+        """get() copies and hashes the object without holding the lock
+        """
+        src = self.write_file('src', b'artifact')
+        self.artifact_cache.add("http://x/a", src)
+        copy_with_sha256 = cache.copy_with_sha256
+        lock_free = []
+
+        def check_lock(*args):
+            """Try to take the lock while copying"""
+            acquired = self.artifact_cache.thread_lock.acquire(False)
+            if acquired:
+                self.artifact_cache.thread_lock.release()
+            lock_free.append(acquired)
+            return copy_with_sha256(*args)
+
+        with mock.patch.object(cache, 'copy_with_sha256',
+                               side_effect=check_lock):
+            self.assertTrue(self.artifact_cache.get(
+                "http://x/a", os.path.join(self.tmpdir, 'dest')
+            ))
+        self.assertEqual(lock_free, [True])
+
+    def test_get_by_checksum(self):
+        """A matching checksum hits, even from another url
+        """
+        src = self.write_file('src', b'artifact')
+        checksum = cache.get_file_sha256(src)
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.artifact_cache.add("http://x/a", src)
+        self.assertTrue(self.artifact_cache.get("http://y/b", dest,
+                                                checksum=checksum))
+        self.assertFalse(self.artifact_cache.get("http://x/a", dest,
+                                                 checksum="0" * 64))
+
+    def test_corrupt_object(self):
+        """A cached object that doesn't match its sha256 is evicted
+        """
+        src = self.write_file('src', b'artifact')
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.artifact_cache.add("http://x/a", src)
+        with open(src, 'ab') as filehandle:
+            filehandle.write(b'changed after add')
+        self.assertTrue(self.artifact_cache.get("http://x/a", dest))
+        with open(dest, 'rb') as filehandle:
+            self.assertEqual(filehandle.read(), b'artifact')
+        object_path = self.artifact_cache.lookup(url="http://x/a")
+        os.chmod(object_path, 0o644)
+        with open(object_path, 'ab') as filehandle:
+            filehandle.write(b'corrupt')
+        self.assertFalse(self.artifact_cache.get("http://x/a", dest))
+        self.assertFalse(os.path.exists(object_path))
+        self.assertEqual(self.artifact_cache.misses, 1)
+
+    def test_evict(self):
+        """The least recently used objects are evicted over max_bytes
+        """
+        for num in range(3):
+            url = "http://x/%d" % num
+            self.artifact_cache.add(url, self.write_file(str(num), b'x' * 10 +
+                                                         str(num).encode()))
+            object_path = self.artifact_cache.lookup(url=url)
+            os.utime(object_path, (num, num))
+        # touch 0, so 1 is the least recently used
+        self.assertTrue(self.artifact_cache.get(
+            "http://x/0", os.path.join(self.tmpdir, 'dest')
+        ))
+        self.artifact_cache.max_bytes = 25
+        self.artifact_cache.add("http://x/3", self.write_file('3', b'x' * 11))
+        self.assertFalse(self.artifact_cache.lookup(url="http://x/1"))
+        self.assertFalse(self.artifact_cache.lookup(url="http://x/2"))
+        self.assertTrue(self.artifact_cache.lookup(url="http://x/0"))
+        self.assertTrue(self.artifact_cache.lookup(url="http://x/3"))
+
+    def test_download_url(self):
+        """download_url(artifact_cache=...) only downloads once
+        """
+        dest = os.path.join(self.tmpdir, 'dest')
+        session = requests.Session()
+        with start_webserver() as (path, host):
+            url = "%s/test_config.json" % host
+            checksum = cache.get_file_sha256(
+                os.path.join(path, "test_config.json")
+            )
+            with mock.patch.object(session, 'get',
+                                   wraps=session.get) as get:
+                for _ in range(2):
+                    shconfig.download_url(url, path=dest, session=session,
+                                          artifact_cache=self.artifact_cache)
+                    self.assertEqual(cache.get_file_sha256(dest), checksum)
+                self.assertEqual(get.call_count, 1)
+            self.assertRaises(
+                ScriptHarnessException, shconfig.download_url, url,
+                path=os.path.join(self.tmpdir, 'bad'), checksum="0" * 64,
+                session=session
+            )
+        session.close()
+        self.assertEqual(self.artifact_cache.hits, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'bad')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     'bad.part')))
+
+    def test_download_url_md5(self):
+        """A non-sha256 checksum is checked, not served from the cache
+        """
+        session = requests.Session()
+        with start_webserver() as (path, host):
+            url = "%s/test_config.json" % host
+            with open(os.path.join(path, "test_config.json"), 'rb') as \
+                    filehandle:
+                md5 = hashlib.md5(filehandle.read()).hexdigest()
+            dest = os.path.join(self.tmpdir, 'dest')
+            shconfig.download_url(url, path=dest, session=session,
+                                  artifact_cache=self.artifact_cache)
+            bad = os.path.join(self.tmpdir, 'bad')
+            self.assertRaises(
+                ScriptHarnessException, shconfig.download_url, url,
+                path=bad, checksum="0" * 32, checksum_type='md5',
+                session=session, artifact_cache=self.artifact_cache
+            )
+            self.assertFalse(os.path.exists(bad))
+            shconfig.download_url(url, path=dest, checksum=md5,
+                                  checksum_type='md5', session=session,
+                                  artifact_cache=self.artifact_cache)
+        session.close()
+        self.assertEqual(self.artifact_cache.hits, 0)
+
+
+# TestParseCache {{{1
+class TestParseCache(unittest.TestCase):
+    """Test ParseCache
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.parse_cache = cache.ParseCache(os.path.join(self.tmpdir,
+                                                         'cache'))
+        self.path = os.path.join(self.tmpdir, 'config.json')
+        self.write_config({'a': 1, 'b': ['c', 'd']})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, config):
+        """Write config as json to self.path"""
+        with open(self.path, 'w') as filehandle:
+            json.dump(config, filehandle)
+
+    def parse(self):
+        """Parse self.path through the cache"""
+        return self.parse_cache.parse(
+            self.path, lambda contents: json.loads(contents.decode('utf-8'))
+        )
+
+    def test_hit(self):
+        """The second parse is a hit
+        """
+        self.assertEqual(self.parse(), {'a': 1, 'b': ['c', 'd']})
+        self.assertEqual(self.parse(), {'a': 1, 'b': ['c', 'd']})
+        self.assertEqual((self.parse_cache.misses, self.parse_cache.hits),
+                         (1, 1))
+
+    def test_invalidate(self):
+        """Changed contents are reparsed, even with the same size and mtime
+        """
+        self.parse()
+        stat = os.stat(self.path)
+        self.write_config({'a': 2, 'b': ['c', 'd']})
+        os.utime(self.path, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self.parse()['a'], 2)
+        self.assertEqual(self.parse_cache.misses, 2)
+        # a touched file with the same contents is still a hit
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(self.parse()['a'], 2)
+        self.assertEqual(self.parse_cache.hits, 1)
+
+    def test_no_verify_hash(self):
+        """Without verify_hash, the mtime and size are trusted
+        """
+        self.parse_cache.verify_hash = False
+        self.parse()
+        with mock.patch('scriptharness.cache.open', create=True) as mock_open:
+            mock_open.side_effect = open
+            self.parse()
+        self.assertEqual(len(mock_open.call_args_list), 1)
+        self.assertEqual(self.parse_cache.hits, 1)
+
+    def test_corrupt_entry(self):
+        """A corrupt entry is a miss
+        """
+        self.parse()
+        with open(self.parse_cache.get_entry_path(self.path), 'wb') as fh:
+            fh.write(b'garbage')
+        self.assertEqual(self.parse()['a'], 1)
+        self.assertEqual(self.parse_cache.misses, 2)
+
+    def test_parse_config_file(self):
+        """parse_config_file(parse_cache=...) with an interner
+        """
+        for _ in range(2):
+            interner = shconfig.ConfigInterner()
+            self.assertEqual(
+                shconfig.parse_config_file(self.path, interner=interner,
+                                           parse_cache=self.parse_cache),
+                {'a': 1, 'b': ['c', 'd']}
+            )
+            self.assertTrue(interner.table)
+        self.assertEqual(self.parse_cache.hits, 1)
@@ -5,8 +5,8 @@
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import argparse
-from contextlib import contextmanager
 from copy import deepcopy
+import hashlib
 import json
 import mock
 import os
@@ -14,13 +14,15 @@ import requests
 from scriptharness.actions import Action
 import scriptharness.config as shconfig
 from scriptharness.exceptions import ScriptHarnessException
+from scriptharness.structures import DeepMerge, LoggingDict, LoggingList, \
+    ReadOnlyDict
+import shutil
 import six
-import subprocess
-import sys
+import tempfile
 import time
 import unittest
 
-from . import TEST_ACTIONS, stdstar_redirected
+from . import TEST_ACTIONS, start_webserver, stdstar_redirected
 
 if six.PY3:
     BUILTIN = 'builtins'
@@ -28,48 +30,18 @@ else:
     BUILTIN = '__builtin__'
 
 TEST_FILE = '_test_config_file'
-TEST_FILES = (TEST_FILE, 'invalid_json.json', 'test_config.json')
+TEST_FILES = (TEST_FILE, 'invalid_json.json', 'test_config.json',
+              'layer1.json', 'layer2.json', 'layer3.json', 'include.json',
+              'test_config.json.gz', 'nonexistent')
 
 
 # Helper functions {{{1
 def nuke_test_files():
     """Cleanup helper function"""
     for path in TEST_FILES:
-        if os.path.exists(path):
-            os.remove(path)
-
-@contextmanager
-def start_webserver():
-    """Start a webserver for local requests testing
-    """
-    port = 8001
-    max_wait = 5
-    wait = 0
-    interval = .02
-    host = "http://localhost:%s" % str(port)
-    dir_path = os.path.join(os.path.dirname(__file__), 'http')
-    file_path = os.path.join(dir_path, 'cgi_server.py')
-    proc = subprocess.Popen([sys.executable, file_path],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while wait < max_wait:
-        try:
-            response = requests.get(host)
-            if response.status_code == 200:
-                break
-        except requests.exceptions.ConnectionError:
-            pass
-        time.sleep(interval)
-        wait += interval
-    try:
-        yield (dir_path, host)
-    finally:
-        proc.terminate()
-        # make sure it goes away
-        try:
-            while True:
-                response = requests.get(host)
-        except requests.exceptions.ConnectionError:
-            pass
+        for name in (path, path + '.part', path + '.part.json'):
+            if os.path.exists(name):
+                os.remove(name)
 
 # TestUrlFunctions {{{1
 class TestUrlFunctionss(unittest.TestCase):
@@ -105,6 +77,28 @@ class TestUrlFunctionss(unittest.TestCase):
             print(url)
             self.assertFalse(shconfig.is_url(url))
 
+    def test_get_local_path(self):
+        """file:// urls and paths are local; other urls aren't"""
+        for resource, expected in (
+                ("file:///tmp/a%20b.json", "/tmp/a b.json"),
+                ("file://localhost/tmp/a.json", "/tmp/a.json"),
+                ("a.json", "a.json"),
+                ("file://example.com/tmp/a.json", None),
+                ("http://example.com/a.json", None),
+        ):
+            self.assertEqual(shconfig.get_local_path(resource), expected)
+
+    def test_parse_file_url(self):
+        """file:// configs are read in place, not downloaded"""
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'http', 'test_config.json')
+        url = "file://" + six.moves.urllib.request.pathname2url(path)
+        with mock.patch.object(shconfig, 'download_url') as download:
+            config = shconfig.parse_config_file(url)
+        self.assertFalse(download.called)
+        self.assertEqual(config, shconfig.parse_config_file(path))
+        self.assertFalse(os.path.exists("test_config.json"))
+
     def test_successful_download_url(self):
         """Download a file from a local webserver.
         """
@@ -145,6 +139,48 @@ class TestUrlFunctionss(unittest.TestCase):
                 "%s/test_config.json" % host, path=path
             )
 
+    def test_download_url_part_file(self):
+        """download_url() writes to a .part file, then renames it
+        """
+        with start_webserver() as (_, host):
+            shconfig.download_url("%s/test_config.json" % host, path=TEST_FILE,
+                                  chunk_size=7)
+        self.assertTrue(os.path.exists(TEST_FILE))
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+
+    def test_download_url_interrupted(self):
+        """An interrupted download_url() leaves neither the path nor .part
+        """
+        def iter_content(**_):
+            """Fail partway through"""
+            yield b'{"partial": '
+            raise requests.exceptions.ChunkedEncodingError("dropped")
+        session = mock.MagicMock()
+        session.get.return_value.iter_content = iter_content
+        session.get.return_value.headers = {}
+        with open(TEST_FILE, 'w') as filehandle:
+            filehandle.write("old")
+        self.assertRaises(
+            ScriptHarnessException, shconfig.download_url,
+            "http://example.com/x", path=TEST_FILE, session=session
+        )
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+        with open(TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "old")
+
+    def test_download_url_append(self):
+        """download_url(mode='ab') appends to path directly
+        """
+        with open(TEST_FILE, 'w') as filehandle:
+            filehandle.write("old")
+        with start_webserver() as (path, host):
+            with open(os.path.join(path, "test_config.json")) as filehandle:
+                orig_contents = filehandle.read()
+            shconfig.download_url("%s/test_config.json" % host, path=TEST_FILE,
+                                  mode='ab')
+        with open(TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "old" + orig_contents)
+
     def test_parse_config_file(self):
         """parse json
         """
@@ -155,6 +191,58 @@ class TestUrlFunctionss(unittest.TestCase):
             config2 = json.load(filehandle)
         self.assertEqual(config, config2)
 
+    def test_parse_config_file_target(self):
+        """parse json straight into a target type
+        """
+        path = os.path.join(os.path.dirname(__file__), 'http',
+                            'test_config.json')
+        config = shconfig.parse_config_file(path)
+        logdict = shconfig.parse_config_file(
+            path, target=LoggingDict.from_pairs
+        )
+        self.assertTrue(isinstance(logdict, LoggingDict))
+        self.assertTrue(isinstance(logdict['yurts'], LoggingDict))
+        self.assertTrue(isinstance(logdict['turtles'], LoggingList))
+        self.assertEqual(logdict, config)
+        interner = shconfig.ConfigInterner()
+        rod = shconfig.parse_config_file(path, target=ReadOnlyDict,
+                                         interner=interner)
+        self.assertTrue(isinstance(rod['yurts'], ReadOnlyDict))
+        self.assertEqual(rod, config)
+        self.assertTrue(interner.table)
+
+    def test_parse_non_object(self):
+        """A config whose top level isn't an object can't be parsed
+        """
+        for contents in ('"abc"', '[1, 2]', '5', '[["a", 1]]'):
+            with open(TEST_FILE, 'w') as filehandle:
+                filehandle.write(contents)
+            for target in (None, ReadOnlyDict):
+                self.assertRaises(ScriptHarnessException,
+                                  shconfig.parse_config_file, TEST_FILE,
+                                  target=target)
+
+    def test_download_url_decompress(self):
+        """Decompress a download on the way to disk
+        """
+        with start_webserver() as (path, host):
+            with open(os.path.join(path, "test_config.json"), 'rb') as \
+                    filehandle:
+                orig_contents = filehandle.read()
+            url = "%s/test_config.json.gz" % host
+            self.assertEqual(shconfig.download_url(url, decompress=True),
+                             "test_config.json")
+            with open("test_config.json", 'rb') as filehandle:
+                self.assertEqual(filehandle.read(), orig_contents)
+            self.assertRaises(ScriptHarnessException, shconfig.download_url,
+                              url, decompress=True, checksum="0" * 64)
+            self.assertFalse(os.path.exists("test_config.json.part"))
+            self.assertEqual(
+                shconfig.parse_config_file(url),
+                shconfig.parse_config_file(os.path.join(path,
+                                                        "test_config.json"))
+            )
+
     def test_parse_invalid_json(self):
         """Download invalid json and parse it
         """
@@ -175,6 +263,797 @@ class TestUrlFunctionss(unittest.TestCase):
         )
 
 
+# TestConfigLoaders {{{1
+class TestConfigLoaders(unittest.TestCase):
+    """Test the config loader registry
+    """
+    config = {"a": [1, "b"], "c": {"d": True, "e": None}}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents):
+        """Write contents (bytes) to name in self.tmpdir"""
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as filehandle:
+            filehandle.write(contents)
+        return path
+
+    def test_get_config_loader(self):
+        """Extensions win, then sniffing, then json
+        """
+        for resource, contents, name in (
+                ("a.yml", b"{}", "yaml"),
+                ("http://x/a.TOML?x=1", None, "toml"),
+                ("a.cfg", b"--- {}", "yaml"),
+                ("a.cfg", b"\x81\xa1a\x01", "msgpack"),
+                ("a.cfg", b"{}", "json"),
+                ("a.json", b"---", "json"),
+        ):
+            self.assertEqual(
+                shconfig.get_config_loader(resource, contents).name, name
+            )
+
+    def test_mmap(self):
+        """Big files are mmapped, and each loader reads the mmap
+        """
+        import marshal
+        for name, contents in (
+                ("config.json", json.dumps(self.config).encode('utf-8')),
+                ("config.marshal", marshal.dumps(self.config)),
+                ("config.cfg", b"\x81\xa1a\x01"),
+        ):
+            path = self.write(name, contents)
+            with shconfig.read_config_contents(path, mmap_threshold=1) as \
+                    contents:
+                if six.PY3:
+                    self.assertFalse(isinstance(contents, bytes))
+                loader = shconfig.get_config_loader(path, contents)
+                if loader.name == "msgpack":
+                    continue
+                self.assertEqual(loader.load(contents), self.config)
+        path = self.write("empty.json", b"")
+        with shconfig.read_config_contents(path, mmap_threshold=0) as \
+                contents:
+            self.assertEqual(contents, b"")
+
+    def test_marshal(self):
+        """marshal configs, with a target
+        """
+        import marshal
+        path = self.write("config.marshal", marshal.dumps(self.config))
+        self.assertEqual(shconfig.parse_config_file(path), self.config)
+        logdict = shconfig.parse_config_file(path,
+                                             target=LoggingDict.from_pairs)
+        self.assertTrue(isinstance(logdict['c'], LoggingDict))
+        path = self.write("bad.marshal", b"\x00")
+        self.assertRaises(ScriptHarnessException, shconfig.parse_config_file,
+                          path)
+
+    def test_yaml(self):
+        """yaml configs, if PyYAML is installed
+        """
+        path = self.write("config.yaml", b"---\na: [1, b]\nc:\n  d: true\n"
+                                         b"  e: null\n")
+        try:
+            import yaml  # pylint: disable=unused-variable
+        except ImportError:
+            self.assertRaises(ScriptHarnessException,
+                              shconfig.parse_config_file, path)
+            return
+        self.assertEqual(shconfig.parse_config_file(path), self.config)
+        path = self.write("bad.yaml", b"a: [")
+        self.assertRaises(ScriptHarnessException, shconfig.parse_config_file,
+                          path)
+
+    def test_toml(self):
+        """toml configs, if tomllib, tomli or toml is importable
+        """
+        path = self.write("config.toml", b'a = [1, "b"]\n[c]\nd = true\n')
+        try:
+            shconfig.import_loader_module("toml", "tomllib", "tomli", "toml")
+        except ScriptHarnessException:
+            self.assertRaises(ScriptHarnessException,
+                              shconfig.parse_config_file, path)
+            return
+        self.assertEqual(shconfig.parse_config_file(path),
+                         {"a": [1, "b"], "c": {"d": True}})
+
+    def test_msgpack(self):
+        """msgpack configs, if msgpack is installed
+        """
+        # {"a": 1, "b": ["c"]}
+        path = self.write("config.msgpack", b"\x82\xa1a\x01\xa1b\x91\xa1c")
+        try:
+            import msgpack  # pylint: disable=unused-variable
+        except ImportError:
+            self.assertRaises(ScriptHarnessException,
+                              shconfig.parse_config_file, path)
+            return
+        self.assertEqual(shconfig.parse_config_file(path),
+                         {"a": 1, "b": ["c"]})
+
+    def test_register(self):
+        """Scripts can register their own loaders
+        """
+        def load_lines(contents, object_pairs_hook=None):
+            """key=value lines"""
+            assert object_pairs_hook is None
+            return dict(line.split("=", 1)
+                        for line in contents.decode('utf-8').splitlines())
+        path = self.write("config.lines", b"a=1\nb=2")
+        with mock.patch.dict(shconfig.CONFIG_LOADERS), \
+                mock.patch.dict(shconfig.CONFIG_EXTENSIONS):
+            shconfig.register_config_loader("lines", load_lines,
+                                            extensions=(".lines", ))
+            self.assertEqual(shconfig.parse_config_file(path),
+                             {"a": "1", "b": "2"})
+        self.assertFalse("lines" in shconfig.CONFIG_LOADERS)
+
+
+# TestCompression {{{1
+class TestCompression(unittest.TestCase):
+    """Test the compressed config support
+    """
+    contents = b'{"a": [1, "b"]}'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def compress(name, contents):
+        """Compress contents with the stdlib module for name"""
+        import bz2
+        import gzip
+        import io
+        if name == "gzip":
+            output = io.BytesIO()
+            with gzip.GzipFile(fileobj=output, mode='wb') as filehandle:
+                filehandle.write(contents)
+            return output.getvalue()
+        if name == "bz2":
+            return bz2.compress(contents)
+        import lzma
+        return lzma.compress(contents)
+
+    def get_names(self):
+        """The compressions we can test here"""
+        names = ["gzip", "bz2"]
+        try:
+            import lzma  # pylint: disable=unused-variable
+            names.append("xz")
+        except ImportError:
+            pass
+        return names
+
+    def test_iter_decompressed(self):
+        """Small chunks, concatenated streams, and uncompressed passthrough
+        """
+        for name in self.get_names():
+            compressed = self.compress(name, self.contents) * 2
+            chunks = [compressed[pos:pos + 3]
+                      for pos in range(0, len(compressed), 3)]
+            self.assertEqual(b"".join(shconfig.iter_decompressed(chunks)),
+                             self.contents * 2)
+            self.assertEqual(
+                shconfig.get_compression("a.json", compressed).name, name
+            )
+            self.assertRaises(ValueError, list, shconfig.iter_decompressed(
+                [compressed[:len(compressed) // 4]]
+            ))
+        self.assertEqual(list(shconfig.iter_decompressed([b"{", b"}"])),
+                         [b"{}"])
+        self.assertEqual(shconfig.get_compression("a.json.gz").name, "gzip")
+        self.assertTrue(shconfig.get_compression("a.json.gz", b"{}") is None)
+
+    def test_parse_config_file(self):
+        """Compressed configs use the loader of their inner extension
+        """
+        extensions = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+        for name in self.get_names():
+            for extension, contents in ((".json", self.contents),
+                                        (".yaml", b"a: [1, b]\n")):
+                if extension == ".yaml":
+                    try:
+                        import yaml  # pylint: disable=unused-variable
+                    except ImportError:
+                        continue
+                path = os.path.join(self.tmpdir, "config" + extension +
+                                    extensions[name])
+                with open(path, 'wb') as filehandle:
+                    filehandle.write(self.compress(name, contents))
+                self.assertEqual(shconfig.parse_config_file(path),
+                                 {"a": [1, "b"]})
+        self.assertEqual(
+            shconfig.get_config_loader("http://x/a.yaml.xz").name, "yaml"
+        )
+
+    def test_decompress_artifact_cache(self):
+        """download_url() won't decompress into an artifact_cache
+        """
+        self.assertRaises(ScriptHarnessException, shconfig.download_url,
+                          "http://localhost/a.gz", decompress=True,
+                          artifact_cache=mock.MagicMock())
+
+
+# TestSessionPool {{{1
+class TestSessionPool(unittest.TestCase):
+    """Test the shared http session pool
+    """
+    def setUp(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def tearDown(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def test_shared_session(self):
+        """get_session() returns the same session until configure()
+        """
+        pool = shconfig.SessionPool()
+        session = pool.get_session()
+        self.assertTrue(pool.get_session() is session)
+        pool.configure(retries=2)
+        session2 = pool.get_session()
+        self.assertFalse(session2 is session)
+        pool.close()
+        self.assertTrue(pool.session is None)
+
+    def test_configure(self):
+        """The adapter is mounted with the configured pool and retries
+        """
+        pool = shconfig.SessionPool(pool_size=3, retries=2,
+                                    backoff_factor=.5, keep_alive=False)
+        session = pool.get_session()
+        for prefix in ("http://", "https://"):
+            adapter = session.get_adapter("%sexample.com" % prefix)
+            self.assertEqual(adapter.max_retries.total, 2)
+            self.assertEqual(adapter.max_retries.backoff_factor, .5)
+            self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(session.headers['Connection'], 'close')
+        pool.close()
+
+    def test_download_reuses_session(self):
+        """download_url() uses the SESSION_POOL session by default
+        """
+        pool = shconfig.SessionPool()
+        with mock.patch('scriptharness.config.SESSION_POOL', new=pool):
+            with start_webserver() as (_, host):
+                for _ in range(2):
+                    shconfig.download_url("%s/test_config.json" % host,
+                                          path=TEST_FILE)
+                session = pool.session
+                self.assertTrue(session is not None)
+                shconfig.download_url("%s/test_config.json" % host,
+                                      path=TEST_FILE)
+                self.assertTrue(pool.session is session)
+        pool.close()
+
+    def test_download_explicit_session(self):
+        """download_url(session=...) uses that session
+        """
+        pool = shconfig.SessionPool()
+        with mock.patch('scriptharness.config.SESSION_POOL', new=pool):
+            with start_webserver() as (_, host):
+                session = requests.Session()
+                shconfig.download_url("%s/test_config.json" % host,
+                                      path=TEST_FILE, session=session)
+                session.close()
+        self.assertTrue(pool.session is None)
+
+
+# TestResumeDownload {{{1
+class TestResumeDownload(unittest.TestCase):
+    """Test resuming interrupted downloads
+    """
+    def setUp(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def tearDown(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    @staticmethod
+    def get_contents():
+        """Read the original test_config.json"""
+        path = os.path.join(os.path.dirname(__file__), 'http',
+                            'test_config.json')
+        with open(path, 'rb') as filehandle:
+            return filehandle.read()
+
+    def write_part(self, contents, validator):
+        """Leave a .part file and metadata, as if interrupted"""
+        with open(TEST_FILE + '.part', 'wb') as filehandle:
+            filehandle.write(contents)
+        with open(TEST_FILE + '.part.json', 'w') as filehandle:
+            json.dump({'url': self.url, 'validator': validator}, filehandle)
+
+    def assert_downloaded(self):
+        """The download completed, and nothing is left behind"""
+        with open(TEST_FILE, 'rb') as filehandle:
+            self.assertEqual(filehandle.read(), self.get_contents())
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+        self.assertFalse(os.path.exists(TEST_FILE + '.part.json'))
+
+    url = None
+
+    def test_resume_dropped_connections(self):
+        """download_url() resumes until the whole file is downloaded
+        """
+        with start_webserver() as (_, host):
+            self.url = "%s/test_config.json?drop=50" % host
+            shconfig.download_url(self.url, path=TEST_FILE)
+        self.assert_downloaded()
+
+    def test_resume_later(self):
+        """A failed download keeps the .part file for the next attempt
+        """
+        with start_webserver() as (_, host):
+            self.url = "%s/test_config.json?drop=50" % host
+            self.assertRaises(
+                ScriptHarnessException, shconfig.download_url, self.url,
+                path=TEST_FILE, resume_retries=0
+            )
+            self.assertEqual(os.path.getsize(TEST_FILE + '.part'), 50)
+            self.assertTrue(os.path.exists(TEST_FILE + '.part.json'))
+            session = requests.Session()
+            with mock.patch.object(session, 'get',
+                                   wraps=session.get) as get:
+                shconfig.download_url(self.url, path=TEST_FILE,
+                                      session=session, resume_retries=2)
+            session.close()
+        self.assertEqual(get.call_args_list[0][1]['headers']['Range'],
+                         'bytes=50-')
+        self.assert_downloaded()
+
+    def test_changed_file(self):
+        """A stale If-Range validator downloads the whole file
+        """
+        with start_webserver() as (_, host):
+            self.url = "%s/test_config.json" % host
+            self.write_part(b'stale contents', '"stale"')
+            shconfig.download_url(self.url, path=TEST_FILE)
+        self.assert_downloaded()
+
+    def test_range_not_satisfiable(self):
+        """An overlong .part file is discarded
+        """
+        contents = self.get_contents()
+        etag = '"%s"' % hashlib.md5(contents).hexdigest()
+        with start_webserver() as (_, host):
+            self.url = "%s/test_config.json" % host
+            self.write_part(b'x' * (len(contents) + 10), etag)
+            shconfig.download_url(self.url, path=TEST_FILE)
+        self.assert_downloaded()
+
+
+# TestParallelDownload {{{1
+class TestParallelDownload(unittest.TestCase):
+    """Test segmented downloads
+    """
+    def setUp(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def tearDown(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def test_segments(self):
+        """download_url_parallel() assembles the segments in order
+        """
+        contents = TestResumeDownload.get_contents()
+        checksum = hashlib.sha256(contents).hexdigest()
+        with start_webserver() as (_, host):
+            for segments in (1, 3, 20):
+                shconfig.download_url_parallel(
+                    "%s/test_config.json" % host, path=TEST_FILE,
+                    segments=segments, checksum=checksum
+                )
+                with open(TEST_FILE, 'rb') as filehandle:
+                    self.assertEqual(filehandle.read(), contents)
+                self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+
+    def test_bad_checksum(self):
+        """A checksum mismatch raises, and leaves nothing behind
+        """
+        with start_webserver() as (_, host):
+            self.assertRaises(
+                ScriptHarnessException, shconfig.download_url_parallel,
+                "%s/test_config.json" % host, path=TEST_FILE,
+                checksum="0" * 64
+            )
+        self.assertFalse(os.path.exists(TEST_FILE))
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+
+    def test_no_ranges(self):
+        """Fall back to download_url() without Accept-Ranges
+        """
+        session = mock.MagicMock()
+        session.head.return_value.status_code = 200
+        session.head.return_value.headers = {'Content-Length': '10'}
+        with mock.patch('scriptharness.config.download_url') as download:
+            shconfig.download_url_parallel("http://example.com/x",
+                                           path=TEST_FILE, session=session)
+        self.assertEqual(download.call_args[0], ("http://example.com/x", ))
+        self.assertEqual(download.call_args[1]['path'], TEST_FILE)
+
+    def test_no_ranges_bad_checksum(self):
+        """A bad fallback download doesn't replace an existing file
+        """
+        with open(TEST_FILE, 'w') as filehandle:
+            filehandle.write("good")
+        session = requests.Session()
+        head = mock.MagicMock(status_code=200,
+                              headers={'Content-Length': '10'})
+        with start_webserver() as (_, host):
+            with mock.patch.object(session, 'head', return_value=head):
+                with mock.patch.object(session, 'get',
+                                       wraps=session.get) as get:
+                    self.assertRaises(
+                        ScriptHarnessException,
+                        shconfig.download_url_parallel,
+                        "%s/test_config.json" % host, path=TEST_FILE,
+                        checksum="0" * 64, checksum_type='md5',
+                        session=session
+                    )
+            # one plain GET, not byte ranges
+            self.assertEqual(get.call_count, 1)
+            self.assertFalse(get.call_args[1].get('headers'))
+        session.close()
+        with open(TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "good")
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+
+    def test_not_partial(self):
+        """Raise if a range request gets a 200
+        """
+        session = mock.MagicMock()
+        session.head.return_value.status_code = 200
+        session.head.return_value.headers = {
+            'Content-Length': '10', 'Accept-Ranges': 'bytes'
+        }
+        session.get.return_value.status_code = 200
+        self.assertRaises(
+            ScriptHarnessException, shconfig.download_url_parallel,
+            "http://example.com/x", path=TEST_FILE, session=session
+        )
+        self.assertFalse(os.path.exists(TEST_FILE + '.part'))
+
+
+# TestParseConfigFiles {{{1
+class TestParseConfigFiles(unittest.TestCase):
+    """Test concurrent config file parsing
+    """
+    def setUp(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def tearDown(self):
+        assert self  # silence pylint
+        nuke_test_files()
+
+    def test_results_order(self):
+        """parse_config_files() returns results in order, with exceptions
+        """
+        path = os.path.join(os.path.dirname(__file__), 'http')
+        resources = [
+            os.path.join(path, 'layer2.json'),
+            "%s/nonexistent_file" % __file__,
+            os.path.join(path, 'layer1.json'),
+        ]
+        for max_workers in (1, 3):
+            results = shconfig.parse_config_files(resources,
+                                                  max_workers=max_workers)
+            self.assertEqual(results[0], ({"layer": 2, "layer2": True}, None))
+            self.assertEqual(results[1][0], None)
+            self.assertTrue(isinstance(results[1][1], ScriptHarnessException))
+            self.assertEqual(results[2], ({"layer": 1, "layer1": True}, None))
+
+    def test_concurrent_build_config(self):
+        """build_config() fetches urls concurrently, preserving precedence
+        """
+        delay = .5
+        with start_webserver() as (_, host):
+            cmdln_args = []
+            for num in (1, 2, 3):
+                cmdln_args.extend([
+                    "-c", "%s/layer%d.json?delay=%s" % (host, num, delay)
+                ])
+            cmdln_args.extend([
+                "--opt-cfg", "%s/test_config.json?delay=%s" % (host, delay),
+                "--opt-cfg", "%s/nonexistent?delay=%s" % (host, delay),
+            ])
+            parser = shconfig.get_parser()
+            parsed_args = shconfig.parse_args(parser, cmdln_args=cmdln_args)
+            start = time.time()
+            config = shconfig.build_config(parser, parsed_args)
+            elapsed = time.time() - start
+        self.assertEqual(config['layer'], 3)
+        for key in ('layer1', 'layer2', 'layer3'):
+            self.assertTrue(config[key])
+        self.assertEqual(config['key1'], 'value1')
+        # Serially, this would take at least 5 * delay.
+        self.assertTrue(elapsed < 3 * delay, elapsed)
+
+
+# TestConfigResolver {{{1
+class TestConfigResolver(unittest.TestCase):
+    """Test ConfigResolver includes
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_configs(self, configs):
+        """Write each name: config in configs as json to self.tmpdir"""
+        for name, config in configs.items():
+            path = os.path.join(self.tmpdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as filehandle:
+                json.dump(config, filehandle)
+        return os.path.join(self.tmpdir, "top.json")
+
+    def test_diamond(self):
+        """Shared includes are parsed once, a level at a time
+        """
+        top = self.write_configs({
+            "top.json": {"include": ["sub/a.json", "b.json"], "top": 1},
+            "sub/a.json": {"include": "../base.json", "a": 1, "x": "a"},
+            "b.json": {"include": ["base.json"], "b": 1, "x": "b"},
+            "base.json": {"base": 1, "x": "base", "a": 0},
+        })
+        resolver = shconfig.ConfigResolver()
+        with mock.patch('scriptharness.config.parse_config_files',
+                        wraps=shconfig.parse_config_files) as parse:
+            for _ in range(2):
+                config = shconfig.parse_config_file(top, resolver=resolver)
+        # b.json's include of base.json comes after a.json, so it wins
+        self.assertEqual(config, {"top": 1, "a": 0, "b": 1, "base": 1,
+                                  "x": "b"})
+        self.assertEqual([len(args[0]) for args, _ in parse.call_args_list],
+                         [1, 2, 1])
+
+    def test_cycle(self):
+        """Include cycles raise, naming the chain
+        """
+        top = self.write_configs({
+            "top.json": {"include": ["a.json"]},
+            "a.json": {"include": ["b.json"]},
+            "b.json": {"include": ["a.json"]},
+        })
+        resolver = shconfig.ConfigResolver()
+        try:
+            resolver.resolve(top)
+        except ScriptHarnessException as exc_info:
+            self.assertTrue("a.json -> " in exc_info.args[0])
+            self.assertTrue("b.json -> " in exc_info.args[0])
+        else:
+            self.fail("No exception on an include cycle!")
+
+    def test_errors(self):
+        """Missing includes and bad include values raise
+        """
+        top = self.write_configs({
+            "top.json": {"include": ["missing.json"]},
+            "bad.json": {"include": {"a": 1}},
+        })
+        resolver = shconfig.ConfigResolver()
+        self.assertRaises(ScriptHarnessException, resolver.resolve, top)
+        self.assertRaises(ScriptHarnessException, resolver.resolve,
+                          os.path.join(self.tmpdir, "bad.json"))
+
+    def test_url_includes(self):
+        """Relative includes in urls are relative to the url
+        """
+        self.assertEqual(
+            shconfig.ConfigResolver.get_key("layer1.json",
+                                            parent="http://x/y/top.json"),
+            "http://x/y/layer1.json"
+        )
+        nuke_test_files()
+        try:
+            with start_webserver() as (_, host):
+                config = shconfig.ConfigResolver().resolve(
+                    "%s/include.json" % host
+                )
+        finally:
+            nuke_test_files()
+        self.assertEqual(config, {"layer": 2, "layer1": True, "layer2": True,
+                                  "include_test": True})
+
+    def test_build_config(self):
+        """build_config(resolver=...) resolves each config file's includes
+        """
+        top = self.write_configs({
+            "top.json": {"include": ["base.json"], "top": 1},
+            "base.json": {"base": {"a": 1, "b": 1}},
+            "opt.json": {"include": ["base.json"], "base": {"b": 2}},
+        })
+        parser = shconfig.get_parser()
+        parsed_args = shconfig.parse_args(parser, cmdln_args=[
+            "-c", top, "--opt-cfg", os.path.join(self.tmpdir, "opt.json"),
+        ])
+        config = shconfig.build_config(
+            parser, parsed_args, merge=DeepMerge(),
+            resolver=shconfig.ConfigResolver(merge=DeepMerge()),
+        )
+        self.assertEqual(config["top"], 1)
+        self.assertEqual(config["base"], {"a": 1, "b": 2})
+
+
+# TestConfigBundle {{{1
+class TestConfigBundle(unittest.TestCase):
+    """Test --compile-config and --config-bundle
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bundle = os.path.join(self.tmpdir, "bundle")
+        self.config_file = os.path.join(self.tmpdir, "config.json")
+        with open(self.config_file, "w") as filehandle:
+            json.dump({"a": 1, "b": {"c": 2}}, filehandle)
+        self.parser = shconfig.get_parser()
+        self.parser.add_argument("--foo", default="default")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        nuke_test_files()
+
+    def build_config(self, *cmdln_args):
+        """build_config() with cmdln_args"""
+        parsed_args = shconfig.parse_args(self.parser,
+                                          cmdln_args=list(cmdln_args))
+        return shconfig.build_config(self.parser, parsed_args,
+                                     initial_config={"d": 3})
+
+    def test_round_trip(self):
+        """The bundle replaces the config files; the commandline still wins
+        """
+        config = self.build_config("-c", self.config_file,
+                                   "--compile-config", self.bundle)
+        self.assertEqual(config, {"a": 1, "b": {"c": 2}, "d": 3,
+                                  "foo": "default"})
+        with mock.patch('scriptharness.config.parse_config_files') as parse:
+            config2 = self.build_config("--config-bundle", self.bundle,
+                                        "--foo", "bar")
+        self.assertFalse(parse.called)
+        config["foo"] = "bar"
+        self.assertEqual(config2, config)
+
+    def test_stale(self):
+        """Changed or missing sources make the bundle stale
+        """
+        self.build_config("-c", self.config_file,
+                          "--compile-config", self.bundle)
+        with open(self.config_file, "w") as filehandle:
+            json.dump({"a": 2, "b": {"c": 2}}, filehandle)
+        self.assertRaises(ScriptHarnessException, self.build_config,
+                          "--config-bundle", self.bundle)
+        self.assertEqual(shconfig.read_config_bundle(self.bundle,
+                                                     verify=False)["a"], 1)
+        os.remove(self.config_file)
+        self.assertRaises(ScriptHarnessException,
+                          shconfig.read_config_bundle, self.bundle)
+
+    def test_remote_source(self):
+        """Remote sources are checked by their ETag or Last-Modified
+        """
+        with start_webserver() as (_, host):
+            url = "%s/test_config.json" % host
+            self.build_config("-c", url, "--compile-config", self.bundle)
+            config = shconfig.read_config_bundle(self.bundle)
+            self.assertEqual(config["key1"], "value1")
+            with mock.patch('scriptharness.config.get_url_validator',
+                            return_value='"changed"'):
+                self.assertRaises(ScriptHarnessException,
+                                  shconfig.read_config_bundle, self.bundle)
+                self.assertEqual(
+                    shconfig.read_config_bundle(self.bundle,
+                                                verify=False)["key1"], "value1"
+                )
+            with mock.patch('scriptharness.config.get_url_validator',
+                            return_value=None):
+                self.assertRaises(ScriptHarnessException, self.build_config,
+                                  "-c", url, "--compile-config",
+                                  self.bundle + "2")
+        # the server is gone
+        self.assertRaises(ScriptHarnessException,
+                          shconfig.read_config_bundle, self.bundle)
+
+    def test_compile_from_bundle(self):
+        """--compile-config with --config-bundle raises
+        """
+        self.build_config("-c", self.config_file,
+                          "--compile-config", self.bundle)
+        self.assertRaises(ScriptHarnessException, self.build_config,
+                          "--config-bundle", self.bundle,
+                          "--compile-config", self.bundle + "2")
+        self.assertFalse(os.path.exists(self.bundle + "2"))
+
+    def test_bad_bundle(self):
+        """Unreadable bundles and other versions raise
+        """
+        import marshal
+        self.assertRaises(ScriptHarnessException,
+                          shconfig.read_config_bundle, self.bundle)
+        with open(self.bundle, "wb") as filehandle:
+            filehandle.write(marshal.dumps({"version": 0, "config": {}}))
+        self.assertRaises(ScriptHarnessException,
+                          shconfig.read_config_bundle, self.bundle)
+        self.assertRaises(ScriptHarnessException,
+                          shconfig.write_config_bundle, self.bundle,
+                          {"a": object()}, [])
+
+
+# TestConfigInterner {{{1
+class TestConfigInterner(unittest.TestCase):
+    """Test ConfigInterner
+    """
+    path = os.path.join(os.path.dirname(__file__), 'http', 'test_config.json')
+
+    def test_shared_values(self):
+        """Parsing the same config twice shares keys and values
+        """
+        interner = shconfig.ConfigInterner()
+        config1 = shconfig.parse_config_file(self.path, interner=interner)
+        config2 = shconfig.parse_config_file(self.path, interner=interner)
+        self.assertEqual(config1, config2)
+        self.assertTrue(config1['key1'] is config2['key1'])
+        self.assertTrue(config1['turtles'][0] is config2['turtles'][0])
+        self.assertTrue(
+            config1['yurts']['yurt1'] is config2['yurts']['yurt1']
+        )
+        key1 = [key for key in config1 if key == 'turtles'][0]
+        key2 = [key for key in config2 if key == 'turtles'][0]
+        self.assertTrue(key1 is key2)
+        self.assertTrue(interner.hits > 0)
+        self.assertTrue(interner.bytes_saved > 0)
+
+    def test_types(self):
+        """Equal values of different types aren't merged
+        """
+        interner = shconfig.ConfigInterner()
+        config = interner([('a', 1), ('b', 1.0), ('c', True), ('d', [1.0])])
+        self.assertTrue(isinstance(config['a'], int))
+        self.assertTrue(isinstance(config['b'], float))
+        self.assertTrue(config['c'] is True)
+        self.assertTrue(config['d'][0] is config['b'])
+
+    def test_signed_zero(self):
+        """-0.0 and 0.0 are equal, but aren't merged
+        """
+        interner = shconfig.ConfigInterner()
+        config = json.loads('{"a": 0.0, "b": -0.0, "c": -0.0}',
+                            object_pairs_hook=interner)
+        self.assertEqual(str(config['a']), "0.0")
+        self.assertEqual(str(config['b']), "-0.0")
+        self.assertTrue(config['c'] is config['b'])
+
+    def test_build_config(self):
+        """build_config() passes the interner to parse_config_file()
+        """
+        interner = shconfig.ConfigInterner()
+        parser = shconfig.get_parser()
+        parsed_args = shconfig.parse_args(
+            parser, cmdln_args=["-c", self.path, "-c", self.path]
+        )
+        config = shconfig.build_config(parser, parsed_args,
+                                       interner=interner)
+        self.assertEqual(config['key1'], 'value1')
+        self.assertTrue(interner.hits > 0)
+
+
 # TestParserFunctions {{{1
 class TestParserFunctions(unittest.TestCase):
     """Test parser functions
@@ -261,6 +1140,126 @@ class TestParserFunctions(unittest.TestCase):
         config2['override_default'] = 'not_default'
         self.assertEqual(config, config2)
 
+    def test_get_parser_defaults(self):
+        """get_parser_defaults() matches parser.get_default()
+        """
+        parser = shconfig.get_parser(all_actions=TEST_ACTIONS)
+        parser.add_argument("--test-default", default="default")
+        parser.set_defaults(other="other", test_default="set_default")
+        defaults = shconfig.get_parser_defaults(parser)
+        for key in ('test_default', 'other', 'config_files', 'nonexistent'):
+            self.assertEqual(defaults.get(key), parser.get_default(key))
+
+    def test_build_layered_config(self):
+        """build_layered_config() records the layer of each value
+        """
+        path = os.path.join(os.path.dirname(__file__), 'http',
+                            'test_config.json')
+        parser = shconfig.get_parser(all_actions=TEST_ACTIONS)
+        parser.add_argument("--test-default", default="default")
+        parser.add_argument("--override-default", default="default")
+        parsed_args = shconfig.parse_args(parser, cmdln_args=[
+            "-c", path, "--override-default", "not_default",
+        ])
+        layered_config = shconfig.build_layered_config(
+            parser, parsed_args, initial_config={"key1": "value0", "a": 1}
+        )
+        self.assertEqual([name for name, _ in layered_config.layers], [
+            "parser defaults", "initial_config", path, "commandline",
+        ])
+        self.assertEqual(layered_config.get_source('test_default'),
+                         "parser defaults")
+        self.assertEqual(layered_config.get_source('a'), "initial_config")
+        self.assertEqual(layered_config.get_source('key1'), path)
+        self.assertEqual(layered_config.get_source('override_default'),
+                         "commandline")
+        self.assertEqual(dict(layered_config), shconfig.build_config(
+            parser, parsed_args, initial_config={"key1": "value0", "a": 1}
+        ))
+
+    def test_build_config_merge(self):
+        """build_config(merge=DeepMerge()) merges nested dicts
+        """
+        parser = shconfig.get_parser(all_actions=TEST_ACTIONS)
+        parsed_args = shconfig.parse_args(parser, cmdln_args=[])
+        initial_config = {"nested": {"a": 1, "b": 1}}
+        config = shconfig.build_config(parser, parsed_args, initial_config)
+        self.assertEqual(config["nested"], {"a": 1, "b": 1})
+        parsed_args.config_files = [
+            os.path.join(os.path.dirname(__file__), 'http', 'nested.json')
+        ]
+        with mock.patch('scriptharness.config.parse_config_file',
+                        return_value={"nested": {"b": 2}}):
+            config = shconfig.build_config(parser, parsed_args, initial_config,
+                                           merge=DeepMerge())
+            self.assertEqual(config["nested"], {"a": 1, "b": 2})
+            config = shconfig.build_config(parser, parsed_args, initial_config)
+            self.assertEqual(config["nested"], {"b": 2})
+
+    def test_get_env_config(self):
+        """get_env_config() nests and coerces prefixed variables
+        """
+        environ = {
+            "SH__platforms__linux__jobs": "8",
+            "SH__platforms__linux__name": "linux64",
+            "SH__debug": "true",
+            "SH__list": '["a", 1]',
+            "SH____empty": "x",
+            "SH__": "ignored",
+            "SHX__other": "ignored",
+            "PATH": "/bin",
+        }
+        self.assertEqual(shconfig.get_env_config(prefix="SH",
+                                                 environ=environ), {
+            "platforms": {"linux": {"jobs": 8, "name": "linux64"}},
+            "debug": True,
+            "list": ["a", 1],
+            "empty": "x",
+        })
+
+    def test_coerce_env_value(self):
+        """Only values that are exactly json are coerced
+        """
+        for value, expected in (
+                ("8", 8), ("-3", -3), ("0.5", 0.5), ("false", False),
+                ("null", None), ('{"a": 1}', {"a": 1}), ("[1]", [1]),
+        ):
+            self.assertEqual(shconfig.coerce_env_value(value), expected)
+        for value in ("1.10", "1e3", "1234e56", "NaN", "Infinity",
+                      "-Infinity", "08", " 8", "linux", ""):
+            self.assertEqual(shconfig.coerce_env_value(value), value)
+
+    def test_build_config_env(self):
+        """The environment layer deep sets values below the commandline
+        """
+        parser = shconfig.get_parser(all_actions=TEST_ACTIONS)
+        parser.add_argument("--jobs")
+        parsed_args = shconfig.parse_args(parser, cmdln_args=[])
+        initial_config = {"platforms": {"linux": {"jobs": 1, "name": "l"},
+                                        "win": {"jobs": 1}}}
+        environ = {"SCRIPTHARNESS__platforms__linux__jobs": "8",
+                   "SCRIPTHARNESS__jobs": "2"}
+        with mock.patch.dict(os.environ, environ):
+            layered_config = shconfig.build_layered_config(
+                parser, parsed_args, initial_config=initial_config,
+                env_prefix=shconfig.DEFAULT_ENV_PREFIX
+            )
+            self.assertEqual(layered_config["platforms"], {
+                "linux": {"jobs": 8, "name": "l"}, "win": {"jobs": 1}
+            })
+            self.assertEqual(layered_config.get_source("platforms"),
+                             "environment")
+            self.assertEqual(layered_config["jobs"], 2)
+            self.assertEqual(initial_config["platforms"]["linux"]["jobs"], 1)
+            parsed_args = shconfig.parse_args(parser,
+                                              cmdln_args=["--jobs", "3"])
+            config = shconfig.build_config(parser, parsed_args,
+                                           env_prefix="SCRIPTHARNESS")
+            self.assertEqual(config["jobs"], "3")
+            config = shconfig.build_config(parser, parsed_args,
+                                           initial_config=initial_config)
+            self.assertEqual(config["platforms"]["linux"]["jobs"], 1)
+
     def test_build_config_optcfg(self):
         """Test build_config() optcfg
         """
@@ -10,6 +10,8 @@ import scriptharness
 from scriptharness.exceptions import ScriptHarnessException
 import six
 from six.moves import reload_module
+import subprocess
+import sys
 import unittest
 from . import TEST_ACTIONS
 
@@ -160,3 +162,19 @@ class TestScriptManager(unittest.TestCase):
         )
         for action in action_tuple:
             self.assertTrue(isinstance(action, FakeAction))
+
+
+# TestLazyImports {{{1
+class TestLazyImports(unittest.TestCase):
+    """Test that heavy dependencies aren't imported until they're used
+    """
+    def test_import_scriptharness(self):
+        """import scriptharness doesn't import requests and friends
+        """
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, scriptharness; "
+            "print(sorted(m for m in ('requests', 'argparse', "
+            "'multiprocessing.pool', 'pprint') if m in sys.modules))"
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.decode('utf-8').strip(), "[]")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test scriptharness/schema.py
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import json
+import os
+from scriptharness.cache import ParseCache
+import scriptharness.config as shconfig
+from scriptharness.exceptions import ScriptHarnessException
+import scriptharness.schema as schema
+from scriptharness.structures import DeepMerge
+import shutil
+import tempfile
+import unittest
+
+SCHEMA = {
+    "keys": {
+        "jobs": {"type": "int", "default": 1, "coerce": True},
+        "platform": {"type": "str", "choices": ["linux", "win"]},
+        "env": {"type": "dict", "values": {"type": "str", "coerce": True}},
+        "tools": {"type": "list", "items": {"type": "str"}},
+        "debug": {"type": ["bool", "null"], "coerce": True},
+    },
+    "required": ["platform"],
+}
+
+
+# TestCoercers {{{1
+class TestCoercers(unittest.TestCase):
+    """Test the COERCERS
+    """
+    def test_coerce(self):
+        """Lossless conversions work; others raise ValueError
+        """
+        for name, value, expected in (
+                ("bool", "Yes", True), ("bool", "0", False), ("bool", 1, True),
+                ("int", " 4", 4), ("int", 4.0, 4), ("float", "1.5", 1.5),
+                ("str", 4, "4"),
+        ):
+            self.assertEqual(schema.COERCERS[name](value), expected)
+        for name, value in (("bool", "maybe"), ("bool", 2), ("int", 4.5),
+                            ("int", "four"), ("float", []), ("str", True)):
+            self.assertRaises(ValueError, schema.COERCERS[name], value)
+
+
+# TestConfigSchema {{{1
+class TestConfigSchema(unittest.TestCase):
+    """Test ConfigSchema
+    """
+    def test_valid(self):
+        """Defaults and coercion are applied to a copy
+        """
+        config = {"platform": "linux", "env": {"A": "a", "B": 2},
+                  "tools": ["gcc"], "debug": "false", "other": [1]}
+        result = schema.ConfigSchema(SCHEMA).validate(config)
+        self.assertEqual(result, {
+            "platform": "linux", "env": {"A": "a", "B": "2"},
+            "tools": ["gcc"], "debug": False, "other": [1], "jobs": 1,
+        })
+        self.assertEqual(config["env"]["B"], 2)
+        self.assertTrue(result["tools"] is config["tools"])
+
+    def test_all_errors(self):
+        """Every error is reported at once
+        """
+        config = {"platform": "mac", "jobs": "many", "tools": ["gcc", 5],
+                  "env": {"A": []}, "debug": None}
+        try:
+            schema.ConfigSchema(SCHEMA).validate(config)
+        except ScriptHarnessException as exc_info:
+            errors = exc_info.args[1]
+        else:
+            self.fail("Invalid config didn't raise!")
+        self.assertEqual(sorted(errors), [
+            "config.env.A: expected str, got []",
+            "config.jobs: expected int, got 'many'",
+            "config.platform: 'mac' is not one of ['linux', 'win']",
+            "config.tools[1]: expected str, got 5",
+        ])
+
+    def test_missing_and_extra(self):
+        """Required and unexpected keys
+        """
+        strict = schema.ConfigSchema({"keys": {"a": {}}, "required": ["a"],
+                                      "extra": False})
+        self.assertRaises(ScriptHarnessException, strict.validate, {})
+        self.assertRaises(ScriptHarnessException, strict.validate,
+                          {"a": 1, "b": 2})
+        self.assertEqual(strict.validate({"a": 1}), {"a": 1})
+        self.assertRaises(ScriptHarnessException, strict.validate, {"a": True,
+                                                                    "b": 2})
+
+    def test_bool_isnt_int(self):
+        """An int schema doesn't accept bools
+        """
+        int_schema = schema.ConfigSchema({"keys": {"a": {"type": "int"}}})
+        self.assertRaises(ScriptHarnessException, int_schema.validate,
+                          {"a": True})
+
+    def test_bad_schema(self):
+        """Invalid schemas raise at compile time
+        """
+        self.assertRaises(ScriptHarnessException, schema.ConfigSchema,
+                          {"keys": {"a": {"type": "integer"}}})
+        self.assertRaises(ScriptHarnessException, schema.ConfigSchema,
+                          {"keys": {"a": "int"}})
+
+    def test_from_file(self):
+        """from_file() goes through the ParseCache
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "schema.json")
+            with open(path, "w") as filehandle:
+                json.dump(SCHEMA, filehandle)
+            parse_cache = ParseCache(os.path.join(tmpdir, "cache"))
+            for _ in range(2):
+                config_schema = schema.ConfigSchema.from_file(
+                    path, parse_cache=parse_cache
+                )
+            self.assertEqual(config_schema.schema, SCHEMA)
+            self.assertEqual(parse_cache.hits, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+# TestBuildConfig {{{1
+class TestBuildConfig(unittest.TestCase):
+    """Test build_config() schema validation
+    """
+    def test_build_config(self):
+        """The parser schema is applied as a replacing layer
+        """
+        config_schema = schema.ConfigSchema(
+            {"keys": {"tools": {"type": "list", "items": {"type": "str",
+                                                          "coerce": True}},
+                      "jobs": {"type": "int", "default": 2}}}
+        )
+        parser = shconfig.get_parser(config_schema=config_schema)
+        parsed_args = shconfig.parse_args(parser, cmdln_args=[])
+        layered_config = shconfig.build_layered_config(
+            parser, parsed_args, initial_config={"tools": [1, "a"]},
+            merge=DeepMerge(list_policy="append")
+        )
+        self.assertEqual(layered_config["tools"], ["1", "a"])
+        self.assertEqual(layered_config.get_source("jobs"), "schema")
+        self.assertRaises(
+            ScriptHarnessException, shconfig.build_config, parser,
+            parsed_args, initial_config={"jobs": "2"}
+        )
+        self.assertEqual(
+            shconfig.build_config(parser, parsed_args, schema={},
+                                  initial_config={"jobs": "2"})["jobs"], "2"
+        )
@@ -5,12 +5,15 @@
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import json
+import mock
 import os
 import scriptharness.actions as actions
 from scriptharness.config import get_parser
-from scriptharness.exceptions import ScriptHarnessException, ScriptHarnessFatal
+from scriptharness.exceptions import ScriptHarnessError, \
+    ScriptHarnessException, ScriptHarnessFatal
 import scriptharness.script as script
 import six
+import threading
 import unittest
 
 if six.PY3:
@@ -70,6 +73,14 @@ class TestScript(unittest.TestCase):
         self.timings.append("fatal")
         raise ScriptHarnessFatal("Fatal")
 
+    def change_config_and_error(self, config):
+        """Helper function for rollback_on_error testing
+        """
+        self.timings.append("error")
+        config['a'] = 2
+        config['new'] = []
+        raise ScriptHarnessError("Error")
+
     def test_bad_actions(self):
         """Script() should throw with a bad action list
         """
@@ -208,3 +219,151 @@ class TestScript(unittest.TestCase):
         self.assertEqual(
             contents, json.dumps(initial_config, sort_keys=True, indent=4)
         )
+
+    def test_dump_config_provenance(self):
+        """--dump-config logs where each value came from
+        """
+        with mock.patch.object(script.Script, 'log_provenance') as log:
+            self.assertRaises(SystemExit, self.get_script,
+                              cmdln_args=["--dump-config"],
+                              initial_config={'a': 1})
+        layered_config = log.call_args[0][0]
+        self.assertEqual(layered_config.get_source('a'), "initial_config")
+        self.assertEqual(layered_config.get_provenance(),
+                         {'a': "initial_config"})
+
+    def test_dict_to_config_gets_dict(self):
+        """dict_to_config() gets a plain dict; the layers are kept apart
+        """
+        with mock.patch.object(script.Script, 'dict_to_config',
+                               autospec=True,
+                               side_effect=script.Script.dict_to_config) \
+                as dict_to_config:
+            scr = self.get_script(initial_config={'a': 1})
+        config = dict_to_config.call_args[0][1]
+        self.assertEqual(type(config), dict)
+        self.assertEqual(config['a'], 1)
+        self.assertEqual(scr.layered_config.get_source('a'), "initial_config")
+
+    def test_compile_config(self):
+        """--compile-config writes the bundle and exits
+        """
+        self.assertRaises(SystemExit, self.get_script,
+                          cmdln_args=["--compile-config", "bundle.marshal"],
+                          initial_config={'a': 1})
+        try:
+            scr = self.get_script(cmdln_args=["--config-bundle",
+                                              "bundle.marshal"])
+        finally:
+            os.remove("bundle.marshal")
+        self.assertEqual(scr.config['a'], 1)
+
+    def test_save_config_in_background(self):
+        """A background save_config() is joined by run()
+        """
+        with mock.patch.object(script.Script, 'save_config_in_background',
+                               True):
+            scr = self.get_script(initial_config={'a': 1, 'b': {}})
+
+        def add_keys(config):
+            """Change the config while the save may be running"""
+            for num in range(200):
+                config['b'][str(num)] = num
+                config[str(num)] = num
+
+        scr.actions[0] = actions.Action("one", function=add_keys,
+                                        enabled=True)
+        self.assertTrue(scr._save_thread is not None)
+        scr.run()
+        self.assertTrue(scr._save_thread is None)
+        with open("localconfig.json") as filehandle:
+            saved = json.load(filehandle)
+        self.assertEqual(saved['a'], 1)
+        self.assertEqual(saved['b'], {})
+        self.assertFalse('0' in saved)
+
+    def test_save_config_in_background_streams(self):
+        """A background save_config() streams a plain copy on the thread
+        """
+        calls = []
+
+        def record(config, path):
+            """Record the config type and the thread"""
+            calls.append((type(config), threading.current_thread().name))
+            return save_config(config, path)
+
+        save_config = script.save_config
+        with mock.patch.object(script, 'save_config', side_effect=record):
+            with mock.patch('json.dumps') as dumps:
+                scr = self.get_script(initial_config={'a': [1]})
+                scr.save_config(background=True)
+                scr.wait_for_save_config()
+        self.assertEqual(calls[-1], (dict, "save_config"))
+        self.assertFalse(dumps.called)
+
+    def test_save_config_in_background_error(self):
+        """A failed background save_config() raises on join
+        """
+        with mock.patch.object(script.Script, 'save_config_in_background',
+                               True):
+            # the patch stays active until run() joins the save thread
+            with mock.patch.object(script, 'open_config_file',
+                                   side_effect=IOError("full")):
+                scr = self.get_script()
+                scr.wait_for_save_config(raise_errors=False)
+                self.assertTrue(scr._save_thread is None)
+                scr.save_config(background=True)
+                self.assertRaises(ScriptHarnessException, scr.run)
+        self.assertEqual(self.timings, ["one", "two", "four"])
+
+    def test_save_config_error_doesnt_mask(self):
+        """A failed background save doesn't replace an action's exception
+        """
+        with mock.patch.object(script.Script, 'save_config_in_background',
+                               True):
+            with mock.patch.object(script, 'open_config_file',
+                                   side_effect=IOError("full")):
+                scr = self.get_script()
+                scr.actions[1] = actions.Action(
+                    "two", function=self.raise_fatal, enabled=True)
+                with mock.patch.object(scr.logger, 'error') as error:
+                    self.assertRaises(ScriptHarnessFatal, scr.run)
+        self.assertTrue(scr._save_thread is None)
+        self.assertTrue(error.called)
+
+    def test_save_config_no_info(self):
+        """The config isn't pretty-printed if INFO is disabled
+        """
+        scr = self.get_script()
+        with mock.patch('pprint.pformat', return_value="") as pformat:
+            for enabled in (False, True):
+                with mock.patch.object(scr.logger, 'isEnabledFor',
+                                       return_value=enabled):
+                    scr.save_config()
+                self.assertEqual(pformat.called, enabled)
+
+    def helper_rollback(self, rollback_on_error):
+        """Run an action that changes the config, then errors out.
+        """
+        scr = self.get_script(initial_config={'a': 1})
+        scr.rollback_on_error = rollback_on_error
+        scr.actions[1] = actions.Action(
+            "two", function=self.change_config_and_error, enabled=True)
+        scr.run()
+        self.assertEqual(self.timings, ["one", "error", "four"])
+        return scr
+
+    def test_rollback_on_error(self):
+        """Config changes from an erroring action are rolled back
+        """
+        scr = self.helper_rollback(True)
+        self.assertEqual(scr.config['a'], 1)
+        self.assertFalse('new' in scr.config)
+        self.assertFalse(scr.config.journaling())
+
+    def test_no_rollback_on_error(self):
+        """By default, config changes from an erroring action stick
+        """
+        scr = self.helper_rollback(False)
+        self.assertEqual(scr.config['a'], 2)
+        self.assertEqual(scr.config['new'], [])
@@ -18,6 +18,7 @@ from __future__ import absolute_import, division, print_function, \
 from collections import OrderedDict
 from copy import deepcopy
 import mock
+import pickle
 import pprint
 from scriptharness.exceptions import ScriptHarnessException
 import scriptharness.structures as structures
@@ -478,6 +479,17 @@ class TestLoggingDict(TestLoggingClass):
             self.assertTrue(isinstance(logdict['a'], structures.LoggingClass))
             self.assertEqual(logdict.muted, logdict['a'].muted)
 
+    def test_from_pairs(self):
+        """Test LoggingDict.from_pairs
+        """
+        for pairs in (LOGGING_CONTROL_DICT,
+                      (pair for pair in LOGGING_CONTROL_DICT.items())):
+            logdict = structures.LoggingDict.from_pairs(pairs, muted=True)
+            self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+            self.assertTrue(logdict.muted)
+            self.assertTrue(isinstance(logdict['c'], structures.LoggingDict))
+            self.assertTrue(logdict['c'].muted)
+
 
 # TestLoggingList {{{2
 class TestLoggingList(TestLoggingClass):
@@ -611,6 +623,36 @@ class TestLoggingList(TestLoggingClass):
         self.get_logger_replacement(mock_logging)
         self.helper_extend(muted_loglist, self.muted_strings)
 
+    @mock.patch('scriptharness.structures.logging')
+    def test_extend_many(self, mock_logging):
+        """Test logging list extend_many, muted+unmuted
+        """
+        for muted, strings in ((False, self.strings),
+                               (True, self.muted_strings)):
+            loglist = get_logging_list(muted=muted)
+            self.get_logger_replacement(mock_logging)
+            count = loglist.extend_many(x for x in ['a', 'b', [], {}])
+            self.assertEqual(count, 4)
+            self.verify_log([
+                "%s: %s" % (NAME, strings['extend_many'] % {"count": 4})
+            ])
+            self.assertEqual(loglist[-4:], ['a', 'b', [], {}])
+            self.assertTrue(isinstance(loglist[-1], structures.LoggingDict))
+            self.assertEqual(loglist[-1].muted, muted)
+            self.assertEqual(loglist[-2].full_name(),
+                             "%s[%d]" % (NAME, len(loglist) - 2))
+
+    def test_from_iter(self):
+        """Test LoggingList.from_iter
+        """
+        loglist = structures.LoggingList.from_iter(
+            (x for x in LOGGING_CONTROL_LIST), muted=True
+        )
+        self.assertEqual(loglist, LOGGING_CONTROL_LIST)
+        self.assertTrue(loglist.muted)
+        self.assertTrue(isinstance(loglist[7], structures.LoggingList))
+        self.assertTrue(loglist[7].muted)
+
     @mock.patch('scriptharness.structures.logging')
     def test_insert(self, mock_logging):
         """Test logging list insert
@@ -732,6 +774,160 @@ class TestAddLogging(unittest.TestCase):
         self.assertRaises(RuntimeError, structures.add_logging_to_obj, three)
         self.assertRaises(RuntimeError, structures.add_logging_to_obj, four)
 
+    def test_fresh_passthrough(self):
+        """Fresh from_pairs() dicts are adopted once, not copied
+        """
+        child = structures.LoggingDict.from_pairs([('a', [1, 2])])
+        self.assertFalse(
+            structures.add_logging_to_obj(child, logger_name="other") is child
+        )
+        self.assertFalse(
+            structures.add_logging_to_obj(child, muted=True) is child
+        )
+        # already adopted by child
+        self.assertFalse(
+            structures.add_logging_to_obj(child['a']) is child['a']
+        )
+        logdict = structures.LoggingDict({'child': child})
+        self.assertTrue(logdict['child'] is child)
+        logdict.recursively_set_parent(name="logdict")
+        self.assertTrue(child.parent is logdict)
+        # once adopted, assigning it elsewhere copies it
+        logdict['copy'] = child
+        self.assertFalse(logdict['copy'] is child)
+        self.assertEqual(logdict['copy'], child)
+
+    def test_shared_child_copied(self):
+        """A child shared between keys, or owned by the caller, is copied
+        """
+        child = structures.LoggingDict({'x': 1})
+        logdict = structures.LoggingDict({'a': child, 'b': child})
+        self.assertFalse(logdict['a'] is logdict['b'])
+        self.assertFalse(logdict['a'] is child)
+        fresh = structures.LoggingDict.from_pairs([('x', 1)])
+        logdict = structures.LoggingDict({'a': fresh, 'b': fresh})
+        self.assertFalse(logdict['a'] is logdict['b'])
+        loglist = structures.LoggingList([child])
+        self.assertFalse(loglist[0] is child)
+        logdict.update({'c': child})
+        logdict['d'] = child
+        self.assertFalse(logdict['c'] is child or logdict['d'] is child)
+
+
+# TestSnapshot {{{2
+class TestSnapshot(unittest.TestCase):
+    """Test LoggingDict snapshot(), rollback(), and release()
+    """
+    def test_dict_rollback(self):
+        """Rollback dict changes
+        """
+        logdict = get_logging_dict()
+        snapshot = logdict.snapshot()
+        logdict['a'] = 'changed'
+        logdict['new'] = {'x': 1}
+        del logdict['b']
+        logdict.pop('c')
+        logdict.setdefault('setdefault', [])
+        logdict.update({'a': 2, 'update': 3})
+        logdict.popitem()
+        self.assertEqual(logdict.rollback(snapshot), 8)
+        self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+
+    def test_clear_rollback(self):
+        """Rollback dict clear()
+        """
+        logdict = get_logging_dict()
+        snapshot = logdict.snapshot()
+        logdict.clear()
+        logdict.rollback(snapshot)
+        self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+
+    def test_child_rollback(self):
+        """Rollback changes to children
+        """
+        logdict = get_logging_dict()
+        snapshot = logdict.snapshot()
+        turtles = logdict['d']['turtles']
+        turtles.append('turtle4')
+        turtles.extend(['turtle5', 'turtle6'])
+        turtles.insert(-1, 'turtle7')
+        turtles.remove('turtle1')
+        turtles.pop()
+        turtles.pop(0)
+        turtles[0] = 'turtle0'
+        del turtles[-1]
+        turtles.reverse()
+        turtles.sort()
+        logdict['e'][2]['turtles'][1] = 'x'
+        del logdict['e'][0:1]
+        logdict['c']['d'] = '5'
+        logdict.rollback(snapshot)
+        self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+        self.assertTrue(logdict['d']['turtles'] is turtles)
+        self.assertEqual(logdict['e'][2].full_name(), "%s['e'][2]" % NAME)
+
+    def test_inplace_rollback(self):
+        """Rollback +=, *= and |= changes
+        """
+        logdict = get_logging_dict()
+        snapshot = logdict.snapshot()
+        logdict['d']['turtles'] += ['turtle4']
+        logdict['e'][2]['turtles'] *= 2
+        logdict['c'] |= {'d': '5', 'new': 6}
+        logdict['d']['turtles'] *= 0
+        self.assertEqual(logdict['d']['turtles'], [])
+        self.assertEqual(len(logdict['e'][2]['turtles']), 6)
+        logdict.rollback(snapshot)
+        self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+
+    def test_unparented_rollback(self):
+        """snapshot() sets the parents, so nested changes are rolled back
+        """
+        logdict = structures.LoggingDict(deepcopy(LOGGING_CONTROL_DICT))
+        snapshot = logdict.snapshot()
+        logdict['c']['d'] = '5'
+        logdict['e'][2]['turtles'].append('turtle7')
+        self.assertEqual(logdict.rollback(snapshot), 2)
+        self.assertEqual(logdict, LOGGING_CONTROL_DICT)
+
+    def test_nested_snapshots(self):
+        """Rollback to an older snapshot drops the newer ones
+        """
+        logdict = get_logging_dict()
+        first = logdict.snapshot()
+        logdict['a'] = 2
+        second = logdict.snapshot()
+        logdict['a'] = 3
+        self.assertEqual(logdict.rollback(second), 1)
+        self.assertEqual(logdict['a'], 2)
+        self.assertEqual(logdict.rollback(first), 1)
+        self.assertEqual(logdict['a'], 1)
+        self.assertRaises(ScriptHarnessException, logdict.rollback, second)
+
+    def test_release(self):
+        """Releasing the last snapshot stops the journal
+        """
+        logdict = get_logging_dict()
+        snapshot = logdict.snapshot()
+        logdict['a'] = 2
+        logdict.release(snapshot)
+        self.assertFalse(logdict.journaling())
+        logdict['a'] = 3
+        self.assertRaises(ScriptHarnessException, logdict.rollback, snapshot)
+        self.assertEqual(logdict['a'], 3)
+
+    def test_release_trims_journal(self):
+        """Releasing the oldest snapshot keeps the newer snapshot usable
+        """
+        logdict = get_logging_dict()
+        first = logdict.snapshot()
+        logdict['a'] = 2
+        second = logdict.snapshot()
+        logdict['a'] = 3
+        logdict.release(first)
+        self.assertEqual(logdict.rollback(second), 1)
+        self.assertEqual(logdict['a'], 2)
+
 
 # Test ReadOnlyDict {{{1
 # helper methods {{{2
@@ -927,3 +1123,204 @@ class TestDeepcopyROD(unittest.TestCase):
         rod2.lock()
         with self.assertRaises(ScriptHarnessException):
             rod2['e'] = 'hey'
+
+
+# TestFrozenConfig {{{1
+class TestFrozenConfig(unittest.TestCase):
+    """Test FrozenConfig
+    """
+    def test_equality(self):
+        """A FrozenConfig and the equivalent dict should be equal.
+        """
+        frozen = structures.FrozenConfig(deepcopy(RO_CONTROL_DICT))
+        self.assertEqual(frozen['a'], RO_CONTROL_DICT['a'])
+        self.assertEqual(deepcopy(frozen), RO_CONTROL_DICT)
+
+    def test_read_only(self):
+        """Any change to a FrozenConfig should raise
+        """
+        frozen = structures.FrozenConfig(deepcopy(RO_CONTROL_DICT))
+        def setitem():
+            """Test func"""
+            frozen['a'] = 2
+        def delitem():
+            """Test func"""
+            del frozen['a']
+        self.assertRaises(ScriptHarnessException, setitem)
+        self.assertRaises(ScriptHarnessException, delitem)
+        for func, args in ((frozen.clear, ()), (frozen.pop, ('a', )),
+                           (frozen.popitem, ()), (frozen.update, ({}, )),
+                           (frozen.setdefault, ('z', 1)),
+                           (frozen['c'].update, ({}, ))):
+            self.assertRaises(ScriptHarnessException, func, *args)
+        self.assertFalse(hasattr(frozen['d']['turtles'], 'append'))
+        self.assertEqual(deepcopy(frozen), RO_CONTROL_DICT)
+
+    def test_hash(self):
+        """Equal FrozenConfigs should hash the same
+        """
+        frozen1 = structures.FrozenConfig(deepcopy(RO_CONTROL_DICT))
+        frozen2 = structures.make_immutable(deepcopy(RO_CONTROL_DICT),
+                                            frozen=True)
+        self.assertEqual(hash(frozen1), hash(frozen2))
+        self.assertEqual(len(set([frozen1, frozen2])), 1)
+
+    def test_freeze(self):
+        """ReadOnlyDict.freeze() should return a FrozenConfig
+        """
+        rod = get_locked_rod()
+        frozen = rod.freeze()
+        self.assertTrue(isinstance(frozen, structures.FrozenConfig))
+        self.assertTrue(isinstance(frozen['e'][2],
+                                   structures.FrozenConfig))
+        self.assertEqual(frozen, rod)
+
+    def test_deepcopy(self):
+        """deepcopy of a FrozenConfig should be a read-write dict
+        """
+        frozen = structures.FrozenConfig(deepcopy(RO_CONTROL_DICT))
+        copied = deepcopy(frozen)
+        self.assertEqual(copied, RO_CONTROL_DICT)
+        copied['d']['turtles'].append('turtle4')
+        self.assertEqual(len(frozen['d']['turtles']), 3)
+
+    def test_pickle(self):
+        """FrozenConfig should survive a pickle round trip
+        """
+        frozen = structures.FrozenConfig(deepcopy(RO_CONTROL_DICT))
+        unpickled = pickle.loads(pickle.dumps(frozen))
+        self.assertTrue(isinstance(unpickled, structures.FrozenConfig))
+        self.assertEqual(unpickled, frozen)
+
+
+# TestLayeredConfig {{{1
+class TestLayeredConfig(unittest.TestCase):
+    """Test LayeredConfig
+    """
+    def get_layered_config(self):
+        """Three layers; 'b' and 'c' are overridden"""
+        self.layers = [
+            ("low", {'a': 1, 'b': 1, 'c': {'x': 1}}),
+            ("middle", {'b': 2}),
+            ("high", {'c': {'y': 3}, 'd': 3}),
+        ]
+        return structures.LayeredConfig(self.layers)
+
+    def test_resolve(self):
+        """Keys resolve to the highest precedence layer, without merging
+        """
+        layered = self.get_layered_config()
+        expected = {'a': 1, 'b': 2, 'c': {'y': 3}, 'd': 3}
+        self.assertEqual(dict(layered), expected)
+        self.assertEqual(dict(layered.iter_resolved()), expected)
+        self.assertEqual(len(layered), 4)
+        self.assertTrue('a' in layered)
+        self.assertFalse('z' in layered)
+        self.assertEqual(layered.get('z', 'default'), 'default')
+        self.assertRaises(KeyError, layered.__getitem__, 'z')
+
+    def test_no_copies(self):
+        """Layers are kept as-is
+        """
+        layered = self.get_layered_config()
+        self.assertTrue(layered['c'] is self.layers[2][1]['c'])
+        self.layers[0][1]['a'] = 5
+        self.assertEqual(layered['a'], 5)
+
+    def test_provenance(self):
+        """get_source() and get_provenance() name the supplying layer
+        """
+        layered = self.get_layered_config()
+        self.assertEqual(layered.get_source('b'), "middle")
+        self.assertEqual(layered.get_provenance(), {
+            'a': "low", 'b': "middle", 'c': "high", 'd': "high",
+        })
+        self.assertRaises(KeyError, layered.get_source, 'z')
+        layered.add_layer("top", {'a': 0, 'z': 0})
+        self.assertEqual(layered.get_source('a'), "top")
+        self.assertEqual(len(layered), 5)
+
+    def test_flatten(self):
+        """flatten() builds a LoggingDict
+        """
+        layered = self.get_layered_config()
+        flat = layered.flatten(logger_name=LOGGER_NAME)
+        self.assertTrue(isinstance(flat, structures.LoggingDict))
+        self.assertTrue(isinstance(flat['c'], structures.LoggingDict))
+        self.assertEqual(flat.logger_name, LOGGER_NAME)
+        self.assertEqual(flat, dict(layered))
+
+    def test_merge(self):
+        """With a merge function, nested dicts are merged across layers
+        """
+        layered = self.get_layered_config()
+        layered.merge = structures.DeepMerge()
+        self.assertEqual(layered['c'], {'x': 1, 'y': 3})
+        self.assertEqual(self.layers[0][1]['c'], {'x': 1})
+        layered.add_layer("scalar", {'c': 5})
+        self.assertEqual(dict(layered.iter_resolved()),
+                         {'a': 1, 'b': 2, 'c': 5, 'd': 3})
+
+    def test_merged_sources(self):
+        """Merged values report every contributing layer
+        """
+        layered = self.get_layered_config()
+        self.assertEqual(layered.get_sources('c'), ["high"])
+        layered.merge = structures.DeepMerge()
+        self.assertEqual(layered.get_sources('c'), ["low", "high"])
+        self.assertEqual(layered.get_provenance()['c'], "high")
+        self.assertEqual(layered.get_provenance(all_sources=True), {
+            'a': ["low"], 'b': ["middle"], 'c': ["low", "high"],
+            'd': ["high"],
+        })
+        layered.add_layer("replace", {'c': {'z': 4}}, replace=True)
+        self.assertEqual(layered.get_sources('c'), ["replace"])
+        self.assertRaises(KeyError, layered.get_sources, 'missing')
+
+
+# TestDeepMerge {{{1
+class TestDeepMerge(unittest.TestCase):
+    """Test DeepMerge
+    """
+    base = {
+        'env': {'PATH': '/bin', 'HOME': '/home'},
+        'platform': {'linux': {'tools': ['gcc']}},
+        'steps': [{'name': 'build', 'jobs': 1}, {'name': 'test'}, 'lint'],
+    }
+
+    def test_dicts(self):
+        """Only the touched dicts are copied, and base isn't changed
+        """
+        base = deepcopy(self.base)
+        merged = structures.DeepMerge()(base, {'env': {'PATH': '/usr/bin'}})
+        self.assertEqual(merged['env'], {'PATH': '/usr/bin', 'HOME': '/home'})
+        self.assertEqual(base, self.base)
+        self.assertTrue(merged['platform'] is base['platform'])
+        self.assertTrue(merged['steps'] is base['steps'])
+        self.assertEqual(structures.DeepMerge()(base, {'env': None})['env'],
+                         None)
+
+    def test_list_policies(self):
+        """replace, append and merge list policies
+        """
+        overlay = {'steps': [{'name': 'build', 'jobs': 4}, 'package'],
+                   'platform': {'linux': {'tools': ['clang']}}}
+        merged = structures.DeepMerge()(self.base, overlay)
+        self.assertEqual(merged['steps'], overlay['steps'])
+        merged = structures.DeepMerge(list_policy="append")(self.base,
+                                                            overlay)
+        self.assertEqual(merged['platform']['linux']['tools'],
+                         ['gcc', 'clang'])
+        self.assertEqual(len(merged['steps']), 5)
+        merged = structures.DeepMerge(list_policy="merge")(self.base,
+                                                           overlay)
+        self.assertEqual(merged['steps'], [
+            {'name': 'build', 'jobs': 4}, {'name': 'test'}, 'lint', 'package',
+        ])
+        self.assertEqual(self.base['steps'][0], {'name': 'build', 'jobs': 1})
+
+    def test_bad_list_policy(self):
+        """An unknown list_policy raises
+        """
+        self.assertRaises(ScriptHarnessException, structures.DeepMerge,
+                          list_policy="bad")